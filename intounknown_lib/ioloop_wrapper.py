@@ -47,3 +47,22 @@ class Loop:
     def get_time(self):
         return self.ioloop.time()
 
+    # Call callback() whenever the file descriptor is readable (BackgroundManager add_reader_cb)
+    def add_reader(self, fd, callback):
+        def handler(fd, events):
+            callback()
+        self.ioloop.add_handler(fd, handler, tornado.ioloop.IOLoop.READ)
+
+    def remove_reader(self, fd):
+        self.ioloop.remove_handler(fd)
+
+    # Awaitable for a concurrent.futures.Future (WorkerExecutor.submit), resolves on this loop
+    #   result = await loop.wrap_future(future)
+    #   results = await asyncio.gather(*[loop.wrap_future(f) for f in futures])
+    def wrap_future(self, future):
+        return asyncio.wrap_future(future, loop=self.ioloop.asyncio_loop)
+
+    # Call callback(future) on this loop once the future is done
+    def add_future(self, future, callback):
+        self.ioloop.add_future(future, callback)
+
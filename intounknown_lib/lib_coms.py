@@ -0,0 +1,1050 @@
+# Message queues (coms) shared by ProcessManagement, its workers, RingCom and the socket transport
+from threading import Thread
+from threading import RLock as ThreadLock
+from threading import Condition
+from threading import local as ThreadLocal
+from queue import Queue as ThreadQueue
+from queue import Empty as QueueEmpty
+from queue import Full as QueueFull
+from collections import deque
+
+# Import Multiprocessing Objects
+import multiprocessing
+from multiprocessing import Queue as ProcessQueue
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait as wait_objects
+from multiprocessing.context import assert_spawning
+from multiprocessing.synchronize import SEM_VALUE_MAX
+from multiprocessing.util import Finalize, register_after_fork
+
+from itertools import count
+import pickle
+import marshal
+import weakref
+
+from time import time, sleep, perf_counter
+import socket
+
+
+OVERFLOW_POLICIES = ('block', 'timeout', 'reject', 'drop_oldest')
+
+
+
+# Written to a work queue by wake(), read() returns None for it so a worker blocked on
+#   its work queue goes on to check its command queue (see ProcessManagement.shutdown_all)
+class WakeSignal:
+    pass
+
+
+# Wakeup socket pair of one thread for wait_for_any, a ThreadCom write signals as many waiting threads as
+#   it wrote messages, so readers of a shared queue do not consume each other's signals
+class Waiter:
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def signal(self):
+        try:
+            self.writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass    # socket buffer is full so the thread already has a pending signal
+
+    def clear(self):
+        while True:
+            try:
+                if not self.reader.recv(4096):
+                    break
+            except (BlockingIOError, InterruptedError):
+                break
+
+    # the thread ended
+    def __del__(self):
+        self.reader.close()
+        self.writer.close()
+
+
+_thread_waiters = ThreadLocal()
+
+
+# the calling thread's Waiter
+def thread_waiter():
+    waiter = getattr(_thread_waiters, 'waiter', None)
+    if waiter is None:
+        waiter = _thread_waiters.waiter = Waiter()
+    return waiter
+
+
+# ThreadCommunication
+#   maxsize=0 is unbounded, overflow decides what write does when the queue is full
+#       block           wait for room
+#       timeout         wait up to put_timeout seconds then raise QueueFull
+#       reject          raise QueueFull right away
+#       drop_oldest     discard the oldest messages, write returns them (otherwise write returns None)
+class ThreadCom:
+    def __init__(self, maxsize=0, overflow='block', put_timeout=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception('overflow ['+str(overflow)+'] not found')
+
+        self.com = ThreadQueue(maxsize)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.wakeup = None      # (reader, writer) socket pair, created by fileno()
+        self.waiters = []       # Waiter of each thread blocked in wait_for_any on this queue
+
+    # read and return immediately or wait and block for X seconds
+    def read(self, timeout=0):
+        msg = self._read_raw(timeout)
+        if isinstance(msg, WakeSignal):
+            return None     # woken up by wake(), the caller checks its command queue
+        return msg
+
+    def _read_raw(self, timeout=0):
+        block = False
+        if timeout != 0:
+            block = True
+        try:
+            return self.com.get(block, timeout)
+        except QueueEmpty:
+            return None
+
+    # run size the queue
+    def size(self):
+        return self.com.qsize()
+
+    # if queue is empty (has no work)
+    def is_empty(self):
+        return self.com.empty()
+
+    # read up to max_count messages, waits up to timeout for the first one (returns [] if none)
+    def read_many(self, max_count=None, timeout=0):
+        msg = self.read(timeout)
+        if msg is None:
+            return []
+
+        result = [msg]
+        queue_obj = self.com
+        with queue_obj.mutex:     # take the rest under one lock
+            items = queue_obj.queue
+            while items and (max_count is None or len(result) < max_count):
+                if isinstance(items[0], WakeSignal):
+                    break       # leave it for the next reader
+                result.append(items.popleft())
+            queue_obj.not_full.notify(len(result) - 1)
+
+        return result
+
+    # put a WakeSignal on the queue so one blocked reader returns None right away (ignores maxsize)
+    def wake(self):
+        queue_obj = self.com
+        with queue_obj.mutex:
+            queue_obj.queue.append(WakeSignal())
+            queue_obj.unfinished_tasks += 1
+            queue_obj.not_empty.notify()
+        self._signal_wakeup()
+
+    # is the queue at maxsize
+    def is_full(self):
+        return self.maxsize > 0 and self.size() >= self.maxsize
+
+    # write a job to the queue (priority is used by PriorityCom)
+    def write(self, msg, priority=None):
+        if self.maxsize > 0:
+            return self.write_many([msg])
+
+        self.com.put(msg)
+        self._signal_wakeup()
+        return None
+
+    # write a list of jobs with one lock and one wakeup signal
+    #   on a bounded queue the overflow policy applies to the whole batch (nothing is written on QueueFull)
+    def write_many(self, msgs, priority=None):
+        if not msgs:
+            return None
+
+        dropped = None
+        queue_obj = self.com
+        with queue_obj.not_full:
+            if self.maxsize > 0:
+                dropped, msgs = self._make_room(msgs)
+            queue_obj.queue.extend(msgs)
+            queue_obj.unfinished_tasks += len(msgs)
+            queue_obj.not_empty.notify(len(msgs))
+        self._signal_wakeup(len(msgs))
+
+        return dropped
+
+    # apply the overflow policy until msgs fit, called with the queue lock held
+    def _make_room(self, msgs):
+        queue_obj = self.com
+        items = queue_obj.queue
+
+        if len(msgs) > self.maxsize:
+            if self.overflow != 'drop_oldest':
+                raise QueueFull(f'batch of {len(msgs)} is larger than maxsize {self.maxsize}')
+            dropped = list(items) + msgs[:-self.maxsize]
+            items.clear()
+            queue_obj.unfinished_tasks -= len(dropped) - (len(msgs) - self.maxsize)
+            return dropped, msgs[-self.maxsize:]
+
+        dropped = None
+        deadline = None
+        while self.maxsize - len(items) < len(msgs):
+            if self.overflow == 'drop_oldest':
+                if dropped is None:
+                    dropped = []
+                dropped.append(items.popleft())
+                queue_obj.unfinished_tasks -= 1
+            elif self.overflow == 'reject':
+                raise QueueFull('queue is full')
+            else:
+                timeout = None
+                if self.overflow == 'timeout':
+                    if deadline is None:
+                        deadline = time() + self.put_timeout
+                    timeout = deadline - time()
+                    if timeout <= 0:
+                        raise QueueFull(f'queue still full after {self.put_timeout}s')
+                queue_obj.not_full.wait(timeout)
+
+        return dropped, msgs
+
+    # remove queued messages where predicate(msg) is true, returns them
+    def remove(self, predicate):
+        queue_obj = self.com
+        with queue_obj.mutex:
+            removed = [a for a in queue_obj.queue if predicate(a)]
+            if not removed:
+                return []
+
+            kept = [a for a in queue_obj.queue if not predicate(a)]
+            queue_obj.queue.clear()
+            queue_obj.queue.extend(kept)
+            queue_obj.unfinished_tasks -= len(removed)
+            queue_obj.not_full.notify(len(removed))
+
+        return removed
+
+    # block until queue is empty
+    def join(self):
+        self.com.join()
+
+    # object for multiprocessing.connection.wait that is ready when a message was written
+    #   (call clear_wakeup before reading)
+    def waitable(self):
+        self.fileno()
+        return self.wakeup[0]
+
+    # file descriptor that becomes readable when a message is written (for select, Tk or tornado)
+    def fileno(self):
+        if self.wakeup is None:
+            reader, writer = socket.socketpair()
+            reader.setblocking(False)
+            writer.setblocking(False)
+            self.wakeup = (reader, writer)
+            if not self.is_empty():
+                self._signal_wakeup()   # messages written before the wakeup existed
+
+        return self.wakeup[0].fileno()
+
+    # close the socket pair of fileno() and waitable() (remove it from the event loop first),
+    #   a later fileno() makes a new one
+    def close(self):
+        wakeup = self.wakeup
+        self.wakeup = None
+        if wakeup is not None:
+            wakeup[0].close()
+            wakeup[1].close()
+
+    # consume pending wakeup signals, call before reading the queue
+    def clear_wakeup(self):
+        if self.wakeup is None:
+            return
+
+        reader = self.wakeup[0]
+        while True:
+            try:
+                if not reader.recv(4096):
+                    break
+            except (BlockingIOError, InterruptedError):
+                break
+
+    # wait_for_any: the next write signals this thread's waiter, returns the object to wait on
+    def watch(self, waiter):
+        with self.com.mutex:
+            if waiter not in self.waiters:
+                self.waiters.append(waiter)
+        return waiter.reader
+
+    def unwatch(self, waiter):
+        with self.com.mutex:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    # count: messages written, wakes that many waiting threads (each one is signalled once)
+    def _signal_wakeup(self, count=1):
+        if self.waiters:
+            with self.com.mutex:
+                woken = self.waiters[:count]
+                del self.waiters[:count]
+            for waiter in woken:
+                waiter.signal()
+
+        wakeup = self.wakeup
+        if wakeup is None:
+            return
+
+        try:
+            wakeup[1].send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass    # socket buffer is full so the reader already has a pending signal
+        except OSError:
+            pass    # closed by close() meanwhile
+
+
+# Handle to a block of shared memory, only the name and size travel through a queue
+#   manager: payload = process_manager.share(data)   # or SharedPayload.create(size=n) and fill payload.view()
+#   worker:  with payload as view: ...                # memoryview over the same pages, no copy
+class SharedPayload:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.shm = None
+        self.views = []
+
+    @classmethod
+    def create(cls, data=None, size=None):
+        if size is None:
+            size = len(data)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))    # zero sized blocks are not allowed
+        payload = cls(shm.name, size)
+        payload.shm = shm
+        if data is not None:
+            shm.buf[:size] = data
+
+        return payload
+
+    def __getstate__(self):
+        return {'name': self.name, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['size'])
+
+    # memoryview over the shared block (attaches on first use)
+    def view(self):
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+
+        view = self.shm.buf[:self.size]
+        self.views.append(view)
+        return view
+
+    # detach from the block, views returned by view() are released
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+    # free the block, done once by whoever owns it
+    def unlink(self):
+        if self.shm is None:
+            try:
+                self.shm = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                return      # already freed
+
+        shm = self.shm
+        self.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self.view()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# SharedPayload objects in a message (the message itself, dict values or list items)
+def find_payloads(msg):
+    if isinstance(msg, SharedPayload):
+        return [msg]
+
+    if isinstance(msg, dict):
+        items = msg.values()
+    elif isinstance(msg, (list, tuple)):
+        items = msg
+    else:
+        return []
+
+    return [a for a in items if isinstance(a, SharedPayload)]
+
+
+# write_many of a single reader queue sends its messages as one MessageBatch (one pickle and one pipe
+#   write), the reading side unpacks it so read() still returns single messages
+class MessageBatch(list):
+    pass
+
+
+# frames of a ProcessCom with a codec, the kind byte starts the head frame
+FRAME_WAKE = 0      # a WakeSignal, nothing else
+FRAME_DATA = 1      # the codec's data, extra was None
+FRAME_EXTRA = 2     # pickle of (data, extra) for a codec flag
+FRAME_BUFFERS = 3   # a 4 byte count and the data, that many out-of-band buffer frames follow the head
+FRAME_BATCH = 0x80  # or-ed into the kind, the codec encoded a MessageBatch as a list
+FRAME_KIND = 0x7f
+KIND_BYTES = [bytes((a,)) for a in range(256)]
+
+
+# Serialization for ProcessCom(codec=...) and RingCom(codec=...), the queue sends the encoded bytes as they are
+#   encode(msg) -> (data, extra) and decode(data, extra) -> msg, extra is the codec's own: None, a flag or a
+#   list of out-of-band PickleBuffers (ProcessCom sends those as frames of their own without copying them)
+#   stats counts messages, bytes put on the pipe and seconds spent, in the process that encoded or decoded
+#   (the parent sees encode costs of work_in and decode costs of work_out)
+class Codec:
+    name = 'pickle'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+        self.stats = {'encoded': 0, 'decoded': 0, 'bytes': 0, 'encode_seconds': 0.0, 'decode_seconds': 0.0,
+            'fallbacks': 0, 'buffers': 0}
+
+    def encode(self, msg):
+        start = perf_counter()
+        data, extra = self._encode(msg)
+        self._encoded(start, len(data))
+        return data, extra
+
+    def decode(self, data, extra):
+        start = perf_counter()
+        msg = self._decode(data, extra)
+        self._decoded(start)
+        return msg
+
+    # the frames ProcessCom writes for msg, the head (kind byte and data) and any out-of-band buffers
+    def encode_frame(self, msg, batch=False):
+        start = perf_counter()
+        data, extra = self._encode(msg)
+        flags = FRAME_BATCH if batch else 0
+        if extra is None:
+            frame = [KIND_BYTES[FRAME_DATA | flags] + data]
+            size = len(frame[0])
+        elif isinstance(extra, list):
+            frame = [KIND_BYTES[FRAME_BUFFERS | flags] + len(extra).to_bytes(4, 'little') + data]
+            frame.extend(a.raw() for a in extra)
+            size = sum(memoryview(a).nbytes for a in frame)
+        else:
+            frame = [KIND_BYTES[FRAME_EXTRA | flags] + pickle.dumps((data, extra), protocol=pickle.HIGHEST_PROTOCOL)]
+            size = len(frame[0])
+        self._encoded(start, size)
+        return frame
+
+    def decode_frame(self, frame):
+        head = frame[0]
+        kind = head[0] & FRAME_KIND
+        if kind == FRAME_WAKE:
+            return WakeSignal()
+
+        start = perf_counter()
+        view = memoryview(head)
+        if kind == FRAME_DATA:
+            msg = self._decode(view[1:], None)
+        elif kind == FRAME_BUFFERS:
+            msg = self._decode(view[5:], frame[1:])
+        else:
+            msg = self._decode(*pickle.loads(view[1:]))
+        self._decoded(start)
+        return MessageBatch(msg) if head[0] & FRAME_BATCH else msg
+
+    def _encoded(self, start, size):
+        self.stats['encode_seconds'] += perf_counter() - start
+        self.stats['encoded'] += 1
+        self.stats['bytes'] += size
+
+    def _decoded(self, start):
+        self.stats['decode_seconds'] += perf_counter() - start
+        self.stats['decoded'] += 1
+
+    def _encode(self, msg):
+        return pickle.dumps(msg, protocol=self.protocol), None
+
+    def _decode(self, data, extra):
+        return pickle.loads(data)
+
+    # counters plus microseconds per message
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['codec'] = self.name
+        stats['encode_us'] = stats['encode_seconds'] / stats['encoded'] * 1e6 if stats['encoded'] else None
+        stats['decode_us'] = stats['decode_seconds'] / stats['decoded'] * 1e6 if stats['decoded'] else None
+        stats['bytes_per_message'] = stats['bytes'] / stats['encoded'] if stats['encoded'] else None
+        return stats
+
+
+class PickleCodec(Codec):
+    pass
+
+
+# pickle protocol 5, PickleBuffer payloads (numpy arrays, bytearray) are not copied into the pickle stream,
+#   ProcessCom writes them to the pipe straight from the message and decode uses what it received as is
+class Pickle5Codec(Codec):
+    name = 'pickle5'
+
+    def __init__(self):
+        super().__init__(5)
+
+    def _encode(self, msg):
+        buffers = []
+        data = pickle.dumps(msg, protocol=5, buffer_callback=buffers.append)
+        if not buffers:
+            return data, None
+        self.stats['buffers'] += len(buffers)
+        return data, buffers
+
+    def _decode(self, data, extra):
+        return pickle.loads(data, buffers=extra)
+
+
+# marshal for messages of plain builtins (dict, list, str, bytes, numbers), the fastest for
+#   the {'msg_id': .., 'msg': ..} dicts, anything marshal refuses is pickled (counted as fallbacks)
+class MarshalCodec(Codec):
+    name = 'marshal'
+
+    def _encode(self, msg):
+        try:
+            return marshal.dumps(msg), None
+        except ValueError:
+            self.stats['fallbacks'] += 1
+            return pickle.dumps(msg, protocol=self.protocol), 'pickle'
+
+    def _decode(self, data, extra):
+        if extra == 'pickle':
+            return pickle.loads(data)
+        return marshal.loads(data)
+
+
+# user supplied encode(msg) -> bytes and decode(bytes) -> msg (must pickle for spawn and forkserver)
+class CustomCodec(Codec):
+    def __init__(self, encode, decode, name='custom'):
+        super().__init__()
+        self.encode_func = encode
+        self.decode_func = decode
+        self.name = name
+
+    def _encode(self, msg):
+        return self.encode_func(msg), None
+
+    def _decode(self, data, extra):
+        return self.decode_func(bytes(data))
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'pickle5': Pickle5Codec,
+    'marshal': MarshalCodec,
+}
+
+
+# None (the queue pickles as before), a name from CODECS or a Codec object
+def get_codec(codec):
+    if codec is None or isinstance(codec, Codec):
+        return codec
+
+    codec_class = CODECS.get(codec, None)
+    if codec_class is None:
+        raise Exception('codec ['+str(codec)+'] not found')
+    return codec_class()
+
+
+WAKE_FRAME = [KIND_BYTES[FRAME_WAKE]]
+
+
+# Process queue of frames for ProcessCom(codec=...), the bytes the codec made go through the pipe as they are
+#   (multiprocessing.Queue would pickle them a second time), put() hands a frame (a list of byte strings, see
+#   Codec.encode_frame) to a feeder thread so a writer never blocks on a full pipe
+#   maxsize counts messages as in multiprocessing.Queue, the feeder flushes at exit the same way
+class FrameQueue:
+    def __init__(self, maxsize=0, ctx=None):
+        ctx = multiprocessing.get_context() if ctx is None else ctx
+        self.maxsize = maxsize if maxsize > 0 else SEM_VALUE_MAX
+        self._reader, self._writer = ctx.Pipe(duplex=False)
+        self.read_lock = ctx.Lock()
+        self.write_lock = ctx.Lock()    # the parts of a frame stay together
+        self.slots = ctx.BoundedSemaphore(self.maxsize)
+        self._reset()
+        register_after_fork(self, FrameQueue._reset)
+
+    def _reset(self):
+        self.buffer = deque()
+        self.buffer_cond = Condition(ThreadLock())
+        self.feeder = None
+
+    def __getstate__(self):
+        assert_spawning(self)
+        return (self.maxsize, self._reader, self._writer, self.read_lock, self.write_lock, self.slots)
+
+    def __setstate__(self, state):
+        self.maxsize, self._reader, self._writer, self.read_lock, self.write_lock, self.slots = state
+        self._reset()
+        register_after_fork(self, FrameQueue._reset)
+
+    def put(self, frame, block=True, timeout=None):
+        if not self.slots.acquire(block, timeout if block else None):
+            raise QueueFull
+        with self.buffer_cond:
+            if self.feeder is None:
+                self._start_feeder()
+            self.buffer.append(frame)
+            self.buffer_cond.notify()
+
+    def _start_feeder(self):
+        self.feeder = Thread(target=FrameQueue._feed, args=(self.buffer, self.buffer_cond, self._writer,
+            self.write_lock), daemon=True)
+        self.feeder.start()
+        # at exit first tell the feeder to stop after what is buffered, then wait for it (multiprocessing.Queue)
+        Finalize(self, FrameQueue._close_feeder, (self.buffer, self.buffer_cond), exitpriority=10)
+        Finalize(self.feeder, FrameQueue._join_feeder, (weakref.ref(self.feeder),), exitpriority=-5)
+
+    @staticmethod
+    def _feed(buffer, buffer_cond, writer, write_lock):
+        while True:
+            with buffer_cond:
+                while not buffer:
+                    buffer_cond.wait()
+                frames = list(buffer)
+                buffer.clear()
+
+            for frame in frames:
+                if frame is None:
+                    return
+                try:
+                    with write_lock:
+                        for part in frame:
+                            writer.send_bytes(part)
+                except OSError:
+                    return      # the reading end is closed, nothing can be delivered any more
+
+    @staticmethod
+    def _close_feeder(buffer, buffer_cond):
+        with buffer_cond:
+            buffer.append(None)
+            buffer_cond.notify()
+
+    @staticmethod
+    def _join_feeder(feeder_ref):
+        feeder = feeder_ref()
+        if feeder is not None:
+            feeder.join()
+
+    def get(self, block=True, timeout=None):
+        if block and timeout is None:
+            with self.read_lock:
+                frame = self._recv()
+        else:
+            deadline = time() + timeout if block else None
+            if not self.read_lock.acquire(block, timeout if block else None):
+                raise QueueEmpty
+            try:
+                if not self._reader.poll(max(deadline - time(), 0) if block else 0):
+                    raise QueueEmpty
+                frame = self._recv()
+            finally:
+                self.read_lock.release()
+
+        self.slots.release()
+        return frame
+
+    def _recv(self):
+        head = self._reader.recv_bytes()
+        if head[0] & FRAME_KIND != FRAME_BUFFERS:
+            return [head]
+        count = int.from_bytes(head[1:5], 'little')
+        return [head] + [self._reader.recv_bytes() for i in range(count)]
+
+    # frames put and not read yet, buffered ones included
+    def qsize(self):
+        return self.maxsize - self.slots.get_value()
+
+    def empty(self):
+        return not self._reader.poll()
+
+
+# Process communication via queues
+class ProcessCom(ThreadCom):
+    # ctx: multiprocessing context of the processes using the queue (default context when None)
+    # codec: pickle | pickle5 | marshal | Codec object, the encoded frames go through a FrameQueue,
+    #   None leaves the pickling to multiprocessing.Queue
+    # single_reader=True: only one process reads the queue (work out, a scheduled worker's own queue) so an
+    #   unbounded queue sends write_many as one MessageBatch, otherwise every message is sent on its own
+    #   and any reader can take it (a whole batch would go to the first process that reads)
+    def __init__(self, maxsize=0, overflow='block', put_timeout=None, ctx=None, codec=None, single_reader=False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception('overflow ['+str(overflow)+'] not found')
+
+        self.codec = get_codec(codec)
+        if self.codec is not None:
+            self.com = FrameQueue(maxsize, ctx)
+        else:
+            self.com = ProcessQueue(maxsize) if ctx is None else ctx.Queue(maxsize)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.wakeup = None
+        self.pending = deque()      # rest of the last batch received by this process
+        self.batching = single_reader and maxsize <= 0      # a batch would take one slot of maxsize
+        self.unpacked = None    # messages in batches after their first, not read yet
+        if self.batching:
+            self.unpacked = (multiprocessing if ctx is None else ctx).Value('q', 0)
+
+    def _encode(self, msg):
+        if self.codec is None:
+            return msg
+        if isinstance(msg, WakeSignal):
+            return WAKE_FRAME
+
+        batch = isinstance(msg, MessageBatch)
+        return self.codec.encode_frame(list(msg) if batch else msg, batch)
+
+    def _decode(self, msg):
+        if self.codec is None or msg is None:
+            return msg
+        return self.codec.decode_frame(msg)
+
+    def get_codec_stats(self):
+        if self.codec is None:
+            return None
+        return self.codec.get_stats()
+
+    def _read_raw(self, timeout=0):
+        if self.pending:
+            self._unpacked(-1)
+            return self.pending.popleft()
+
+        msg = self._decode(super()._read_raw(timeout))
+        if isinstance(msg, MessageBatch):
+            self.pending.extend(msg[1:])
+            msg = msg[0]
+
+        return msg
+
+    def read_many(self, max_count=None, timeout=0):
+        msg = self.read(timeout)
+        if msg is None:
+            return []
+
+        result = [msg]
+        while max_count is None or len(result) < max_count:
+            if self.pending:
+                # the rest of a batch with one update of the count
+                n = len(self.pending) if max_count is None else min(len(self.pending), max_count - len(result))
+                result.extend(self.pending.popleft() for i in range(n))
+                self._unpacked(-n)
+                continue
+
+            msg = self._read_raw()
+            if isinstance(msg, WakeSignal):
+                self.wake()     # pass it on to another reader
+                break
+            if msg is None:
+                break
+            result.append(msg)
+
+        return result
+
+    def _unpacked(self, n):
+        with self.unpacked.get_lock():
+            self.unpacked.value += n
+
+    def wake(self):
+        try:
+            self.com.put(self._encode(WakeSignal()), False)
+        except QueueFull:
+            pass    # the reader wakes up at its read timeout
+
+    # messages written and not read yet, a batch counts all of its messages
+    def size(self):
+        if self.unpacked is None:
+            return self.com.qsize()
+        return self.com.qsize() + self.unpacked.value
+
+    def is_empty(self):
+        return not self.pending and self.com.empty()
+
+    def write(self, msg, priority=None):
+        msg = self._encode(msg)
+        if self.maxsize <= 0 or self.overflow == 'block':
+            self.com.put(msg)
+        elif self.overflow == 'reject':
+            self.com.put(msg, False)    # raises QueueFull
+        elif self.overflow == 'timeout':
+            self.com.put(msg, True, self.put_timeout)
+        else:
+            return self._write_drop_oldest(msg)
+
+        return None
+
+    def _write_drop_oldest(self, msg):
+        dropped = []
+        while True:
+            try:
+                self.com.put(msg, False)
+                return dropped or None
+            except QueueFull:
+                pass
+
+            # the queue can be full while messages are still in the feeder thread, wait for them briefly
+            try:
+                dropped.append(self._decode(self.com.get(True, 0.01)))
+            except QueueEmpty:
+                continue
+
+    # one MessageBatch on a single reader queue, otherwise one message at a time so every reader gets work
+    #   on a bounded queue reject and timeout wait for room for the whole list first (nothing is written
+    #   on QueueFull as long as one process writes the queue, the manager for work queues)
+    def write_many(self, msgs, priority=None):
+        if not msgs:
+            return None
+
+        if self.batching:
+            self._unpacked(len(msgs) - 1)   # before the write so size() never counts less than is queued
+            return self.write(MessageBatch(msgs))
+
+        if self.maxsize > 0 and self.overflow in ('reject', 'timeout'):
+            self._wait_room(len(msgs))
+
+        dropped = []
+        for msg in msgs:
+            dropped.extend(self.write(msg) or ())
+        return dropped or None
+
+    # wait until n messages fit or raise QueueFull (see ThreadCom._make_room)
+    def _wait_room(self, n):
+        if n > self.maxsize:
+            raise QueueFull(f'batch of {n} is larger than maxsize {self.maxsize}')
+
+        deadline = None
+        while self.maxsize - self.com.qsize() < n:
+            if self.overflow == 'reject':
+                raise QueueFull('queue is full')
+            if deadline is None:
+                deadline = time() + self.put_timeout
+            if time() >= deadline:
+                raise QueueFull(f'queue still full after {self.put_timeout}s')
+            sleep(0.001)
+
+    # messages already in the pipe cannot be taken back, workers skip cancelled jobs instead
+    def remove(self, predicate):
+        return []
+
+    def waitable(self):
+        return self.com._reader
+
+    # the queue's own pipe is readable as soon as a message arrives (not selectable on Windows)
+    def fileno(self):
+        return self.com._reader.fileno()
+
+    def clear_wakeup(self):
+        pass
+
+    # the pipe stays readable until a message is taken, every reader can wait on it
+    def watch(self, waiter):
+        return self.waitable()
+
+    def unwatch(self, waiter):
+        pass
+
+
+class Priority:
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# Work queue with one lane per priority, read() always takes from the highest priority lane first
+#   lanes are ThreadCom or ProcessCom objects, lane 0 is the highest priority
+class PriorityCom:
+    def __init__(self, lanes, default_priority=Priority.NORMAL):
+        self.lanes = lanes
+        self.default_priority = min(default_priority, len(lanes) - 1)
+
+    def _lane(self, priority):
+        if priority is None:
+            priority = self.default_priority
+        return self.lanes[max(0, min(priority, len(self.lanes) - 1))]
+
+    def read(self, timeout=0):
+        msg = self._read_raw(timeout)
+        if isinstance(msg, WakeSignal):
+            return None
+        return msg
+
+    def _read_raw(self, timeout=0):
+        deadline = None
+        while True:
+            for lane in self.lanes:
+                msg = lane._read_raw()
+                if msg is not None:
+                    return msg
+
+            if timeout == 0:
+                return None
+
+            # wait until any lane gets a message
+            remaining = None
+            if timeout is not None:
+                if deadline is None:
+                    deadline = time() + timeout
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return None
+
+            wait_for_any(self.lanes, remaining)
+
+    def read_many(self, max_count=None, timeout=0):
+        msg = self.read(timeout)
+        if msg is None:
+            return []
+
+        result = [msg]
+        for lane in self.lanes:
+            if max_count is not None and len(result) >= max_count:
+                break
+            result.extend(lane.read_many(None if max_count is None else max_count - len(result)))
+        return result
+
+    def write(self, msg, priority=None):
+        return self._lane(priority).write(msg)
+
+    def write_many(self, msgs, priority=None):
+        return self._lane(priority).write_many(msgs)
+
+    def remove(self, predicate):
+        removed = []
+        for lane in self.lanes:
+            removed.extend(lane.remove(predicate))
+        return removed
+
+    def wake(self):
+        self.lanes[0].wake()
+
+    def size(self):
+        return sum(a.size() for a in self.lanes)
+
+    def is_empty(self):
+        return all(a.is_empty() for a in self.lanes)
+
+    # the default lane is the one add_job normally writes to
+    def is_full(self):
+        return self._lane(None).is_full()
+
+
+# Per-worker work queue handed to a scheduled worker as its 'work_in'
+#   read() takes from the worker's own queue first, then steals from the busiest peer
+class ScheduledCom:
+    def __init__(self, own_com, peers=None, stealing=False):
+        self.own = own_com
+        self.peers = peers if peers is not None else []    # list shared by every worker of the group
+        self.stealing = stealing
+        self.assigned = 0       # jobs routed here and not answered, counted by ProcessManagement (see _route)
+
+    def read(self, timeout=0):
+        msg = self._read_raw(timeout)
+        if isinstance(msg, WakeSignal):
+            return None
+        return msg
+
+    def _read_raw(self, timeout=0):
+        msg = self.own._read_raw()
+        if msg is None and self.stealing:
+            msg = self._steal()
+        if msg is None and timeout != 0:
+            msg = self.own._read_raw(timeout)
+        return msg
+
+    def read_many(self, max_count=None, timeout=0):
+        msg = self.read(timeout)
+        if msg is None:
+            return []
+
+        result = [msg]
+        if max_count is None or max_count > 1:
+            result.extend(self.own.read_many(None if max_count is None else max_count - 1))
+        return result
+
+    def _steal(self):
+        busiest = sorted(self.peers, key=lambda a: a.own.size(), reverse=True)
+        for peer in busiest:
+            if peer is self:
+                continue
+            msg = peer.own._read_raw()
+            if isinstance(msg, WakeSignal):
+                peer.own.wake()     # the signal belongs to the peer
+                continue
+            if msg is not None:
+                return msg
+        return None
+
+    def write(self, msg, priority=None):
+        return self.own.write(msg, priority)
+
+    def write_many(self, msgs, priority=None):
+        return self.own.write_many(msgs, priority)
+
+    def remove(self, predicate):
+        return self.own.remove(predicate)
+
+    def wake(self):
+        self.own.wake()
+
+    def size(self):
+        return self.own.size()
+
+    def is_empty(self):
+        return self.own.is_empty()
+
+    # jobs queued or running on the worker, the manager's count works for process workers too as it does not
+    #   depend on the worker, queued messages without a msg_id are only seen in the queue's size
+    def outstanding(self):
+        return max(self.assigned, self.own.size())
+
+
+# Block until one of the queues has something to read or timeout seconds passed (None waits forever),
+#   one wait on every queue so an idle worker uses no CPU, returns False on timeout
+#   thread queues signal the waiting thread's own Waiter, so several workers can wait on one shared queue
+#   a message can be taken by another reader first, read without blocking after the wait
+def wait_for_any(coms, timeout=None):
+    leaves = []
+    for com in coms:
+        leaves.extend(wait_leaves(com))
+
+    waiter = thread_waiter()
+    objects = []
+    try:
+        for com in leaves:
+            obj = com.watch(waiter)
+            if all(obj is not a for a in objects):
+                objects.append(obj)
+        if any(not a.is_empty() for a in leaves):
+            return True     # written before the waiter was registered
+        return bool(wait_objects(objects, timeout))
+    finally:
+        for com in leaves:
+            com.unwatch(waiter)
+        waiter.clear()
+
+
+# the queues with a waitable behind PriorityCom lanes and ScheduledCom
+def wait_leaves(com):
+    if isinstance(com, PriorityCom):
+        return [a for lane in com.lanes for a in wait_leaves(lane)]
+    if isinstance(com, ScheduledCom):
+        return wait_leaves(com.own)
+    return [com]
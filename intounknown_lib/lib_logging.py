@@ -0,0 +1,155 @@
+# Log sink behind printLine, shared by ProcessManagement and its process workers
+from threading import Thread
+from threading import RLock as ThreadLock
+from threading import current_thread
+from queue import Queue as ThreadQueue
+from queue import Empty as QueueEmpty
+
+import multiprocessing
+from multiprocessing.util import register_after_fork
+from time import time
+import os
+import sys
+import atexit
+
+
+# log levels, printLine logs at INFO
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+
+# Queue backed log sink, callers only format and enqueue a record and one writer thread writes them in batches
+#   log_sink.level = DEBUG      hot paths check `if log_sink.level <= DEBUG:` before building the message
+#   log_sink.open(path)         append to a file instead of stdout
+#   log_sink.fmt = '{time:.3f} {level} {pid} {thread} {message}'     default '{message}' (plain print output)
+#   log_sink.flush()            wait until everything logged so far is written (also runs at exit)
+# process workers started by ProcessManagement forward their records to the parent's sink
+#   multiprocessing children skip atexit, a process that logs itself (remote_worker) calls flush before it returns
+class LogSink:
+    def __init__(self, level=INFO, fmt='{message}', batch_size=256):
+        self.level = level
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.stream = None      # None writes to sys.stdout
+        self.records = ThreadQueue()
+        self.writer = None
+        self.process_records = {}     # {start method: process queue} child processes write to, relayed into records
+        self.forward_to = None      # set in a child process, the parent's process_records
+        self.start_lock = ThreadLock()
+        register_after_fork(self, LogSink._after_fork)
+
+    def open(self, path):
+        self.flush()
+        self.stream = open(path, 'a')
+
+    # file: write this record to another stream (sys.stderr, an open file) in order with the rest
+    def write(self, level, *args, sep=' ', end='\n', file=None):
+        if level < self.level:
+            return
+
+        sep = ' ' if sep is None else sep
+        end = '\n' if end is None else end
+        if file is not None and self.forward_to is not None:
+            print(*args, sep=sep, end=end, file=file)     # a stream cannot go to the parent
+            return
+
+        record = (time(), level, os.getpid(), current_thread().name, sep.join(str(a) for a in args), end, file)
+        if self.forward_to is not None:
+            self.forward_to.put(record)
+            return
+
+        if self.writer is None:
+            self._start()
+        self.records.put(record)
+
+    def flush(self):
+        if self.writer is not None:
+            self.records.join()
+
+    def _start(self):
+        with self.start_lock:
+            if self.writer is not None:
+                return
+            self.writer = Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+            atexit.register(self.flush)
+
+    def _format(self, record):
+        t, level, pid, thread, message, end, file = record
+        if self.fmt == '{message}':
+            return message + end
+        return self.fmt.format(time=t, level=LEVEL_NAMES.get(level, level), pid=pid, thread=thread, message=message) + end
+
+    def _write_loop(self):
+        while True:
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except QueueEmpty:
+                    break
+
+            try:
+                # one write per run of records going to the same stream
+                default = self.stream if self.stream is not None else sys.stdout
+                runs = []
+                for a in batch:
+                    stream = a[6] if a[6] is not None else default
+                    if runs and runs[-1][0] is stream:
+                        runs[-1][1].append(self._format(a))
+                    else:
+                        runs.append((stream, [self._format(a)]))
+                for stream, lines in runs:
+                    stream.write(''.join(lines))
+                    stream.flush()
+            except Exception:
+                pass    # nowhere left to report it
+            finally:
+                for a in batch:
+                    self.records.task_done()
+
+    # parent side: queue handed to process workers, records arrive in this process's writer
+    #   ctx: the workers' multiprocessing context, queues can only be shared within one context
+    def get_process_queue(self, ctx=None):
+        ctx = ctx or multiprocessing.get_context()
+        with self.start_lock:
+            process_queue = self.process_records.get(ctx.get_start_method(), None)
+            if process_queue is None:
+                process_queue = ctx.Queue()
+                self.process_records[ctx.get_start_method()] = process_queue
+                Thread(target=self._relay_loop, args=(process_queue,), daemon=True).start()
+            return process_queue
+
+    def _relay_loop(self, process_queue):
+        while True:
+            record = process_queue.get()
+            if self.writer is None:
+                self._start()
+            self.records.put(record)
+
+    # child side: send records to the parent instead of writing them here
+    def forward(self, process_queue, level):
+        self.level = level
+        self.forward_to = process_queue
+        self._after_fork()
+
+    # the parent's writer and relay threads did not survive the fork, the child starts its own
+    def _after_fork(self):
+        self.records = ThreadQueue()
+        self.writer = None
+        self.process_records = {}
+        self.start_lock = ThreadLock()
+
+
+log_sink = LogSink()
+
+
+# print replacement, returns as soon as the line is queued
+#   file=stream writes the line there through the sink, flush=True waits until it is written
+def printLine(*args, sep=' ', end='\n', file=None, flush=False, level=INFO):
+    log_sink.write(level, *args, sep=sep, end=end, file=file)
+    if flush:
+        log_sink.flush()
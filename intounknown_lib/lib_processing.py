@@ -1,80 +1,518 @@
 # Import Threading Objects
 from threading import Thread
 from threading import RLock as ThreadLock
+from threading import Timer
 from queue import Queue as ThreadQueue
 from queue import Empty as QueueEmpty
+from queue import Full as QueueFull
+from collections import deque
+from collections import OrderedDict
 
 # Import Multiprocessing Objects
-from multiprocessing import Process
+import multiprocessing
 from multiprocessing import RLock as ProcessLock
 from multiprocessing import Queue as ProcessQueue
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Listener
+from multiprocessing.connection import deliver_challenge, answer_challenge
+
+from concurrent.futures import Executor, Future, BrokenExecutor
+from itertools import count
+import pickle
+import hashlib
+import json
+from types import GeneratorType
 
 from time import time, sleep
 from random import randint
-from uuid import uuid4
+from bisect import bisect
+import heapq
+from zlib import crc32
+import os
+import platform
+import atexit
+
+from intounknown_lib.lib_logging import DEBUG, WARNING, log_sink, printLine
+from intounknown_lib.lib_coms import WakeSignal, ThreadCom, SharedPayload, find_payloads, get_codec, ProcessCom
+from intounknown_lib.lib_coms import PriorityCom, ScheduledCom, wait_for_any, wait_leaves
+from intounknown_lib.lib_ring import RingCom, LOCAL_FENCE
+from intounknown_lib.lib_transport import SocketConnection, RemoteWorker, abort_connection
+
+
+# handed to a BackgroundManager callback in place of a response when the job outlived job_ttl
+class JobTimeout(Exception):
+    def __init__(self, msg_id, age):
+        super().__init__(f'job {msg_id} got no response in {age:.1f} seconds')
+        self.msg_id = msg_id
+        self.age = age
+
 
 class BackgroundManager:
-    def __init__(self, process_manager, run_after_cb):
-        self.queue = []     # track what jobs are currently being processed
-        self.store = MessageStore()
+    # add_reader_cb=None      poll the work out queue every 100 milliseconds
+    # add_reader_cb=func      wakeup mode, func(fd, callback) must call callback when fd is readable
+    #   Tk:      add_reader_cb=lambda fd, cb: app.tk.createfilehandler(fd, tkinter.READABLE, lambda f, m: cb())
+    #   Tornado: add_reader_cb=loop.add_reader   (intounknown_lib.ioloop_wrapper.Loop)
+    # batch_writes=True       add_job buffers jobs and writes them as one batch with run_after(0, ...)
+    # on_dropped=func         func(msg_id, msg, reason) for jobs that will not get a response
+    #                         reason = overflow (a bounded work queue discarded it or a batch_writes flush
+    #                         could not write it) | expired (a worker read it after its deadline)
+    # on_error=func           func(msg_id, msg, error) when a handler raised (start_handler_worker), printed if not set
+    #   both run once more for each add_job coalesced into the job (see coalesce)
+    # metrics=JobMetrics()    time every job (queue wait, run, delivery) and count outcomes, see get_metrics
+    #   metrics_file=path     also write get_metrics() as json every metrics_interval milliseconds
+    # job_ttl=seconds         give up on jobs without a response after this long (a worker died or lost them),
+    #                         checked every sweep_interval milliseconds, the callback gets a JobTimeout
+    # coalesce=True           an add_job identical to one still running (same job_key) does not go to a worker,
+    #                         its callback gets the running job's response as well (see add_job)
+    # cache_size=n            keep the last n responses by job_key, a repeated add_job is answered from the cache
+    #   cache_ttl=seconds     without a worker, responses older than cache_ttl are not used (None: until evicted)
+    # hedge_percentile=0.95   a job still running after the 95th percentile of recent job latencies is written
+    #                         a second time so another worker can run it, the first response wins (the other copy
+    #                         is cancelled if it has not started, its response is ignored otherwise)
+    #   hedge_after=seconds   fixed threshold instead of the percentile
+    #   hedge_min_samples     completed jobs needed before the percentile is used
+    #   hedge_budget=0.05     at most this share of the jobs added so far is hedged
+    #   stream jobs are never hedged, handlers of hedged jobs should be safe to run twice
+    # watch_interval          milliseconds between checks for add_job(timeout=..) and hedging
+    def __init__(self, process_manager, run_after_cb, add_reader_cb=None, remove_reader_cb=None, batch_writes=False,
+            on_dropped=None, on_error=None, metrics=None, metrics_file=None, metrics_interval=10000,
+            job_ttl=None, sweep_interval=1000, coalesce=False, cache_size=0, cache_ttl=None,
+            hedge_percentile=None, hedge_after=None, hedge_min_samples=20, hedge_budget=0.05, watch_interval=20):
+        self.queue = {}     # track what jobs are currently being processed {msg_id: None} (ordered, O(1) removal)
+        self.store = MessageStore(job_ttl)
+        self.sweep_interval = sweep_interval
         self.process_manager = process_manager
         self.run_after = run_after_cb
         self.shutdown_on = False
 
+        self.batch_writes = batch_writes
+        self.outgoing = []      # [(worker_msg, key, priority)] waiting for _flush_jobs
+        self.flush_scheduled = False
+        self.on_dropped = on_dropped
+        self.on_error = on_error
+
+        self.metrics = JobMetrics() if metrics is True else metrics
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+
+        self.coalesce = coalesce
+        self.running = {}       # {job_key: msg_id} of coalescing jobs without a response yet
+        self.cache = ResultCache(cache_size, cache_ttl) if cache_size > 0 else None
+
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget = hedge_budget
+        self.hedging = hedge_percentile is not None or hedge_after is not None
+        self.latencies = RollingHistogram() if hedge_percentile is not None else None
+        self.hedge_threshold = None
+        self.hedge_threshold_at = 0.0
+        self.hedge_stats = {'jobs': 0, 'hedged': 0, 'hedge_won': 0}
+        self.watch_interval = watch_interval
+        self.watched = []       # heap of (time, msg_id, 'timeout' | 'hedge')
+        self.watch_scheduled = False
+
         worker_id = self.process_manager.get_random_worker()
         self.queue_access = worker_id
 
         self._notify_queue_callback = None
-        self._listen()
+        self.notify_delta = False
+        self.notify_dirty = False
+        self.notify_added = {}      # {msg_id: msg} since the last delta notification
+        self.notify_done = []       # msg_ids completed since the last delta notification
+
+        self.wakeup_fd = None
+        self.remove_reader = remove_reader_cb
+        if add_reader_cb is not None:
+            # workers signal the file descriptor when a response lands on work out
+            self.wakeup_fd = self.process_manager.get_work_out_fileno(self.queue_access)
+            add_reader_cb(self.wakeup_fd, self._on_wakeup)
+            self._deliver_responses()   # pick up anything written before the reader was registered
+            if self.process_manager.supervise:
+                # a dead worker sends nothing, look for one without waiting for a response
+                self.run_after(int(self.process_manager.heartbeat_interval * 1000), self._check_workers)
+        else:
+            self._listen()
+
+        if self.metrics is not None and self.metrics_file is not None:
+            self.run_after(self.metrics_interval, self._dump_metrics)
+
+        if job_ttl is not None:
+            self.run_after(self.sweep_interval, self._sweep_jobs)
 
     def shutdown(self):
         self.shutdown_on = True
 
-    def add_job(self, msg, callback):
+        if self.metrics is not None and self.metrics_file is not None:
+            self.metrics.dump(self.metrics_file)
+
+        # jobs that never completed still own shared memory payloads
+        for msg_id in self.store.get_ids():
+            self._release_payloads(msg_id, self.store.get(msg_id, delete=True))
+
+        if self.wakeup_fd is not None and self.remove_reader is not None:
+            self.remove_reader(self.wakeup_fd)
+            self.process_manager.close_work_out_fileno(self.queue_access)
+            self.wakeup_fd = None
+
+    # key: optional routing key, jobs with the same key go to the same worker (consistent_hash scheduler)
+    # priority: Priority.HIGH | NORMAL | LOW, needs ProcessManagement(priority_lanes=...)
+    # deadline: time() after which workers skip the job and on_dropped gets reason 'expired'
+    # msg_type: handler to run in start_handler_worker (or a 'type' key in a dict msg)
+    # stream: the handler yields chunks and callback(chunk, seq, end) runs once per chunk as it arrives,
+    #   then callback(None, seq, True) at the end of the stream (a plain return value is one final chunk)
+    #   without stream the chunks of a generator handler are collected and callback gets the list
+    # timeout: seconds until the job is given up, callback gets a JobTimeout (like job_ttl but per job)
+    # job_key: identifies identical jobs for coalesce and the result cache, by default a hash of msg and msg_type
+    #   (stream jobs, jobs with shared memory payloads and messages that do not pickle are never coalesced)
+    #   a coalesced job returns the msg_id of the running job (cancel cancels it for every caller),
+    #   a job answered from the cache returns None and callback runs with run_after(0, ...)
+    #   raises QueueFull when a bounded work queue rejects the job (overflow reject or timeout)
+    def add_job(self, msg, callback, key=None, priority=None, deadline=None, msg_type=None, stream=False,
+            job_key=None, timeout=None):
+        if (self.coalesce or self.cache is not None) and not stream:
+            if job_key is None and not find_payloads(msg):
+                job_key = make_job_key(msg, msg_type)
+            if job_key is not None:
+                shared = self._join_job(job_key, msg, callback)
+                if shared is not False:
+                    return shared
+        else:
+            job_key = None
+
+        msg_id, worker_msg = self._register_job(msg, callback, deadline, msg_type, stream, timeout, priority)
+        if job_key is not None:
+            self.store.get(msg_id).job_key = job_key
+            if self.coalesce:
+                self.running[job_key] = msg_id
+
+        if self.batch_writes:
+            self.outgoing.append((worker_msg, key, priority))
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                self.run_after(0, self._flush_jobs)    # write everything added during this event in one batch
+        else:
+            try:
+                dropped = self.process_manager.write_work(self.queue_access, worker_msg, key=key, priority=priority)
+            except QueueFull:
+                self._forget_job(msg_id)
+                raise
+            self._drop_jobs(dropped)
+
+        # there is no polling loop in wakeup mode so notify right away
+        if self.wakeup_fd is not None:
+            self._notify_subscriber()
+
+        return msg_id
+
+    # answer add_job from the cache or attach it to a running identical job
+    #   returns None (cached), the running msg_id or False when the job has to run
+    def _join_job(self, job_key, msg, callback):
+        if self.cache is not None:
+            found, res_msg = self.cache.get(job_key)
+            if found:
+                if self.metrics is not None:
+                    self.metrics.count('cached')
+                self.run_after(0, lambda: callback(res_msg))
+                return None
+
+        if self.coalesce:
+            msg_id = self.running.get(job_key, None)
+            stored_msg = self.store.get(msg_id) if msg_id is not None else None
+            if stored_msg is not None:
+                if stored_msg.waiters is None:
+                    stored_msg.waiters = []
+                stored_msg.waiters.append(callback)
+                if self.metrics is not None:
+                    self.metrics.count('coalesced')
+                return msg_id
+
+        return False
+
+    # drop cached responses, one job_key or all of them
+    def invalidate_cache(self, job_key=None):
+        if self.cache is None:
+            return
+        if job_key is None:
+            self.cache.clear()
+        else:
+            self.cache.delete(job_key)
+
+    # add several jobs with one queue transfer
+    #   jobs = [(msg, callback), (msg, callback, key), ...]
+    def add_jobs(self, jobs, priority=None, deadline=None, msg_type=None, stream=False, timeout=None):
+        msg_ids = []
+        worker_msgs = []
+        keys = []
+        for job in jobs:
+            msg_id, worker_msg = self._register_job(job[0], job[1], deadline, msg_type, stream, timeout, priority)
+            msg_ids.append(msg_id)
+            worker_msgs.append(worker_msg)
+            keys.append(job[2] if len(job) > 2 else None)
+
+        try:
+            dropped = self.process_manager.write_work_many(self.queue_access, worker_msgs, keys=keys, priority=priority)
+        except QueueFull:
+            for msg_id in msg_ids:
+                self._forget_job(msg_id)
+            raise
+        self._drop_jobs(dropped)
+
+        if self.wakeup_fd is not None:
+            self._notify_subscriber()
+
+        return msg_ids
+
+    # cancel a job that has not completed, its callback will not be called
+    #   a job that a worker already started runs to the end but its response is ignored
+    #   returns False if the job is unknown or already done
+    def cancel(self, msg_id):
+        if self.store.get(msg_id) is None:
+            return False
+
+        outgoing = [a for a in self.outgoing if a[0]['msg_id'] != msg_id]
+        if len(outgoing) != len(self.outgoing):
+            self.outgoing = outgoing    # not written yet
+        else:
+            self.process_manager.cancel_work(self.queue_access, [msg_id])
+
+        self._forget_job(msg_id)
+
+        if self.wakeup_fd is not None:
+            self._notify_subscriber()
+
+        if self.metrics is not None:
+            self.metrics.count('cancelled')
+
+        return True
+
+    # is the work queue at its maxsize (add_job would block, raise or drop)
+    def is_saturated(self):
+        return self.process_manager.is_work_in_full(self.queue_access)
+
+    # remove a job that will not get a response, returns its stored message (None if unknown)
+    def _forget_job(self, msg_id):
+        stored_msg = self.store.get(msg_id, delete=True)
+        if stored_msg is None:
+            return None
+
+        self._end_coalescing(msg_id, stored_msg)
+        self._job_done(msg_id)
+        self._release_payloads(msg_id, stored_msg)
+        return stored_msg
+
+    # forget jobs a bounded queue discarded and tell the on_dropped subscriber
+    def _drop_jobs(self, worker_msgs, reason='overflow'):
+        if not worker_msgs:
+            return
+
+        for worker_msg in worker_msgs:
+            msg_id = worker_msg.get('msg_id', None) if isinstance(worker_msg, dict) else None
+            stored_msg = self._forget_job(msg_id)
+            if stored_msg is not None and self.metrics is not None:
+                self.metrics.count(reason)
+            if stored_msg is not None and self.on_dropped is not None:
+                for i in range(stored_msg.copies()):
+                    self.on_dropped(msg_id, stored_msg.msg, reason)
+
+    def _register_job(self, msg, callback, deadline=None, msg_type=None, stream=False, timeout=None, priority=None):
         # store callback by unique request id
-        msg_id = self.store.set({
-            'msg': msg,     # store message for debugging
-            'callback': callback,   # callback to call with response
-        })
+        stored = JobRecord(msg, callback, find_payloads(msg), stream)
+        msg_id = self.store.set(stored)
 
-        self.queue.append(msg_id)       # track that we are processing a new job
+        self.queue[msg_id] = None       # track that we are processing a new job
+        if self._notify_queue_callback is not None:
+            self.notify_dirty = True
+            if self.notify_delta:
+                self.notify_added[msg_id] = msg
 
         worker_msg = {
             'msg_id': msg_id,
             'msg': msg,
         }
+        if deadline is not None:
+            worker_msg['deadline'] = deadline
+        if msg_type is not None:
+            worker_msg['type'] = msg_type
+
+        if self.metrics is not None:
+            # workers answer timed jobs with their dequeue, start and finish times
+            worker_msg['enqueued'] = time()
+            stored.enqueued = worker_msg['enqueued']
+            stored.msg_type = job_type(worker_msg)
+            self.metrics.count('enqueued')
+
+        if timeout is not None:
+            self._watch(stored.created + timeout, msg_id, 'timeout')
+        if self.hedging and not stream:
+            self.hedge_stats['jobs'] += 1
+            threshold = self._hedge_threshold()
+            if threshold is not None:
+                stored.hedge = (worker_msg, priority)
+                self._watch(stored.created + threshold, msg_id, 'hedge')
+
+        return msg_id, worker_msg
+
+    # seconds after which a job is hedged, None while there are too few samples
+    def _hedge_threshold(self):
+        if self.hedge_after is not None:
+            return self.hedge_after
+
+        now = time()
+        if now - self.hedge_threshold_at >= 1.0:     # the window moves slowly, recompute once a second
+            self.hedge_threshold_at = now
+            value, n = self.latencies.percentile(self.hedge_percentile, now)
+            self.hedge_threshold = value if n >= self.hedge_min_samples else None
+        return self.hedge_threshold
+
+    def _watch(self, at, msg_id, kind):
+        heapq.heappush(self.watched, (at, msg_id, kind))
+        if not self.watch_scheduled:
+            self.watch_scheduled = True
+            self.run_after(self.watch_interval, self._watch_jobs)
+
+    # time out and hedge the jobs that are due
+    def _watch_jobs(self):
+        self.watch_scheduled = False
+        if self.shutdown_on:
+            return
 
-        self.process_manager.write_work(self.queue_access, worker_msg)
+        now = time()
+        timed_out = []
+        while self.watched and self.watched[0][0] <= now:
+            at, msg_id, kind = heapq.heappop(self.watched)
+            stored_msg = self.store.get(msg_id)
+            if stored_msg is None:
+                continue    # answered, cancelled or dropped
+
+            if kind == 'timeout':
+                self.store.delete(msg_id)
+                timed_out.append((msg_id, stored_msg))
+            elif stored_msg.hedge is not None and \
+                    self.hedge_stats['hedged'] < self.hedge_budget * self.hedge_stats['jobs']:
+                worker_msg, priority = stored_msg.hedge
+                stored_msg.hedge = None
+                try:
+                    # a scheduler picks a worker other than the busy one
+                    dropped = self.process_manager.write_work(self.queue_access, worker_msg, priority=priority,
+                        elsewhere=True)
+                except QueueFull:
+                    continue    # no room for a copy, the first one keeps running
+                stored_msg.hedged = now
+                self.hedge_stats['hedged'] += 1
+                if self.metrics is not None:
+                    self.metrics.count('hedged')
+                self._drop_jobs(dropped)
+
+        if timed_out:
+            self._expire_jobs(timed_out)
+
+        if self.watched:
+            self.watch_scheduled = True
+            self.run_after(self.watch_interval, self._watch_jobs)
+
+    # counters of hedged execution, hedge_won = hedged jobs answered after the second copy was written
+    def get_hedge_stats(self):
+        stats = dict(self.hedge_stats)
+        stats['threshold'] = self._hedge_threshold() if self.hedging else None
+        return stats
+
+    def _flush_jobs(self):
+        self.flush_scheduled = False
+        if not self.outgoing:
+            return
 
-        return msg_id
+        outgoing = self.outgoing
+        self.outgoing = []
 
-#    def remove_job(self, msg_id):
-#        self.queue.remove(msg_id)
-#        self.store.delete(msg_id)
+        # one batch per priority lane
+        by_priority = {}
+        for worker_msg, key, priority in outgoing:
+            by_priority.setdefault(priority, []).append((worker_msg, key))
+
+        for priority, jobs in by_priority.items():
+            worker_msgs = [a[0] for a in jobs]
+            try:
+                dropped = self.process_manager.write_work_many(self.queue_access,
+                    worker_msgs, keys=[a[1] for a in jobs], priority=priority)
+            except QueueFull:
+                dropped = worker_msgs   # add_job already returned, report the jobs as dropped
+            self._drop_jobs(dropped)
 
     def get_queue_size(self):
         return len(self.queue)      # get queue size
 
+    # JobMetrics.snapshot() or None without metrics
+    def get_metrics(self):
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
 
-    def set_notify_subscriber(self, cb):
+    def _dump_metrics(self):
+        if self.shutdown_on:
+            return
+
+        self.metrics.dump(self.metrics_file)
+        self.run_after(self.metrics_interval, self._dump_metrics)
+
+
+    # cb(messages) with every pending message when the pending jobs change
+    # delta=True: cb(added, completed) with only the changes, added = [(msg_id, msg)] and completed = [msg_id]
+    #   (the first call lists the jobs already pending as added)
+    def set_notify_subscriber(self, cb, delta=False):
         self._notify_queue_callback = cb
-        self.cached_notify_msg = None
+        self.notify_delta = delta
+        self.notify_dirty = True
+        self.notify_added = {}
+        self.notify_done = []
+        if delta:
+            for msg_id in self.queue:
+                self.notify_added[msg_id] = self.store.get(msg_id).msg
+
+    # identical jobs added from now on run again
+    def _end_coalescing(self, msg_id, stored_msg):
+        if stored_msg.job_key is not None and self.running.get(stored_msg.job_key, None) == msg_id:
+            del self.running[stored_msg.job_key]
+
+    # stop tracking a job that finished, was dropped or timed out
+    def _job_done(self, msg_id):
+        if msg_id not in self.queue:
+            return
+        del self.queue[msg_id]
+
+        if self._notify_queue_callback is None:
+            return
+
+        self.notify_dirty = True
+        if self.notify_delta:
+            if msg_id in self.notify_added:
+                del self.notify_added[msg_id]   # came and went between notifications
+            else:
+                self.notify_done.append(msg_id)
 
 
     def _notify_subscriber(self):
         # check if a callback is set, if not return
-        if self._notify_queue_callback is None:
+        if self._notify_queue_callback is None or not self.notify_dirty:
+            return
+        self.notify_dirty = False
+
+        if self.notify_delta:
+            added = list(self.notify_added.items())
+            completed = self.notify_done
+            self.notify_added = {}
+            self.notify_done = []
+            if added or completed:
+                self._notify_queue_callback(added, completed)
             return
 
         result = []
         for msg_id in self.queue:
             req_msg = self.store.get(msg_id)    # for testing this is a string
-            raw_msg = req_msg.get('msg')
+            raw_msg = req_msg.msg
             result.append(raw_msg)
 
-        if self.cached_notify_msg != result:
-            self.cached_notify_msg = result
-            self._notify_queue_callback(result)
+        self._notify_queue_callback(result)
 
 
     def _listen(self):
@@ -87,7 +525,23 @@ class BackgroundManager:
             printLine('BackgroundManager: shutting down')
             return
 
-        messages = self.process_manager.slurp_work_out(self.queue_access)    # will receive at least one message [None]
+        self._deliver_responses()
+
+        self.run_after(100, self._listen)   # rerun after 100 milliseconds
+
+    # called by the event loop when the work out queue's file descriptor is readable
+    def _on_wakeup(self):
+        if self.shutdown_on:
+            return
+
+        # clear the signal before reading so a response written after the read signals again
+        self.process_manager.clear_work_out_wakeup(self.queue_access)
+        self._deliver_responses()
+        self._notify_subscriber()
+
+    def _deliver_responses(self):
+        # payloads are released here once the callback returned
+        messages = self.process_manager.slurp_work_out(self.queue_access, release_payloads=False)
         # Expect message in this format:
         # {'msg_id' : '', 'msg' : ''}
 
@@ -97,27 +551,252 @@ class BackgroundManager:
             if res_msg is not None:
                 #printLine('_listen.res_msg', res_msg)
                 msg_id = res_msg.get('msg_id', None)    # get message id
+                expired = res_msg.get('expired', False)     # worker skipped the job after its deadline
+                error = res_msg.get('error', None)      # handler raised
+                seq = res_msg.get('seq', None)      # chunk number of a streamed response
+                end = res_msg.get('end', False)     # last message of a stream (carries no chunk)
+                times = res_msg.get('times', None)      # worker timestamps of a timed job
                 res_msg = res_msg.get('msg', None)      # get response message
 
                 # check that a message id was returned
                 if msg_id is None:
                     continue
 
+                if expired:
+                    self._drop_jobs([{'msg_id': msg_id}], 'expired')
+                    continue
+
+                if error is not None:
+                    stored_msg = self._forget_job(msg_id)
+                    if stored_msg is None:
+                        continue
+                    if self.metrics is not None:
+                        self._record_job(stored_msg, times, time(), None, failed=True)
+                    if self.on_error is not None:
+                        for i in range(stored_msg.copies()):
+                            self.on_error(msg_id, stored_msg.msg, error)
+                    else:
+                        printLine('BackgroundManager: job', msg_id, 'failed:', error, level=WARNING)
+                    continue
+
+                if seq is not None and not end:
+                    self._deliver_chunk(msg_id, seq, res_msg)
+                    continue
+
                 msg = self.store.get(msg_id, delete=True)   # get callback from store and auto remove message from store
-                cb = msg['callback']    # get the callback
-                cb(res_msg)     # call the callback with the response message
+                if msg is None:
+                    continue    # job was forgotten (dropped or rejected after the worker got it)
+                self._end_coalescing(msg_id, msg)
+                if self.hedging:
+                    self._hedge_done(msg_id, msg)
+
+                cb = msg.callback    # get the callback
+                delivered = time()
+                try:
+                    if msg.stream:
+                        cb(res_msg, seq or 0, True)
+                    else:
+                        if end:
+                            res_msg = msg.chunks or []      # streamed to a plain job, hand over everything at once
+                        if self.cache is not None and msg.job_key is not None:
+                            self.cache.set(msg.job_key, res_msg)
+                        cb(res_msg)     # call the callback with the response message
+                        for waiter in msg.waiters or ():
+                            waiter(res_msg)     # coalesced copies of the job
+                finally:
+                    # payloads only live until the callback returns (copy with bytes(payload.view()) to keep)
+                    self._release_payloads(msg_id, msg)
+                    for payload in find_payloads(res_msg):
+                        payload.unlink()
+
+                if self.metrics is not None:
+                    self._record_job(msg, times, delivered, time())
+
+                self._job_done(msg_id)   # remove it from the queue
+
+    # learn job latencies for the hedge threshold, and stop the copy of a hedged job that lost
+    def _hedge_done(self, msg_id, stored_msg):
+        if self.latencies is not None and stored_msg.hedged is None:
+            self.latencies.record(time() - stored_msg.created)
+        if stored_msg.hedged is not None:
+            self.hedge_stats['hedge_won'] += 1
+            self.process_manager.cancel_work(self.queue_access, [msg_id])
+
+    def _check_workers(self):
+        if self.shutdown_on:
+            return
 
-                self.queue.remove(msg_id)   # remove it from the queue
+        self.process_manager.check_workers()
+        self.run_after(int(self.process_manager.heartbeat_interval * 1000), self._check_workers)
 
-        self.run_after(100, self._listen)   # rerun after 100 milliseconds
+    def _record_job(self, stored_msg, times, delivered, callback_done, failed=False):
+        times = dict(times or {})
+        times['enqueued'] = stored_msg.enqueued
+        times['delivered'] = delivered
+        times['callback_done'] = callback_done
+        self.metrics.record(stored_msg.msg_type, times.pop('worker', None), times, failed)
+
+    # time out jobs older than job_ttl, a late response is ignored like any unknown msg_id
+    def _sweep_jobs(self):
+        if self.shutdown_on:
+            return
+
+        expired = self.store.sweep()
+        if expired:
+            self._expire_jobs(expired)
+
+        self.run_after(self.sweep_interval, self._sweep_jobs)
+
+    # give up on jobs already taken out of the store, [(msg_id, record)], callbacks get a JobTimeout
+    def _expire_jobs(self, expired):
+        msg_ids = set(a[0] for a in expired)
+        for msg_id in msg_ids:
+            self._job_done(msg_id)
+        self.outgoing = [a for a in self.outgoing if a[0]['msg_id'] not in msg_ids]
+        self.process_manager.cancel_work(self.queue_access, list(msg_ids))
+
+        for msg_id, msg in expired:
+            self._end_coalescing(msg_id, msg)
+            self._release_payloads(msg_id, msg)
+            if self.metrics is not None:
+                self.metrics.count('timeout')
+
+            timeout = JobTimeout(msg_id, time() - msg.created)
+            if msg.stream:
+                msg.callback(timeout, None, True)
+            else:
+                msg.callback(timeout)
+                for waiter in msg.waiters or ():
+                    waiter(timeout)
+
+        if self.wakeup_fd is not None:
+            self._notify_subscriber()
+
+    # one chunk of a streamed response, the job stays in the store until the end of the stream
+    def _deliver_chunk(self, msg_id, seq, chunk):
+        msg = self.store.get(msg_id)
+        if msg is None:
+            for payload in find_payloads(chunk):
+                payload.unlink()
+            return
+
+        if not msg.stream:
+            if msg.chunks is None:
+                msg.chunks = []
+            msg.chunks.append(chunk)
+            return
+
+        try:
+            msg.callback(chunk, seq, False)
+        finally:
+            for payload in find_payloads(chunk):
+                payload.unlink()
+
+    def _release_payloads(self, msg_id, stored_msg):
+        self.process_manager.release_job_payloads(msg_id)
+        if stored_msg is None:
+            return
+
+        for payload in stored_msg.payloads:
+            self.process_manager.release_payload(payload)
+
+
+# Job kept by BackgroundManager until its response is delivered
+class JobRecord:
+    __slots__ = ('msg', 'callback', 'payloads', 'stream', 'created', 'enqueued', 'msg_type', 'chunks', 'job_key',
+        'waiters', 'hedge', 'hedged')
+
+    def __init__(self, msg, callback, payloads=(), stream=False):
+        self.msg = msg      # store message for debugging
+        self.callback = callback    # callback to call with response
+        self.payloads = payloads    # shared memory released when the job is done
+        self.stream = stream    # callback(chunk, seq, end) per streamed chunk
+        self.created = time()
+        self.enqueued = None    # metrics
+        self.msg_type = None
+        self.chunks = None      # streamed chunks of a plain job
+        self.job_key = None     # coalesce and result cache
+        self.waiters = None     # callbacks of coalesced copies of the job
+        self.hedge = None       # (worker_msg, priority) to write again when the job is slow
+        self.hedged = None      # time the second copy was written
+
+    # add_job calls answered by this job, itself and the coalesced ones
+    def copies(self):
+        return 1 + len(self.waiters or ())
+
+
+# job_key of BackgroundManager(coalesce=True, cache_size=n), None when the message does not pickle
+def make_job_key(msg, msg_type=None):
+    try:
+        data = pickle.dumps((msg_type, msg), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# LRU of responses by job_key, entries older than ttl seconds are dropped when looked up
+class ResultCache:
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()    # {job_key: (stored, response)} least recently used first
+
+    # (True, response) or (False, None)
+    def get(self, job_key, now=None):
+        entry = self.entries.get(job_key, None)
+        if entry is None:
+            return False, None
+
+        if self.ttl is not None and (time() if now is None else now) - entry[0] > self.ttl:
+            del self.entries[job_key]
+            return False, None
 
+        self.entries.move_to_end(job_key)
+        return True, entry[1]
 
+    def set(self, job_key, response):
+        self.entries[job_key] = (time(), response)
+        self.entries.move_to_end(job_key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, job_key):
+        self.entries.pop(job_key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Records by integer id, ids only grow so the dict stays ordered by age
+#   ttl=seconds   sweep() removes and returns records older than ttl (their response was lost)
 class MessageStore:
-    def __init__(self):
+    def __init__(self, ttl=None):
         self.messages = {}
+        self.ids = count(1)
+        self.ttl = ttl
 
     def _generate_id(self):
-        return str(uuid4())
+        return next(self.ids)
+
+    # [(msg_id, record)] older than ttl, oldest first
+    def sweep(self, now=None):
+        if self.ttl is None:
+            return []
+
+        oldest = (time() if now is None else now) - self.ttl
+        expired = []
+        for msg_id, msg in self.messages.items():
+            if msg.created > oldest:
+                break
+            expired.append((msg_id, msg))
+
+        for msg_id, msg in expired:
+            del self.messages[msg_id]
+
+        return expired
 
     def get(self, msg_id, delete=False):
         msg = self.messages.get(msg_id, None)
@@ -144,58 +823,376 @@ class MessageStore:
         return len(self.messages)
 
 
+# Latency histogram over a rolling window (window seconds kept as `slices` time slices)
+#   buckets double from 100 microseconds, record is O(1) and memory does not grow with job count
+class RollingHistogram:
+    BOUNDS = tuple(0.0001 * 2 ** a for a in range(21))    # 100us .. ~105s, one more bucket for anything slower
+
+    def __init__(self, window=60.0, slices=6):
+        self.slice_length = window / slices
+        self.slices = deque(maxlen=slices)     # [slice_index, counts, total, max]
+        self.count = 0      # all time
+        self.total = 0.0
+
+    def _current(self, now):
+        index = int(now / self.slice_length)
+        if not self.slices or self.slices[-1][0] != index:
+            self.slices.append([index, [0] * (len(self.BOUNDS) + 1), 0.0, 0.0])
+        return self.slices[-1]
+
+    def record(self, value, now=None):
+        value = max(value, 0.0)
+        current = self._current(time() if now is None else now)
+        current[1][bisect(self.BOUNDS, value)] += 1
+        current[2] += value
+        current[3] = max(current[3], value)
+        self.count += 1
+        self.total += value
+
+    # counts of the slices still inside the window
+    def _window(self, now):
+        oldest = int(now / self.slice_length) - self.slices.maxlen + 1
+        counts = [0] * (len(self.BOUNDS) + 1)
+        total = 0.0
+        largest = 0.0
+        for index, slice_counts, slice_total, slice_max in self.slices:
+            if index < oldest:
+                continue
+            for i, n in enumerate(slice_counts):
+                counts[i] += n
+            total += slice_total
+            largest = max(largest, slice_max)
+        return counts, total, largest
+
+    # (percentile over the window, number of values in the window), (None, 0) when it is empty
+    def percentile(self, fraction, now=None):
+        counts, total, largest = self._window(time() if now is None else now)
+        n = sum(counts)
+        if not n:
+            return None, 0
+        return self._percentile(counts, n, largest, fraction), n
+
+    # percentile as the upper bound of the bucket it falls in (the max for the last bucket)
+    def _percentile(self, counts, n, largest, fraction):
+        rank = fraction * n
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if c and seen >= rank:
+                return min(self.BOUNDS[i], largest) if i < len(self.BOUNDS) else largest
+        return largest
+
+    def snapshot(self, now=None):
+        now = time() if now is None else now
+        counts, total, largest = self._window(now)
+        n = sum(counts)
+        return {
+            'count': n,
+            'mean': total / n if n else None,
+            'p50': self._percentile(counts, n, largest, 0.5) if n else None,
+            'p90': self._percentile(counts, n, largest, 0.9) if n else None,
+            'p99': self._percentile(counts, n, largest, 0.99) if n else None,
+            'max': largest if n else None,
+            'buckets': [[self.BOUNDS[i] if i < len(self.BOUNDS) else None, c] for i, c in enumerate(counts) if c],
+            'all_count': self.count,
+            'all_mean': self.total / self.count if self.count else None,
+        }
 
-print_lock = ThreadLock()
-def printLine(*args, **kwargs):
-    with print_lock:
-        print(*args, **kwargs)
 
-# ThreadCommunication
-class ThreadCom:
-    def __init__(self):
-        self.com = ThreadQueue()
+# Job lifecycle metrics kept by BackgroundManager(metrics=JobMetrics())
+#   stages (seconds):  queue_wait = enqueued -> worker dequeued  dispatch = dequeued -> start (batch collection)
+#                      run = start -> finish                      delivery = finish -> callback called
+#                      callback = time spent in the callback      total = enqueued -> callback done
+#   worker stages need start_handler_worker, other workers only report total
+#   counters: enqueued, completed, failed, cancelled, overflow, expired, timeout, coalesced, cached, hedged
+#   used from the thread that runs the manager
+class JobMetrics:
+    STAGES = (
+        ('queue_wait', 'enqueued', 'dequeued'),
+        ('dispatch', 'dequeued', 'started'),
+        ('run', 'started', 'finished'),
+        ('delivery', 'finished', 'delivered'),
+        ('callback', 'delivered', 'callback_done'),
+        ('total', 'enqueued', 'callback_done'),
+    )
+
+    def __init__(self, window=60.0, slices=6):
+        self.window = window
+        self.slices = slices
+        self.started = time()
+        self.counters = {'enqueued': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'overflow': 0, 'expired': 0,
+            'timeout': 0, 'coalesced': 0, 'cached': 0, 'hedged': 0}
+        self.overall = self._new_group()
+        self.by_worker = {}
+        self.by_type = {}
+
+    def _new_group(self):
+        return {
+            'completed': 0,
+            'failed': 0,
+            'finished': RollingHistogram(self.window, self.slices),   # every job, for jobs per second
+            'stages': {a[0]: RollingHistogram(self.window, self.slices) for a in self.STAGES},
+        }
 
-    # read and return immediately or wait and block for X seconds
-    def read(self, timeout=0):
-        block = False
-        if timeout != 0:
-            block = True
-        try:
-            return self.com.get(block, timeout)
-        except QueueEmpty:
-            return None
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # times = {'enqueued', 'dequeued', 'started', 'finished', 'delivered', 'callback_done'}, missing ones are skipped
+    def record(self, msg_type, worker_id, times, failed=False):
+        now = time()
+        self.count('failed' if failed else 'completed')
+
+        groups = [self.overall]
+        if worker_id is not None:
+            groups.append(self.by_worker.setdefault(worker_id, self._new_group()))
+        groups.append(self.by_type.setdefault(msg_type, self._new_group()))
+
+        for group in groups:
+            group['failed' if failed else 'completed'] += 1
+            group['finished'].record(0.0, now)
+            for stage, begin, end in self.STAGES:
+                if times.get(begin, None) is not None and times.get(end, None) is not None:
+                    group['stages'][stage].record(times[end] - times[begin], now)
+
+    def _group_snapshot(self, group, now):
+        seconds = min(self.window, max(now - self.started, 0.001))
+        return {
+            'completed': group['completed'],
+            'failed': group['failed'],
+            'jobs_per_second': group['finished'].snapshot(now)['count'] / seconds,
+            'stages': {name: h.snapshot(now) for name, h in group['stages'].items()},
+        }
+
+    def snapshot(self):
+        now = time()
+        return {
+            'time': now,
+            'uptime': now - self.started,
+            'window': self.window,
+            'counters': dict(self.counters),
+            'overall': self._group_snapshot(self.overall, now),
+            'by_worker': {str(a): self._group_snapshot(g, now) for a, g in self.by_worker.items()},
+            'by_type': {str(a): self._group_snapshot(g, now) for a, g in self.by_type.items()},
+        }
+
+    # write snapshot() as json, replaced in one step so readers never see half a file
+    def dump(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+# entry point of process workers, routes the worker's log lines to the parent's log_sink
+def run_process_worker(target_func, log_queue, log_level, **kwargs):
+    log_sink.forward(log_queue, log_level)
+    try:
+        target_func(**kwargs)
+    finally:
+        log_sink.flush()    # atexit does not run in a multiprocessing child
 
-    # run size the queue
-    def size(self):
-        return self.com.qsize()
 
-    # if queue is empty (has no work)
-    def is_empty(self):
-        return self.com.empty()
+# entry point of prestarted process workers, waits with everything imported until
+#   ProcessManagement.create_process sends ('start', pickle of (target_func, kwargs, worker_id))
+def run_warm_worker(log_queue, log_level, queues):
+    log_sink.forward(log_queue, log_level)
+    while True:
+        msg = queues['in'].read(None)      # sleeps until create_process or shutdown
+        if msg == 'shutdown':
+            return
+        if isinstance(msg, tuple) and len(msg) == 2 and msg[0] == 'start':
+            target_func, kwargs, queues['worker_id'] = pickle.loads(msg[1])
+            kwargs['queues'] = queues
+            try:
+                target_func(**kwargs)
+            finally:
+                log_sink.flush()
+            return
 
-    # write a job to the queue
-    def write(self, msg):
-        self.com.put(msg)
 
-    # block until queue is empty
-    def join(self):
-        self.com.join()
+# Scheduling policies used by ProcessManagement(scheduler=...) to pick a worker per job
+#   choose(worker_ids, readers, key) -> worker_id
+#       worker_ids: ordered ids of the group's workers
+#       readers: {worker_id: ScheduledCom}
+#       key: optional job key passed to write_work
+class Scheduler:
+    def choose(self, worker_ids, readers, key=None):
+        raise NotImplementedError()
 
+    # called when workers join or leave a group
+    def update(self, worker_ids):
+        pass
 
-# Process communication via queues
-class ProcessCom(ThreadCom):
+
+class RoundRobinScheduler(Scheduler):
     def __init__(self):
-        self.com = ProcessQueue()
+        self.position = 0
 
+    def choose(self, worker_ids, readers, key=None):
+        worker_id = worker_ids[self.position % len(worker_ids)]
+        self.position += 1
+        return worker_id
 
-class ProcessManagement:
+
+class LeastOutstandingScheduler(Scheduler):
     def __init__(self):
+        self.position = 0   # rotate the starting point so ties are spread out
+
+    def choose(self, worker_ids, readers, key=None):
+        count = len(worker_ids)
+        best_id = None
+        best_load = None
+        for i in range(count):
+            worker_id = worker_ids[(self.position + i) % count]
+            load = readers[worker_id].outstanding()
+            if best_load is None or load < best_load:
+                best_id = worker_id
+                best_load = load
+                if load == 0:
+                    break
+        self.position += 1
+        return best_id
+
+
+# Jobs with the same key always go to the same worker while the group is unchanged
+#   (adding or removing a worker only moves the keys of that worker)
+class ConsistentHashScheduler(Scheduler):
+    def __init__(self, replicas=64):
+        self.replicas = replicas    # virtual nodes per worker
+        self.ring = []              # sorted hashes
+        self.ring_ids = []          # worker id for each hash
+        self.fallback = RoundRobinScheduler()   # jobs without a key
+
+    def _hash(self, value):
+        return crc32(str(value).encode('utf-8'))
+
+    def update(self, worker_ids):
+        points = []
+        for worker_id in worker_ids:
+            for i in range(self.replicas):
+                points.append((self._hash(f'{worker_id}:{i}'), worker_id))
+        points.sort()
+        self.ring = [a[0] for a in points]
+        self.ring_ids = [a[1] for a in points]
+
+    def choose(self, worker_ids, readers, key=None):
+        if key is None or not self.ring:
+            return self.fallback.choose(worker_ids, readers)
+
+        index = bisect(self.ring, self._hash(key)) % len(self.ring)
+        return self.ring_ids[index]
+
+
+SCHEDULERS = {
+    'round_robin': RoundRobinScheduler,
+    'least_outstanding': LeastOutstandingScheduler,
+    'consistent_hash': ConsistentHashScheduler,
+}
+
+
+NO_JOB = -1.0     # WorkerHealth msg_id slot of an idle worker
+
+
+# Heartbeat of a supervised worker, [time of the last beat, msg_id of the running job, msg_id of the
+#   job before] written by the worker and read by ProcessManagement.check_workers, shared memory for
+#   process workers so the last values survive the process being killed (only integer msg_ids are tracked)
+#   the previous job is kept because its response can die with the process (queue feeder thread)
+class WorkerHealth:
+    def __init__(self, ctx=None):
+        values = [0.0, NO_JOB, NO_JOB]
+        self.values = values if ctx is None else ctx.RawArray('d', values)
+
+    def beat(self):
+        self.values[0] = time()
+
+    def started(self, msg_id):
+        self.values[1] = msg_id if isinstance(msg_id, int) else NO_JOB
+        self.values[0] = time()
+
+    def finished(self):
+        self.values[2] = self.values[1]
+        self.values[1] = NO_JOB
+
+    # (last beat or None, [msg_id of the running job, msg_id of the job before] without the missing ones)
+    def get(self):
+        beat, current, previous = self.values[0], self.values[1], self.values[2]
+        return beat or None, [int(a) for a in (current, previous) if a != NO_JOB]
+
+
+class ProcessManagement:
+    # scheduler=None      workers of a type share one work in queue (first come first served)
+    # scheduler=<name>    each worker gets its own work in queue and write_work routes jobs
+    #                     round_robin | least_outstanding | consistent_hash (or a Scheduler object)
+    # work_stealing=True  idle thread workers take queued jobs from the busiest peer
+    # work_in_maxsize     bound for the work in queues (0 = unbounded, per worker with a scheduler)
+    # overflow            block | timeout | reject | drop_oldest (see ThreadCom), put_timeout for timeout
+    # priority_lanes=3    work in queues get one lane per priority (Priority.HIGH is read first), 0 = one FIFO
+    # start_method        fork | spawn | forkserver for process workers (None = multiprocessing default)
+    # preload=[modules]   forkserver imports these once so new workers start with them loaded
+    # warm_processes=2    keep processes prestarted in the background, create_process hands one its target
+    #                     instead of starting a process (kwargs must pickle, otherwise it starts cold),
+    #                     with fork the replacements are forked by create_process itself, not in the background
+    # codec               serialization of the process work queues, pickle | pickle5 | marshal | Codec object
+    #                     (see Codec, get_codec_stats), None uses multiprocessing's own pickling
+    # supervise=True      restart thread and process workers that died (same worker_id and queues) and
+    #                     write their unanswered job to the work queue again, see check_workers
+    #   heartbeat_interval    seconds between worker heartbeats and between checks
+    #   heartbeat_timeout     seconds without a heartbeat before a process worker counts as hung and is
+    #                         terminated (None: only dead workers are restarted, long jobs are fine)
+    #   max_retries           times a job is written again after its worker died, then the job is answered
+    #                         with {'msg_id': .., 'error': 'WorkerLost: ..'} (BackgroundManager on_error)
+    # channel='ring'      process workers' command queues, and their own work in queue with a scheduler, are
+    #                     RingCom shared memory rings of ring_size bytes instead of multiprocessing queues
+    #                     (work_in_maxsize does not apply to the rings, overflow drop_oldest is not supported,
+    #                     x86 only, see lib_ring.RingCom)
+    # daemon_threads=True thread workers do not keep the interpreter alive at exit (WorkerExecutor)
+    def __init__(self, scheduler=None, work_stealing=False, work_in_maxsize=0, overflow='block', put_timeout=None,
+            priority_lanes=0, start_method=None, preload=None, warm_processes=0, codec=None,
+            supervise=False, heartbeat_interval=1.0, heartbeat_timeout=None, max_retries=2,
+            channel='queue', ring_size=1 << 20, daemon_threads=False):
+        self.mp_context = multiprocessing.get_context(start_method)
+        if preload and self.mp_context.get_start_method() == 'forkserver':
+            self.mp_context.set_forkserver_preload([__name__] + list(preload))
+
         self.process_queue_work_in = None
         self.process_queue_work_out = None
 
         self.thread_queue_work_in = None
         self.thread_queue_work_out = None
 
+        self.scheduler_option = scheduler
+        self.work_stealing = work_stealing
+
+        self.work_in_options = {
+            'maxsize': work_in_maxsize,
+            'overflow': overflow,
+            'put_timeout': put_timeout,
+        }
+        self.priority_lanes = priority_lanes
+        self.codec = codec
+
+        if channel not in ('queue', 'ring'):
+            raise Exception('channel ['+str(channel)+'] not found')
+        if channel == 'ring' and not LOCAL_FENCE:
+            raise Exception('channel [ring] needs an x86 CPU, not ['+platform.machine()+']')
+        self.channel = channel
+        self.ring_size = ring_size
+        self.daemon_threads = daemon_threads
+
+        self.payloads = {}      # {name: SharedPayload} shared memory created by share()
+        self.routed = {}        # {msg_id: [ScheduledCom]} readers a scheduled job was written to, until its response
+        self.route_lock = ThreadLock()      # writers route and a reader thread (WorkerExecutor) unroutes
+        self.job_payloads = {}  # {msg_id: [SharedPayload]} share() payloads of written jobs until their response
+        self.groups = {}
+            # {
+            # ('thread', 'thread'): {
+            #   'ids': [worker_id, ...],
+            #   'readers': {worker_id: ScheduledCom},
+            #   'peers': [ScheduledCom, ...],
+            #   'scheduler': Scheduler,
+            # },
+            # }
+
         self.worker_id = 0
         self.workers = {}
             # {
@@ -205,32 +1202,165 @@ class ProcessManagement:
             # 'out_com': out_com,
             # }
 
+        self.listener = None
+        self.remote_pending = deque()   # RemoteWorker links accepted but not registered yet
+        self.remote_lost = deque()      # RemoteWorker links that disconnected
+        self.remote_work_queue_type = 'thread'
+
+        self.supervise = supervise
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_retries = max_retries
+        self.unanswered = {}    # {msg_id: [msg, retries]} jobs written while supervising, until their response
+        self.last_check = time()
+
+        self.warm_processes = warm_processes
+        self.spares = deque()       # [(process, queues)] prestarted by _start_spares
+        self.spare_lock = ThreadLock()
+        self.spare_refill = None    # thread starting spares
+        self.spares_closed = False
+        self._refill_spares()
+
     def _get_object(self, worker_id):
         worker = self.workers.get(worker_id, None)
         if not worker:
-            raise Exception('worker_id ['+worker_id+'] not found ')
+            raise Exception('worker_id ['+str(worker_id)+'] not found ')
         return worker
 
+    # work in queue with the configured bound and priority lanes
+    #   single_reader: a worker's own queue that only its process reads (see ProcessCom)
+    def _new_work_in(self, com_class, single_reader=False):
+        options = dict(self.work_in_options)
+        if com_class is ProcessCom:
+            options['ctx'] = self.mp_context
+            options['codec'] = self.codec
+            options['single_reader'] = single_reader
+        elif com_class is RingCom:
+            del options['maxsize']
+            options['capacity'] = self.ring_size
+            options['ctx'] = self.mp_context
+            options['codec'] = self.codec
+        if self.priority_lanes > 0:
+            return PriorityCom([com_class(**options) for i in range(self.priority_lanes)])
+        return com_class(**options)
+
+    def _new_scheduler(self):
+        if isinstance(self.scheduler_option, Scheduler):
+            return self.scheduler_option
+
+        scheduler_class = SCHEDULERS.get(self.scheduler_option, None)
+        if scheduler_class is None:
+            raise Exception('scheduler ['+str(self.scheduler_option)+'] not found')
+        return scheduler_class()
+
+    # create a worker's own work in queue and add it to its scheduling group
+    #   group = (worker type, work queue type)
+    def _add_scheduled_worker(self, worker_id, group_key, com, stealing):
+        group = self.groups.get(group_key, None)
+        if group is None:
+            group = {
+                'ids': [],
+                'readers': {},
+                'peers': [],
+                'scheduler': self._new_scheduler(),
+            }
+            self.groups[group_key] = group
+
+        reader = ScheduledCom(com, group['peers'], stealing)
+        group['ids'].append(worker_id)
+        group['readers'][worker_id] = reader
+        group['peers'].append(reader)
+        group['scheduler'].update(group['ids'])
+
+        return reader
+
+    # take a worker out of its scheduling group, returns its reader (None if it is not scheduled)
+    def _remove_scheduled_worker(self, worker_id):
+        worker = self._get_object(worker_id)
+        group = self.groups.get(worker['group'], None)
+        if group is None or worker_id not in group['readers']:
+            return None
+
+        reader = group['readers'].pop(worker_id)
+        group['ids'].remove(worker_id)
+        group['peers'].remove(reader)
+        group['scheduler'].update(group['ids'])
+
+        return reader
+
     # obj_type = thread | process
+    # remote workers share the thread workers' queues so they count as 'thread' when there is no local one
     def get_random_worker(self, obj_type='thread'):
+        self.accept_remote_workers()
+        remote_id = None
         for worker_id, obj in self.workers.items():
+            if obj.get('retiring', False):
+                continue
             if obj['type'] == obj_type:
                 return worker_id
+            if obj_type == 'thread' and obj['type'] == 'remote' and remote_id is None:
+                remote_id = worker_id
 
-        return None
+        return remote_id
 
     # work_queue_type = thread|process # thread and use thread or process queues
     def create_thread(self, target_func, work_queue_type='thread', **kwargs):
         worker_id = self.worker_id
         self.worker_id += 1
 
+        if work_queue_type == 'process':
+            printLine('switching to process queue for work')
+        queue_work_in, queue_work_out = self._shared_work_queues(work_queue_type)
+
+        worker_reader = queue_work_in
+        if self.scheduler_option is not None:
+            queue_work_in = self._new_work_in(ThreadCom if work_queue_type == 'thread' else ProcessCom, True)
+            worker_reader = self._add_scheduled_worker(worker_id, ('thread', work_queue_type),
+                queue_work_in, self.work_stealing)
+
+        in_com = ThreadCom()
+        out_com = ThreadCom()
+
+        queues = {
+            'work_in': worker_reader,
+            'work_out': queue_work_out,
+            'in': in_com,
+            'out': out_com,
+            'worker_id': worker_id,     # the id this manager knows the worker by (job metrics)
+        }
+        if self.supervise:
+            queues['health'] = WorkerHealth()
+            queues['heartbeat'] = self.heartbeat_interval
+
+        input = kwargs
+        input['queues'] = queues
+
+        t = Thread(target=target_func, kwargs=input, daemon=self.daemon_threads)
+
+        self.workers[worker_id] = {
+            'type': 'thread',
+            'object': t,
+            'in_com': in_com,
+            'out_com': out_com,
+            'work_in': queue_work_in,
+            'work_out':  queue_work_out,
+            'group': ('thread', work_queue_type),
+        }
+        self._watch_worker(worker_id, target_func, input)
+
+        t.start()
+
+        return worker_id
+
+    # work in and work out queues shared by thread (and remote) workers of work_queue_type
+    def _shared_work_queues(self, work_queue_type):
         queue_work_in = None
         queue_work_out = None
 
         if work_queue_type == 'thread':
             # initialize work in queue it not defined
             if not self.thread_queue_work_in:
-                self.thread_queue_work_in = ThreadCom()
+                self.thread_queue_work_in = self._new_work_in(ThreadCom)
             queue_work_in = self.thread_queue_work_in
 
             # initialize work out queue it not defined
@@ -242,99 +1372,582 @@ class ProcessManagement:
             printLine('switching to process queue for work')
             # initialize work in queue it not defined
             if not self.process_queue_work_in:
-                self.process_queue_work_in = ProcessCom()
+                self.process_queue_work_in = self._new_work_in(ProcessCom)
             queue_work_in = self.process_queue_work_in
 
             # initialize work out queue it not defined
             if not self.process_queue_work_out:
-                self.process_queue_work_out = ProcessCom()
+                self.process_queue_work_out = ProcessCom(ctx=self.mp_context, codec=self.codec, single_reader=True)
             queue_work_out = self.process_queue_work_out
 
         else:
             raise Exception('work_queue_type ', work_queue_type, 'not found')
 
+        return queue_work_in, queue_work_out
+
+    # accept workers started with run_remote_worker (python -m intounknown_lib.remote_worker)
+    #   address = ('0.0.0.0', 6000) for TCP (port 0 picks a free one) or a path for a Unix socket
+    #   authkey: required for TCP, a connection has to answer the challenge before anything it sends is
+    #   unpickled (an authenticated worker can still run code in the manager, only give the key to trusted
+    #   hosts), a Unix socket without authkey is protected by the socket file's permissions only
+    #   handshake_timeout: seconds a new connection gets for the challenge and its hello
+    #   remote workers share the thread workers' work_queue_type queues (their own queue with a scheduler),
+    #   connections are registered by accept_remote_workers, which get_random_worker and write_work call
+    #   returns the address workers should connect to
+    def listen(self, address, authkey=None, work_queue_type='thread', handshake_timeout=10.0):
+        if authkey is None and isinstance(address, tuple):
+            raise Exception('listen on a TCP address requires an authkey')
+
+        self.remote_work_queue_type = work_queue_type
+        self.listener = Listener(address)     # authenticated in _handshake, not on the accept thread
+        Thread(target=self._accept_loop, args=(self.listener, authkey, handshake_timeout), daemon=True).start()
+        return self.listener.address
+
+    def _accept_loop(self, listener, authkey, handshake_timeout):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                if self.listener is not listener:
+                    return      # closed by stop_listening
+                sleep(0.1)      # out of file descriptors or a connection reset before accept
+                continue
+            Thread(target=self._handshake, args=(conn, authkey, handshake_timeout), daemon=True).start()
+
+    # authenticate a new connection and read its hello, one thread per connection so a slow or silent
+    #   client does not hold up the others, the connection is cut when it takes longer than timeout
+    def _handshake(self, conn, authkey, timeout):
+        timer = Timer(timeout, abort_connection, (conn,))
+        timer.start()
+        try:
+            if authkey is not None:
+                deliver_challenge(conn, authkey)
+                answer_challenge(conn, authkey)
+            if not conn.poll(timeout):
+                raise Exception(f'no hello within {timeout} seconds')
+            msg = conn.recv()
+            if not (isinstance(msg, tuple) and len(msg) == 2 and msg[0] == 'hello' and isinstance(msg[1], dict)):
+                raise Exception('expected a hello message')
+            link = RemoteWorker(SocketConnection(conn), msg[1])
+        except Exception as e:
+            printLine(f'remote worker rejected: {type(e).__name__}: {e}', level=WARNING)
+            conn.close()
+            return
+        finally:
+            timer.cancel()
+
+        self.remote_pending.append(link)
+
+    def stop_listening(self):
+        listener = self.listener
+        self.listener = None
+        if listener is not None:
+            listener.close()
+
+    # called where the manager reads or writes work so remote workers come and go on its own thread
+    def _sync_remote_workers(self):
+        if self.remote_pending or self.remote_lost:
+            self.accept_remote_workers()
+
+    # register remote workers that connected since the last call and drop the ones that disconnected
+    #   (their unanswered jobs go to the rest of the group), returns the new worker ids
+    def accept_remote_workers(self):
+        while self.remote_lost:
+            link = self.remote_lost.popleft()
+            if link.worker_id in self.workers:
+                self._reap_worker(link.worker_id)
 
-        in_com = ThreadCom()
-        out_com = ThreadCom()
+        result = []
+        while self.remote_pending:
+            link = self.remote_pending.popleft()
+            worker_id = self.worker_id
+            self.worker_id += 1
+
+            work_queue_type = self.remote_work_queue_type
+            queue_work_in, queue_work_out = self._shared_work_queues(work_queue_type)
+            worker_reader = queue_work_in
+            if self.scheduler_option is not None:
+                queue_work_in = self._new_work_in(ThreadCom if work_queue_type == 'thread' else ProcessCom, True)
+                worker_reader = self._add_scheduled_worker(worker_id, ('thread', work_queue_type),
+                    queue_work_in, False)
+
+            self.workers[worker_id] = {
+                'type': 'remote',
+                'object': link,
+                'in_com': link.connection.channel('in'),
+                'out_com': link.connection.channel('out'),
+                'work_in': queue_work_in,
+                'work_out':  queue_work_out,
+                'group': ('thread', work_queue_type),
+                'host': link.host,
+            }
+            link.worker_id = worker_id
+            link.on_lost = self.remote_lost.append
+            link.start(worker_reader, queue_work_out)
+            result.append(worker_id)
 
-        queues = {
-            'work_in': queue_work_in,
-            'work_out': queue_work_out,
-            'in': in_com,
-            'out': out_com,
-        }
+        return result
 
-        input = kwargs
-        input['queues'] = queues
 
-        t = Thread(target=target_func, kwargs=input)
+    # queues for a new process worker, its own work in queue when a scheduler is used
+    def _new_process_queues(self):
+        with self.spare_lock:
+            # initialize work in queue it not defined
+            if not self.process_queue_work_in:
+                self.process_queue_work_in = self._new_work_in(ProcessCom)
 
-        self.workers[worker_id] = {
-            'type': 'thread',
-            'object': t,
-            'in_com': in_com,
-            'out_com': out_com,
-            'work_in': queue_work_in,
-            'work_out':  queue_work_out,
-        }
+            # initialize work out queue it not defined
+            if not self.process_queue_work_out:
+                self.process_queue_work_out = ProcessCom(ctx=self.mp_context, codec=self.codec, single_reader=True)
 
-        t.start()
+        queue_work_in = self.process_queue_work_in
+        if self.scheduler_option is not None:
+            queue_work_in = self._new_work_in(RingCom if self.channel == 'ring' else ProcessCom, True)
 
-        return worker_id
+        # start the shared memory tracker first so children reuse it instead of starting their own,
+        #   a child's tracker would unlink payloads it only attached to when the child exits
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
 
+        queues = {
+            'work_in': queue_work_in,
+            'work_out': self.process_queue_work_out,
+            'in': self._new_channel(),
+            'out': self._new_channel(),
+        }
+        if self.supervise:
+            queues['health'] = WorkerHealth(self.mp_context)
+            queues['heartbeat'] = self.heartbeat_interval
+        return queues
+
+    # command queue between the manager and one process worker
+    def _new_channel(self):
+        if self.channel == 'ring':
+            return RingCom(self.ring_size, ctx=self.mp_context)
+        return ProcessCom(ctx=self.mp_context)
 
     def create_process(self, target_func, **kwargs):
         worker_id = self.worker_id
         self.worker_id += 1
 
-        # initialize work in queue it not defined
-        if not self.process_queue_work_in:
-            self.process_queue_work_in = ProcessCom()
-
-        # initialize work out queue it not defined
-        if not self.process_queue_work_out:
-            self.process_queue_work_out = ProcessCom()
+        p, queues = self._take_spare(target_func, kwargs, worker_id)
+        if p is None:
+            queues = self._new_process_queues()
+            queues['worker_id'] = worker_id
 
-        in_com = ProcessCom()
-        out_com = ProcessCom()
+            input = kwargs
+            input['queues'] = queues
 
-        queues = {
-            'work_in': self.process_queue_work_in,
-            'work_out': self.process_queue_work_out,
-            'in': in_com,
-            'out': out_com,
-        }
+            p = self.mp_context.Process(target=run_process_worker,
+                args=(target_func, log_sink.get_process_queue(self.mp_context), log_sink.level), kwargs=input)
 
-        input = kwargs
-        input['queues'] = queues
-
-        p = Process(target=target_func, kwargs=input)
+        if self.scheduler_option is not None:
+            # peers live in other processes so process workers do not steal
+            self._add_scheduled_worker(worker_id, ('process', 'process'), queues['work_in'], False)
 
         self.workers[worker_id] = {
             'type': 'process',
             'object': p,
-            'in_com': in_com,
-            'out_com': out_com,
-            'work_in': self.process_queue_work_in,
-            'work_out':  self.process_queue_work_out,
+            'in_com': queues['in'],
+            'out_com': queues['out'],
+            'work_in': queues['work_in'],
+            'work_out':  queues['work_out'],
+            'group': ('process', 'process'),
         }
+        self._watch_worker(worker_id, target_func, dict(kwargs, queues=queues))
 
-        p.start()
+        if not p.is_alive():
+            p.start()
 
         return worker_id
 
+    # what check_workers needs to restart a worker
+    def _watch_worker(self, worker_id, target_func, kwargs):
+        if not self.supervise:
+            return
+
+        worker = self.workers[worker_id]
+        worker['target'] = target_func
+        worker['kwargs'] = kwargs       # includes the queues
+        worker['health'] = kwargs['queues'].get('health', None)
+        worker['beat'] = None       # time of the last heartbeat (None until the worker sends one)
+        worker['current'] = []      # msg_ids of the job it is running and the one before
+        worker['restarts'] = 0
+
+    # supervise: restart dead (and hung) workers and write their job to the work queue again
+    #   runs at most every heartbeat_interval from read_work, read_work_many and slurp_work_out,
+    #   call it directly when nothing reads responses, returns the ids of the restarted workers
+    #   the job a worker was running and the one before are retried when their response has not been
+    #   read, so a job whose response was still on the way runs twice (the second response is ignored),
+    #   jobs it had read ahead (a MessageBatch) are lost with it, BackgroundManager(job_ttl=..) times those out
+    #   a process killed while writing to a shared process queue can leave the queue's lock held,
+    #   which no restart repairs
+    def check_workers(self):
+        self.last_check = time()
+        result = []
+        for worker_id, worker in tuple(self.workers.items()):
+            if worker.get('health', None) is None or worker.get('retiring', False) or worker.get('stopped', False):
+                continue
+
+            worker['beat'], worker['current'] = worker['health'].get()
+
+            process_or_thread = worker['object']
+            if process_or_thread.is_alive():
+                if self.heartbeat_timeout is None or worker['beat'] is None \
+                        or time() - worker['beat'] < self.heartbeat_timeout:
+                    continue
+                if worker['type'] != 'process':
+                    continue    # threads cannot be stopped from outside, wait for them
+                printLine(f'supervise: worker [{worker_id}] sent no heartbeat for '
+                    f'{time() - worker["beat"]:.1f} seconds, terminating it', level=WARNING)
+                process_or_thread.terminate()
+                process_or_thread.join(1)
+
+            self._restart_worker(worker_id)
+            result.append(worker_id)
+
+        return result
+
+    def _restart_worker(self, worker_id):
+        worker = self.workers[worker_id]
+        msg_ids = worker['current']
+        printLine(f'supervise: worker [{worker_id}] died (jobs {msg_ids}), restarting it', level=WARNING)
+
+        kwargs = dict(worker['kwargs'])
+        if worker['type'] == 'process':
+            # fresh command queues, the dead process may have held their locks
+            queues = dict(kwargs['queues'])
+            for name in ('in', 'out'):
+                queues[name] = self._new_channel()
+            queues['health'] = WorkerHealth(self.mp_context)
+            kwargs['queues'] = queues
+            process_or_thread = self.mp_context.Process(target=run_process_worker,
+                args=(worker['target'], log_sink.get_process_queue(self.mp_context), log_sink.level), kwargs=kwargs)
+            worker['in_com'] = queues['in']
+            worker['out_com'] = queues['out']
+            worker['health'] = queues['health']
+            worker['kwargs'] = kwargs
+        else:
+            kwargs['queues']['health'] = worker['health'] = WorkerHealth()
+            process_or_thread = Thread(target=worker['target'], kwargs=kwargs, daemon=self.daemon_threads)
+
+        worker['object'] = process_or_thread
+        worker['beat'] = None
+        worker['current'] = []
+        worker['restarts'] += 1
+        process_or_thread.start()
+
+        for msg_id in msg_ids:
+            job = self.unanswered.get(msg_id, None)
+            if job is None:
+                continue    # answered before it died, or not a supervised job
+
+            if job[1] >= self.max_retries:
+                del self.unanswered[msg_id]
+                worker['work_out'].write({'msg_id': msg_id,
+                    'error': f'WorkerLost: worker [{worker_id}] died running the job {job[1] + 1} times'})
+                continue
+
+            job[1] += 1
+            self.write_work(worker_id, job[0])
+
+    # remember supervised jobs until their response is read
+    def _track_jobs(self, msgs):
+        for msg in msgs:
+            if isinstance(msg, dict) and msg.get('msg_id', None) is not None:
+                job = self.unanswered.get(msg['msg_id'], None)
+                if job is None:
+                    self.unanswered[msg['msg_id']] = [msg, 0]
+
+    # the last response of these jobs was read, stop retrying and counting them and free their share() payloads
+    #   (a WorkerExecutor 'started' notice is not a response)
+    def _answered(self, messages, release_payloads=True):
+        for res_msg in messages:
+            if isinstance(res_msg, dict) and (res_msg.get('seq', None) is None or res_msg.get('end', False)) \
+                    and not res_msg.get('started', False):
+                msg_id = res_msg.get('msg_id', None)
+                self.unanswered.pop(msg_id, None)
+                if self.routed:
+                    self._unroute(msg_id)
+                if release_payloads and self.job_payloads:
+                    self.release_job_payloads(msg_id)
+        return messages
+
+    def _check_workers_due(self):
+        if self.supervise and time() - self.last_check >= self.heartbeat_interval:
+            self.check_workers()
+
+    # liveness of the workers, {worker_id: {'type', 'alive', 'last_beat', 'current', 'restarts'}}
+    #   current = [msg_id of the running job, msg_id of the job before] as of the last check_workers
+    def get_worker_health(self):
+        result = {}
+        for worker_id, worker in self.workers.items():
+            result[worker_id] = {
+                'type': worker['type'],
+                'alive': worker['object'].is_alive(),
+                'last_beat': worker.get('beat', None),
+                'current': worker.get('current', []),
+                'restarts': worker.get('restarts', 0),
+            }
+        return result
+
+    # a prestarted process running target_func, (None, None) when there is none ready
+    def _take_spare(self, target_func, kwargs, worker_id):
+        if self.warm_processes <= 0:
+            return None, None
+
+        try:
+            start_msg = ('start', pickle.dumps((target_func, kwargs, worker_id)))
+        except Exception:
+            return None, None   # a cold start can still hand over what does not pickle (fork)
+
+        p = None
+        with self.spare_lock:
+            while self.spares:
+                p, queues = self.spares.popleft()
+                if p.is_alive():
+                    break
+                p = None
+
+        self._refill_spares()   # replace it in the background
+        if p is None:
+            return None, None
+
+        queues['in'].write(start_msg)
+        queues['worker_id'] = worker_id
+        return p, queues
+
+    # spawn and forkserver start spares on a background thread, fork starts them on the calling thread
+    #   (forking from a second thread copies locks other threads may hold in the middle of a change)
+    def _refill_spares(self):
+        with self.spare_lock:
+            if self.spares_closed or self.spare_refill is not None or len(self.spares) >= self.warm_processes:
+                return
+            if self.mp_context.get_start_method() != 'fork':
+                self.spare_refill = Thread(target=self._start_spares, daemon=True)
+                self.spare_refill.start()
+                return
+
+        self._start_spares()
+
+    def _start_spares(self):
+        while True:
+            with self.spare_lock:
+                if self.spares_closed or len(self.spares) >= self.warm_processes:
+                    self.spare_refill = None
+                    return
+
+            queues = self._new_process_queues()
+            p = self.mp_context.Process(target=run_warm_worker,
+                args=(log_sink.get_process_queue(self.mp_context), log_sink.level), kwargs={'queues': queues})
+            p.start()
+
+            with self.spare_lock:
+                self.spares.append((p, queues))
+
+    # stop the prestarted processes nobody took
+    def _stop_spares(self, deadline=None):
+        with self.spare_lock:
+            self.spares_closed = True
+            refill = self.spare_refill
+        if refill is not None:
+            refill.join()
+
+        spares = list(self.spares)
+        self.spares.clear()
+        for p, queues in spares:
+            queues['in'].write('shutdown')
+        for p, queues in spares:
+            p.join(1.0 if deadline is None else max(0.0, deadline - time()))
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
 
 
     # write to work input queue
-    def write_work(self, worker_id, msg):
+    #   with a scheduler the job is routed to one of the workers in worker_id's group
+    #   key: jobs with the same key go to the same worker (consistent_hash)
+    #   priority: Priority.HIGH | NORMAL | LOW lane when priority_lanes is set
+    #   elsewhere=True: pick a worker that does not already hold a job with this msg_id (hedged copies)
+    def write_work(self, worker_id, msg, key=None, priority=None, elsewhere=False):
+        self._sync_remote_workers()
+        if self.supervise:
+            self._track_jobs((msg,))
+        if self.payloads:
+            self._track_payloads((msg,))
         worker = self._get_object(worker_id)
         #printLine('write_work:', worker)
-        worker['work_in'].write(msg)
+        group = self.groups.get(worker['group'], None)
+        if group is None:
+            return worker['work_in'].write(msg, priority)    # messages dropped by drop_oldest or None
+
+        worker_ids = group['ids']
+        if elsewhere and isinstance(msg, dict):
+            with self.route_lock:
+                holding = self.routed.get(msg.get('msg_id', None), ())
+                worker_ids = [a for a in worker_ids if group['readers'][a] not in holding] or worker_ids
+        target_id = group['scheduler'].choose(worker_ids, group['readers'], key)
+        reader = group['readers'][target_id]
+        self._route(reader, (msg,))
+        try:
+            dropped = self._get_object(target_id)['work_in'].write(msg, priority)
+        except Exception:
+            self._unroute_from(reader, (msg,))
+            raise
+        self._unroute_from(reader, dropped)
+        return dropped
+
+    # write a list of jobs as one transfer per target queue
+    #   keys: optional list of routing keys, one per message
+    def write_work_many(self, worker_id, msgs, keys=None, priority=None):
+        self._sync_remote_workers()
+        if self.supervise:
+            self._track_jobs(msgs)
+        if self.payloads:
+            self._track_payloads(msgs)
+        worker = self._get_object(worker_id)
+        group = self.groups.get(worker['group'], None)
+        if group is None:
+            return worker['work_in'].write_many(msgs, priority)
+
+        # split the batch by the worker the scheduler picks for each message
+        batches = {}
+        for i, msg in enumerate(msgs):
+            key = keys[i] if keys is not None else None
+            target_id = group['scheduler'].choose(group['ids'], group['readers'], key)
+            batches.setdefault(target_id, []).append(msg)
+
+        dropped = None
+        for target_id, batch in batches.items():
+            reader = group['readers'][target_id]
+            self._route(reader, batch)
+            try:
+                result = self._get_object(target_id)['work_in'].write_many(batch, priority)
+            except Exception:
+                self._unroute_from(reader, batch)
+                raise
+            self._unroute_from(reader, result)
+            if result:
+                dropped = (dropped or []) + result
+
+        return dropped
+
+    # count written jobs against the worker they went to until their last response is read (see _answered),
+    #   least_outstanding sees a process worker's running job this way, only jobs with a msg_id are counted
+    #   routed before the write, a response read on another thread right after it finds its route
+    def _route(self, reader, msgs):
+        with self.route_lock:
+            for msg in msgs:
+                msg_id = msg.get('msg_id', None) if isinstance(msg, dict) else None
+                if msg_id is not None:
+                    self.routed.setdefault(msg_id, []).append(reader)
+                    reader.assigned += 1
+
+    # jobs that did not stay in reader's queue (the write failed, drop_oldest dropped them)
+    def _unroute_from(self, reader, msgs):
+        with self.route_lock:
+            for msg in msgs or ():
+                msg_id = msg.get('msg_id', None) if isinstance(msg, dict) else None
+                readers = self.routed.get(msg_id, None)
+                if readers is None or reader not in readers:
+                    continue
+                readers.remove(reader)
+                reader.assigned -= 1
+                if not readers:
+                    del self.routed[msg_id]
+
+    # a hedged or retried job was written more than once, every copy stops counting
+    def _unroute(self, msg_id):
+        with self.route_lock:
+            for reader in self.routed.pop(msg_id, ()):
+                reader.assigned -= 1
+
+    # write to a specific worker's own queue, bypassing the scheduler
+    def write_work_direct(self, worker_id, msg):
+        worker = self._get_object(worker_id)
+        group = self.groups.get(worker['group'], None)
+        if group is None or worker_id not in group['readers']:
+            raise Exception('write_work_direct requires a scheduler, workers share one queue')
+        reader = group['readers'][worker_id]
+        self._route(reader, (msg,))
+        try:
+            dropped = worker['work_in'].write(msg)
+        except Exception:
+            self._unroute_from(reader, (msg,))
+            raise
+        self._unroute_from(reader, dropped)
+        return dropped
+
+    # take queued jobs {'msg_id': ..} out of the work in queue(s) that worker_id reads from
+    #   thread queues remove them directly, jobs already in a process queue's pipe cannot be taken back
+    #   so the workers are told to skip them, returns the msg_ids that were removed
+    def cancel_work(self, worker_id, msg_ids):
+        msg_ids = set(msg_ids)
+        for msg_id in msg_ids:
+            self.unanswered.pop(msg_id, None)
+            self._unroute(msg_id)
+            self.release_job_payloads(msg_id)     # no response will come
+        worker = self._get_object(worker_id)
+        group = self.groups.get(worker['group'], None)
+        if group is None:
+            coms = [worker['work_in']]
+            members = [a for a, obj in self.workers.items() if obj['work_in'] is worker['work_in']]
+        else:
+            coms = [a.own for a in group['readers'].values()]
+            members = list(group['ids'])
+
+        removed = []
+        for com in coms:
+            removed.extend(com.remove(lambda msg: isinstance(msg, dict) and msg.get('msg_id', None) in msg_ids))
+
+        # jobs already taken by a worker (a process worker's own queue or a stream in progress)
+        removed_ids = set(a['msg_id'] for a in removed)
+        remaining = msg_ids - removed_ids
+        if remaining:
+            for member_id in members:
+                self.write_in(member_id, ('cancel', list(remaining)))
+
+        return removed_ids
+
+    # is the work in queue that write_work(worker_id, ...) uses at its maxsize
+    #   with a scheduler the group is full when every worker's queue is full
+    def is_work_in_full(self, worker_id):
+        worker = self._get_object(worker_id)
+        group = self.groups.get(worker['group'], None)
+        if group is None:
+            return worker['work_in'].is_full()
+
+        return all(a.own.is_full() for a in group['readers'].values())
+
+    # jobs written to each scheduled worker whose last response has not been read (queued or running),
+    #   {worker_id: count}
+    def get_worker_loads(self):
+        result = {}
+        for group in self.groups.values():
+            for worker_id, reader in group['readers'].items():
+                result[worker_id] = reader.outstanding()
+        return result
 
     # read from work output queue
     def read_work(self, worker_id, wait_time=0):
+        self._sync_remote_workers()
+        worker = self._get_object(worker_id)
+        res_msg = worker['work_out'].read(wait_time)
+        if self.unanswered or self.job_payloads or self.routed:
+            self._answered((res_msg,))
+        self._check_workers_due()
+        return res_msg
+
+    # read up to max_count messages from the work output queue
+    def read_work_many(self, worker_id, max_count=None, wait_time=0):
+        self._sync_remote_workers()
         worker = self._get_object(worker_id)
-        return worker['work_out'].read(wait_time)
+        messages = worker['work_out'].read_many(max_count, wait_time)
+        if self.unanswered or self.job_payloads or self.routed:
+            self._answered(messages)
+        self._check_workers_due()     # after reading so responses already received are not retried
+        return messages
 
     # write a worker's command input
     def write_in(self, worker_id, msg):
@@ -346,6 +1959,30 @@ class ProcessManagement:
         worker = self._get_object(worker_id)
         worker['out_com'].read(wait_time)
 
+    # file descriptor that becomes readable when the work output queue receives a message
+    def get_work_out_fileno(self, worker_id):
+        worker = self._get_object(worker_id)
+        return worker['work_out'].fileno()
+
+    # close the file descriptor of get_work_out_fileno once the event loop no longer watches it
+    def close_work_out_fileno(self, worker_id):
+        worker = self._get_object(worker_id)
+        worker['work_out'].close()
+
+    # consume the work output queue's wakeup signal (call before slurp_work_out)
+    def clear_work_out_wakeup(self, worker_id):
+        worker = self._get_object(worker_id)
+        worker['work_out'].clear_wakeup()
+
+    # serialization counters of the process work queues in this process, {'work_in': {..}, 'work_out': {..}}
+    #   (None for a queue without a codec, a shared Codec object shows the same numbers for both)
+    def get_codec_stats(self):
+        result = {}
+        for name, com in (('work_in', self.process_queue_work_in), ('work_out', self.process_queue_work_out)):
+            lanes = com.lanes if isinstance(com, PriorityCom) else [com]
+            result[name] = lanes[0].get_codec_stats() if com is not None else None
+        return result
+
     def get_queue_sizes(self, worker_id):
         worker = self._get_object(worker_id)
         return {
@@ -354,31 +1991,23 @@ class ProcessManagement:
         }
 
     # Get all message from work out queue
-    def slurp_work_out(self, worker_id):
+    #   release_payloads=False leaves the share() payloads of answered jobs to release_job_payloads
+    def slurp_work_out(self, worker_id, release_payloads=True):
+        self._sync_remote_workers()
         worker = self._get_object(worker_id)
-        queue_obj = worker['work_out']
-
-        result = []
-        while True:
-            msg = queue_obj.read()
-            if msg is None:
-                break
-            result.append(msg)
-
-        return result
+        messages = worker['work_out'].read_many()
+        if self.unanswered or self.job_payloads or self.routed:
+            self._answered(messages, release_payloads)
+        self._check_workers_due()
+        return messages
 
     def _drain_queue(self, queue_obj):
-        result = []
         if queue_obj is None:
-            return result
+            return []
+        if any(isinstance(a, RingCom) for a in wait_leaves(queue_obj)):
+            return []   # only the worker reads its ring, what is left goes away with it
 
-        while True:
-            msg = queue_obj.read()
-            if msg is None:
-                break
-            result.append(msg)
-
-        return result
+        return queue_obj.read_many()
 
     # clear the work queues and all memory before shutdown
     def drain_work_queues(self):
@@ -387,22 +2016,495 @@ class ProcessManagement:
         self._drain_queue(self.thread_queue_work_in)
         self._drain_queue(self.thread_queue_work_out)
 
+        # per worker queues when a scheduler is used
+        for group in self.groups.values():
+            for reader in group['readers'].values():
+                self._drain_queue(reader.own)
+
+
+    # shutdown a worker, it finishes its current job first
+    #   timeout: seconds to wait, then a process is terminated if terminate is True
+    #   returns True if the worker stopped
+    def shutdown(self, worker_id, timeout=None, terminate=True):
+        deadline = None if timeout is None else time() + timeout
+        result = self._stop([worker_id], deadline, terminate)
+        return worker_id not in result['alive']
+
+    # distinct work in queues the workers read from
+    def _work_in_coms(self):
+        result = []
+        for worker in self.workers.values():
+            if not any(worker['work_in'] is a for a in result):
+                result.append(worker['work_in'])
+        return result
+
+    # send shutdown to every worker at once, wake them and wait until deadline
+    def _stop(self, worker_ids, deadline, terminate):
+        for worker_id in worker_ids:
+            self._get_object(worker_id)['stopped'] = True     # not restarted by check_workers
+            self.write_in(worker_id, 'shutdown')        # send the shutdown command to the process or thread
+        for worker_id in worker_ids:
+            self._get_object(worker_id)['work_in'].wake()    # don't wait for the read timeout
+
+        result = {'stopped': [], 'terminated': [], 'alive': []}
+        for worker_id in worker_ids:
+            worker = self._get_object(worker_id)
+            process_or_thread = worker['object']
+
+            while process_or_thread.is_alive():
+                wait_time = 0.5
+                if deadline is not None:
+                    wait_time = min(wait_time, deadline - time())
+                    if wait_time <= 0:
+                        break
+                process_or_thread.join(wait_time)
+
+            if not process_or_thread.is_alive():
+                result['stopped'].append(worker_id)
+            elif worker['type'] in ('process', 'remote') and terminate:
+                process_or_thread.terminate()
+                process_or_thread.join(1)
+                if process_or_thread.is_alive():
+                    process_or_thread.kill()
+                    process_or_thread.join()
+                result['terminated'].append(worker_id)
+            else:
+                result['alive'].append(worker_id)    # threads cannot be stopped from outside
+
+        return result
+
+    # ask a worker to stop without waiting for it, reap() removes it once it has exited
+    #   the worker finishes its current job first
+    def retire(self, worker_id):
+        worker = self._get_object(worker_id)
+        if worker.get('retiring', False):
+            return
+
+        worker['retiring'] = True
+        worker['reader'] = self._remove_scheduled_worker(worker_id)    # stop routing new jobs to it
+        self.write_in(worker_id, 'shutdown')
+        worker['work_in'].wake()
 
-    # shutdown a worker
-    def shutdown(self, worker_id):
-        self.write_in(worker_id, 'shutdown')        # send the shutdown command to the process or thread
+    # remove retired workers that have exited and remote workers that disconnected, returns their ids
+    def reap(self):
+        result = []
+        for worker_id, worker in tuple(self.workers.items()):
+            if worker_id not in self.workers or worker['object'].is_alive():
+                continue    # reaped while handing over another worker's jobs, or still running
+            if worker.get('retiring', False) or worker['type'] == 'remote':
+                self._reap_worker(worker_id)
+                result.append(worker_id)
+
+        return result
+
+    def _reap_worker(self, worker_id):
         worker = self._get_object(worker_id)
-        process_or_thread = worker['object']
+        if not worker.get('retiring', False):
+            worker['reader'] = self._remove_scheduled_worker(worker_id)     # disconnected remote worker
+        del self.workers[worker_id]
+
+        # hand jobs left in the worker's own queue to the rest of its group
+        reader = worker.get('reader', None)
+        if reader is not None:
+            leftover = reader.own.read_many()
+            group = self.groups[worker['group']]
+            if leftover and group['ids']:
+                self.write_work_many(group['ids'][0], leftover)
+            elif leftover:
+                printLine(f'reap: worker [{worker_id}] left {len(leftover)} jobs with no worker to take them', level=WARNING)
+
+    # number of jobs waiting in the work in queue(s) that worker_id reads from
+    def get_work_in_depth(self, worker_id):
+        worker = self._get_object(worker_id)
+        group = self.groups.get(worker['group'], None)
+        if group is None:
+            return worker['work_in'].size()
+
+        return sum(a.size() for a in group['readers'].values())
+
+    # shutdown all workers at once
+    #   drain=False  queued jobs are discarded (channel='ring' leaves them in the worker's ring, only it reads
+    #                there), workers stop after their current job
+    #   drain=True   workers finish the queued jobs first
+    #   timeout      overall seconds for draining and stopping, processes still running after it are
+    #                terminated when terminate is True (threads cannot be, they are reported as alive)
+    #   returns {'stopped': [worker_id, ...], 'terminated': [...], 'alive': [...]}
+    def shutdown_all(self, drain=False, timeout=None, terminate=True):
+        deadline = None if timeout is None else time() + timeout
+        coms = self._work_in_coms()
+
+        if drain:
+            while any(a.size() > 0 for a in coms):
+                if deadline is not None and time() >= deadline:
+                    break
+                sleep(0.01)
+
+        # abort anything still queued
+        for com in coms:
+            self._drain_queue(com)
+
+        self._stop_spares(deadline)
+        self.stop_listening()
+        self.accept_remote_workers()
+        result = self._stop(tuple(self.workers.keys()), deadline, terminate)
+        self.release_all_payloads()
+        for com in (self.thread_queue_work_out, self.process_queue_work_out):
+            if com is not None:
+                com.close()     # the wakeup sockets of get_work_out_fileno
+        return result
+
+    # copy data into shared memory once, send the returned handle with write_work instead of the data
+    #   a job {'msg_id': .., 'msg': ..} written with write_work keeps its payloads until its last response is
+    #   read (read_work, read_work_many, slurp_work_out) or it is cancelled, then they are released
+    def share(self, data=None, size=None):
+        payload = SharedPayload.create(data, size)
+        self.payloads[payload.name] = payload
+        return payload
+
+    # free a payload from share() when its job is complete or abandoned
+    def release_payload(self, payload):
+        payload = self.payloads.pop(payload.name, payload)
+        payload.unlink()
+
+    # free the share() payloads of a job written with write_work
+    def release_job_payloads(self, msg_id):
+        for payload in self.job_payloads.pop(msg_id, ()):
+            self.release_payload(payload)
+
+    # remember which share() payloads each job carries
+    def _track_payloads(self, msgs):
+        for msg in msgs:
+            if isinstance(msg, dict) and msg.get('msg_id', None) is not None:
+                payloads = [a for a in find_payloads(msg.get('msg', None)) if a.name in self.payloads]
+                if payloads:
+                    self.job_payloads[msg['msg_id']] = payloads
+
+    def release_all_payloads(self):
+        self.job_payloads.clear()
+        for payload in tuple(self.payloads.values()):
+            self.release_payload(payload)
+
+
+# Worker pool that grows and shrinks with the depth of its work in queue
+#   pool = WorkerPool(p, start_background_worker, run_after_cb=app.after, min_workers=1, max_workers=12)
+#   worker_id = pool.get_worker()   # any live worker id, for write_work / BackgroundManager access
+#
+#   scale up:   depth > scale_up_depth, or the queue has not been empty for scale_up_wait seconds
+#   scale down: queue empty for idle_cooldown seconds, one worker is retired per cooldown
+#   the newest workers are retired first so the first worker (BackgroundManager access) stays
+class WorkerPool:
+    # worker_type = thread | process
+    def __init__(self, process_manager, target_func, run_after_cb=None, worker_type='thread',
+            work_queue_type='thread', min_workers=1, max_workers=4, scale_up_depth=10,
+            scale_up_wait=1.0, idle_cooldown=30.0, check_interval=500, on_scale=None, **kwargs):
+        if min_workers < 1 or max_workers < min_workers:
+            raise Exception('WorkerPool requires 1 <= min_workers <= max_workers')
+
+        self.process_manager = process_manager
+        self.target_func = target_func
+        self.run_after = run_after_cb
+        self.worker_type = worker_type
+        self.work_queue_type = work_queue_type
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_depth = scale_up_depth
+        self.scale_up_wait = scale_up_wait
+        self.idle_cooldown = idle_cooldown
+        self.check_interval = check_interval      # milliseconds between checks when run_after_cb is set
+        self.on_scale = on_scale        # on_scale(decision) called after each scaling decision
+        self.kwargs = kwargs            # passed to target_func
+
+        self.worker_ids = []            # oldest first
+        self.backlog_since = None       # when the queue was last seen going from empty to not empty
+        self.idle_since = time()
+        self.decisions = deque(maxlen=100)
+        self.shutdown_on = False
+
+        for i in range(min_workers):
+            self._spawn()
+
+        if self.run_after is not None:
+            self._run()
+
+    def _spawn(self):
+        kwargs = dict(self.kwargs)
+        kwargs.setdefault('worker_id', self.process_manager.worker_id)    # id the worker will be given
+
+        if self.worker_type == 'process':
+            worker_id = self.process_manager.create_process(self.target_func, **kwargs)
+        else:
+            worker_id = self.process_manager.create_thread(self.target_func,
+                work_queue_type=self.work_queue_type, **kwargs)
+
+        self.worker_ids.append(worker_id)
+        return worker_id
+
+    def _decide(self, action, depth, reason):
+        decision = {
+            'time': time(),
+            'action': action,       # scale_up | scale_down
+            'workers': len(self.worker_ids),
+            'depth': depth,
+            'reason': reason,
+        }
+        self.decisions.append(decision)
+        if self.on_scale is not None:
+            self.on_scale(decision)
+
+    def get_worker(self):
+        return self.worker_ids[0]
+
+    def get_size(self):
+        return len(self.worker_ids)
+
+    def get_depth(self):
+        return self.process_manager.get_work_in_depth(self.get_worker())
 
+    # evaluate the queue once and scale by at most one worker, returns the decision or None
+    def check(self):
+        self.process_manager.reap()
+
+        now = time()
+        depth = self.get_depth()
+        size = len(self.worker_ids)
+
+        if depth > 0:
+            self.idle_since = None
+            if self.backlog_since is None:
+                self.backlog_since = now
+        else:
+            self.backlog_since = None
+            if self.idle_since is None:
+                self.idle_since = now
+
+        if size < self.max_workers:
+            reason = None
+            if depth > self.scale_up_depth:
+                reason = f'depth {depth} > {self.scale_up_depth}'
+            elif self.scale_up_wait is not None and self.backlog_since is not None \
+                    and now - self.backlog_since >= self.scale_up_wait:
+                reason = f'queue not empty for {now - self.backlog_since:.2f}s'
+
+            if reason is not None:
+                self._spawn()
+                self.backlog_since = now    # give the new worker a full wait period before adding another
+                self._decide('scale_up', depth, reason)
+                return self.decisions[-1]
+
+        if size > self.min_workers and self.idle_since is not None \
+                and now - self.idle_since >= self.idle_cooldown:
+            worker_id = self.worker_ids.pop()   # newest first
+            self.process_manager.retire(worker_id)
+            self.idle_since = now
+            self._decide('scale_down', depth, f'idle for {self.idle_cooldown}s')
+            return self.decisions[-1]
+
+        return None
+
+    def get_stats(self):
+        return {
+            'workers': len(self.worker_ids),
+            'min_workers': self.min_workers,
+            'max_workers': self.max_workers,
+            'depth': self.get_depth(),
+            'decisions': list(self.decisions),
+        }
+
+    def _run(self):
+        if self.shutdown_on:
+            return
+
+        self.check()
+        self.run_after(self.check_interval, self._run)
+
+    # stop scaling, the workers are shut down with ProcessManagement.shutdown_all
+    def shutdown(self):
+        self.shutdown_on = True
+
+
+# concurrent.futures Executor over its own ProcessManagement and start_executor_worker workers
+#   with WorkerExecutor(max_workers=4, worker_type='process') as ex:
+#       futures = [ex.submit(func, a) for a in items]     # func must be picklable for processes
+#   in a tornado Loop: result = await loop.wrap_future(future)
+#   a thread worker marks the future running itself when it takes the job, so cancel() is exact, a process
+#   worker reports it with a 'started' response first, a cancel() that wins against that report still
+#   returns True and the result is dropped even though the call ran
+#   shutdown(wait=False) returns at once, the workers are stopped when the last pending future is done
+#   without shutdown() the executor is shut down at interpreter exit (pending futures finish first), its
+#   thread workers are daemon threads so they do not block the exit before that
+#   a process worker that dies breaks the executor: pending futures fail with BrokenExecutor, so does submit
+class WorkerExecutor(Executor):
+    # worker_type = thread | process
+    def __init__(self, max_workers=4, worker_type='thread', scheduler=None):
+        self.process_manager = ProcessManagement(scheduler=scheduler, daemon_threads=True)
+        self.worker_type = worker_type
+        self.futures = {}       # {msg_id: Future}
+        self.futures_lock = ThreadLock()
+        self.msg_ids = count()
+        self.shutdown_on = False
+        self.broken = None      # why the executor broke, see _check_workers
+
+        for i in range(max_workers):
+            if worker_type == 'process':
+                self.process_manager.create_process(start_executor_worker, worker_id=i)
+            else:
+                self.process_manager.create_thread(start_executor_worker, worker_id=i)
+        self.queue_access = next(iter(self.process_manager.workers))
+
+        # resolve futures as responses arrive
+        self.collector = Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+        # runs before multiprocessing joins its child processes at exit, so process workers are stopped too
+        atexit.register(self.shutdown)
+
+    def submit(self, fn, *args, **kwargs):
+        if self.broken is not None:
+            raise BrokenExecutor(self.broken)
+        if self.shutdown_on:
+            raise RuntimeError('cannot schedule new futures after shutdown')
+
+        future = Future()
+        call = (fn, args, kwargs)
+        if self.worker_type == 'process':
+            # pickle here so a bad argument fails this future instead of the queue's feeder thread
+            try:
+                call = pickle.dumps(call)
+            except Exception as e:
+                future.set_exception(e)
+                return future
+
+        msg_id = next(self.msg_ids)
+        with self.futures_lock:
+            self.futures[msg_id] = future
+
+        req_msg = {
+            'msg_id': msg_id,
+            'msg': call,
+        }
+        if self.worker_type != 'process':
+            req_msg['future'] = future      # the thread worker calls set_running_or_notify_cancel
+        self.process_manager.write_work(self.queue_access, req_msg)
+
+        return future
+
+    def _collect(self):
+        checked = time()
         while True:
-            process_or_thread.join(0.5)
-            if not process_or_thread.is_alive():
-                break
+            with self.futures_lock:
+                if self.shutdown_on and not self.futures:
+                    break
+
+            if time() - checked >= 0.5:
+                checked = time()
+                if self._check_workers():
+                    break
+
+            for res_msg in self.process_manager.read_work_many(self.queue_access, None, 0.5):
+                with self.futures_lock:
+                    if res_msg.get('started', False):
+                        future = self.futures.get(res_msg['msg_id'], None)
+                    else:
+                        future = self.futures.pop(res_msg['msg_id'], None)
+
+                if future is None or res_msg.get('cancelled', False):
+                    continue
+
+                if res_msg.get('started', False):
+                    future.set_running_or_notify_cancel()   # False if cancel() came first, the result is dropped
+                    continue
+
+                # a cancelled future keeps its state, the result is dropped
+                if future.done():
+                    continue
+
+                if res_msg.get('pickled', False):
+                    res_msg = pickle.loads(res_msg['msg'])
+
+                if 'error' in res_msg:
+                    future.set_exception(res_msg['error'])
+                else:
+                    future.set_result(res_msg['msg'])
+
+        self.process_manager.shutdown_all()
+
+    # a dead process worker takes its job with it, fail every pending future instead of waiting forever,
+    # returns True if the executor is broken
+    def _check_workers(self):
+        if self.worker_type != 'process':
+            return False
+
+        dead = [worker_id for worker_id, worker in self.process_manager.workers.items()
+            if not worker['object'].is_alive()]
+        if not dead:
+            return False
+
+        self.broken = 'process worker '+str(dead)+' died, the pending futures were failed'
+        with self.futures_lock:
+            futures = list(self.futures.values())
+            self.futures.clear()
+            self.shutdown_on = True
+
+        for future in futures:
+            if not future.done():
+                future.set_exception(BrokenExecutor(self.broken))
+        return True
+
+    # cancel_futures=True cancels the futures that have not started and takes their jobs off the queue
+    def shutdown(self, wait=True, cancel_futures=False):
+        if cancel_futures:
+            msg_ids = []
+            with self.futures_lock:
+                for msg_id, future in tuple(self.futures.items()):
+                    if future.cancel():
+                        del self.futures[msg_id]
+                        msg_ids.append(msg_id)
+            if msg_ids:
+                self.process_manager.cancel_work(self.queue_access, msg_ids)
+
+        atexit.unregister(self.shutdown)
+        self.shutdown_on = True
+        if wait:
+            self.collector.join()
+
+
+CANCELLED_MEMORY = 10000    # cancelled msg_ids a worker remembers
+
+STEAL_INTERVAL = 0.5    # seconds an idle work stealing worker waits before looking at its peers again
 
-    # shutdown all workers
-    def shutdown_all(self):
-        for worker_id in tuple(self.workers.keys()):
-            self.shutdown(worker_id)
+
+# how long an idle worker may block in wait_for_any, heartbeat: seconds between heartbeats or None
+def idle_timeout(work_queue_in, heartbeat=None):
+    timeout = heartbeat
+    if isinstance(work_queue_in, ScheduledCom) and work_queue_in.stealing:
+        timeout = STEAL_INTERVAL if timeout is None else min(timeout, STEAL_INTERVAL)
+    return timeout
+
+# Worker side handling of control commands other than 'shutdown', returns True if msg was one
+#   ('cancel', [msg_id, ...])   skip these jobs if this worker reads them (see ProcessManagement.cancel_work)
+def apply_command(msg, cancelled):
+    if isinstance(msg, tuple) and len(msg) == 2 and msg[0] == 'cancel':
+        for msg_id in msg[1]:
+            cancelled[msg_id] = True
+        while len(cancelled) > CANCELLED_MEMORY:
+            del cancelled[next(iter(cancelled))]    # forget the oldest
+        return True
+
+    return False
+
+
+# Why a worker should not run a job: 'cancelled', 'expired' (past its deadline) or None
+def skip_reason(req_msg, cancelled):
+    msg_id = req_msg.get('msg_id', None)
+    if msg_id in cancelled:
+        del cancelled[msg_id]
+        return 'cancelled'
+
+    deadline = req_msg.get('deadline', None)
+    if deadline is not None and time() > deadline:
+        return 'expired'
+
+    return None
 
 
 def start_worker(queues=None, worker_id=None):
@@ -414,71 +2516,398 @@ def start_worker(queues=None, worker_id=None):
 
     printLine(f'worker [{worker_id}] starting')
 
+    wait_coms = [a for a in (cmd_queue_in, work_queue_in) if a is not None]
+    cancelled = {}      # msg_ids to skip
     while True:
+        msg = None
         if work_queue_in != None:
-            msg = work_queue_in.read(0.5)     # read from the work and wait 1 second for message
-            if msg != None:
+            msg = work_queue_in.read()     # read from the work but don't wait
+            if isinstance(msg, dict) and msg.get('msg_id', None) in cancelled:
+                pass    # skipped, see apply_command
+            elif msg != None:
                 rand_sleep = randint(0, 1000) / 1000.0
                 #rand_sleep = randint(0, 5)
-                printLine(f'worker [{worker_id}]:', rand_sleep, msg)
+                if log_sink.level <= DEBUG:
+                    printLine(f'worker [{worker_id}]:', rand_sleep, msg, level=DEBUG)
                 sleep(rand_sleep)
-                work_queue_out.write('worker received work: '+ msg)
+                work_queue_out.write('worker received work: '+ str(msg))
 
-        msg = cmd_queue_in.read()   # check queue but don't wait
-        if msg == 'shutdown':
+        cmd = cmd_queue_in.read()   # check queue but don't wait
+        if cmd == 'shutdown':
             printLine('cmd: shutting down worker')
             break
-        elif msg != None:
-            printLine('cmd:', msg)
-            cmd_queue_out.write('worker cmd received: '+ msg)
-            printLine('cmd: message has been written: '+ msg)
+        elif apply_command(cmd, cancelled):
+            pass    # ('cancel', [msg_id, ...]) sent to every worker sharing the queue
+        elif cmd != None:
+            printLine('cmd:', cmd)
+            cmd_queue_out.write('worker cmd received: '+ str(cmd))
+            printLine('cmd: message has been written: '+ str(cmd))
+
+        if msg is None and cmd is None:
+            wait_for_any(wait_coms, idle_timeout(work_queue_in))     # sleep until work or a command arrives
 
     printLine('worker is shutdown')
 
 
+# Handlers for start_handler_worker keyed by message type (None is the default handler)
+#   registry = HandlerRegistry()
+#
+#   @registry.handler('resize')
+#   def resize(msg, context):       # context is what the worker's initializer returned
+#       return ...
+#
+#   p.create_process(start_handler_worker, handlers=registry, initializer=open_db, initargs=(path,))
+#   bg.add_job({'path': ..}, callback, msg_type='resize')
+#
+#   @registry.handler('lookup', batch=True)
+#   def lookup(msgs, context):      # the messages of up to batch_size queued jobs of this type
+#       return [...]                # one result per message, an Exception instance fails only that job
+class HandlerRegistry:
+    def __init__(self, handlers=None, batch_handlers=None):
+        self.handlers = dict(handlers or {})
+        self.batch_types = set()
+        for msg_type, func in (batch_handlers or {}).items():
+            self.register(msg_type, func, batch=True)
+
+    def register(self, msg_type, func, batch=False):
+        self.handlers[msg_type] = func
+        if batch:
+            self.batch_types.add(msg_type)
+        else:
+            self.batch_types.discard(msg_type)
+
+    # decorator form of register
+    def handler(self, msg_type=None, batch=False):
+        def wrap(func):
+            self.register(msg_type, func, batch)
+            return func
+        return wrap
+
+    # is the handler get(msg_type) returns a batch handler
+    def is_batch(self, msg_type):
+        if msg_type in self.handlers:
+            return msg_type in self.batch_types
+        return None in self.batch_types
+
+    def get(self, msg_type):
+        func = self.handlers.get(msg_type, None)
+        if func is None:
+            func = self.handlers.get(None, None)
+        if func is None:
+            raise Exception('no handler for message type ['+str(msg_type)+']')
+        return func
+
+
+# message type of a job, worker_msg['type'] (add_job msg_type) or a 'type' key in a dict message
+def job_type(req_msg):
+    msg_type = req_msg.get('type', None)
+    if msg_type is None and isinstance(req_msg.get('msg', None), dict):
+        msg_type = req_msg['msg'].get('type', None)
+    return msg_type
+
+
+# Worker loop that dispatches jobs {'msg_id': .., 'msg': .., 'type': ..} to registered handlers
+#   initializer(*initargs) runs once when the worker starts and its return value (a database
+#   connection, a loaded model, ...) is passed to every handler call, finalizer(context) runs on shutdown
+#   responds {'msg_id': .., 'msg': result} or {'msg_id': .., 'error': 'ExceptionType: text'}
+#   a job for a batch handler collects up to batch_size queued jobs, waiting at most batch_wait
+#   milliseconds for more, the handler runs once per message type and the responses are written as one batch
+class WorkerRuntime:
+    def __init__(self, queues, worker_id=None, handlers=None, initializer=None, initargs=(), finalizer=None,
+            batch_size=64, batch_wait=5):
+        self.work_queue_in = queues.get('work_in')
+        self.work_queue_out = queues.get('work_out')
+        self.cmd_queue_in = queues.get('in')
+        self.cmd_queue_out = queues.get('out')
+        self.worker_id = worker_id
+        self.manager_id = queues.get('worker_id', worker_id)    # the id job metrics are grouped by
+
+        self.registry = handlers if isinstance(handlers, HandlerRegistry) else HandlerRegistry(handlers)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.initializer = initializer
+        self.initargs = initargs
+        self.finalizer = finalizer
+        self.context = None
+        self.cancelled = {}     # msg_ids to skip
+        self.stopping = False   # shutdown came in while a stream was running
+
+        # ProcessManagement(supervise=True) listens for heartbeats and the job being run
+        self.health = queues.get('health', None)
+        self.heartbeat = queues.get('heartbeat', 1.0)
+        self.last_beat = 0.0
+
+        # an idle worker blocks on work and commands together, waking only for heartbeats
+        self.wait_coms = [a for a in (self.cmd_queue_in, self.work_queue_in) if a is not None]
+        self.wait_timeout = idle_timeout(self.work_queue_in, self.heartbeat if self.health is not None else None)
+
+    def run(self):
+        printLine(f'worker [{self.worker_id}] starting')
+
+        if self.initializer is not None:
+            self.context = self.initializer(*self.initargs)
+
+        try:
+            while True:
+                # Work Queue Requests
+                req_msg = None
+                if self.work_queue_in != None:
+                    req_msg = self.work_queue_in.read()
+                    if req_msg != None:
+                        if self.registry.batch_types and self.registry.is_batch(job_type(req_msg)):
+                            self.handle_batch(self.collect(req_msg))
+                        else:
+                            self.handle(req_msg)
+
+                # Direct Worker Request Queue
+                if self.stopping or self.check_commands():
+                    printLine('cmd: shutting down worker')
+                    break
+
+                self.beat()
+                if req_msg is None:
+                    wait_for_any(self.wait_coms, self.wait_timeout)
+        finally:
+            if self.finalizer is not None:
+                self.finalizer(self.context)
+
+        printLine('worker is shutdown')
+
+    # tell the supervisor this worker is alive, at most every heartbeat seconds
+    def beat(self):
+        if self.health is not None and time() - self.last_beat >= self.heartbeat:
+            self.last_beat = time()
+            self.health.beat()
+
+    # apply waiting commands without blocking, True on shutdown
+    def check_commands(self):
+        while True:
+            msg = self.cmd_queue_in.read()
+            if msg is None:
+                return False
+            if msg == 'shutdown':
+                return True
+            apply_command(msg, self.cancelled)
+
+    def handle(self, req_msg):
+        msg_id = req_msg.get('msg_id', None)
+
+        times = None
+        if 'enqueued' in req_msg:    # the manager keeps metrics
+            times = {'worker': self.manager_id, 'dequeued': time()}
+
+        reason = skip_reason(req_msg, self.cancelled)
+        if reason == 'expired':
+            self.work_queue_out.write({'msg_id': msg_id, 'expired': True})
+            return
+        elif reason is not None:
+            return
+
+        if times is not None:
+            times['started'] = time()
+        if self.health is not None:
+            self.health.started(msg_id)
+
+        try:
+            func = self.registry.get(job_type(req_msg))
+            result = func(req_msg.get('msg', None), self.context)
+        except Exception as e:
+            self.write_final({'msg_id': msg_id, 'error': f'{type(e).__name__}: {e}'}, times)
+            return
+
+        if isinstance(result, GeneratorType):
+            self.stream(msg_id, result, times)
+            return
+
+        self.write_final({
+            'msg_id': msg_id,
+            'msg': result,
+        }, times)
+
+    # up to batch_size jobs starting with first, waits at most batch_wait milliseconds for the rest
+    def collect(self, first):
+        batch = [first]
+        deadline = time() + self.batch_wait / 1000.0
+        while len(batch) < self.batch_size:
+            more = self.work_queue_in.read_many(self.batch_size - len(batch))
+            if more:
+                batch.extend(more)
+                continue
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            msg = self.work_queue_in.read(remaining)
+            if msg is None:
+                break   # nothing came (or a wake up for a command)
+            batch.append(msg)
+
+        return batch
+
+    # run collected jobs, batch handler types with one call each, and write their responses at once
+    #   jobs of other types in the batch are handled one by one
+    def handle_batch(self, req_msgs):
+        responses = []
+        groups = {}     # {msg_type: [(req_msg, times)]}
+        for req_msg in req_msgs:
+            msg_type = job_type(req_msg)
+            if not self.registry.is_batch(msg_type):
+                self.handle(req_msg)
+                continue
+
+            times = None
+            if 'enqueued' in req_msg:
+                times = {'worker': self.manager_id, 'dequeued': time()}
+
+            reason = skip_reason(req_msg, self.cancelled)
+            if reason == 'expired':
+                responses.append({'msg_id': req_msg.get('msg_id', None), 'expired': True})
+            elif reason is None:
+                groups.setdefault(msg_type, []).append((req_msg, times))
+
+        for msg_type, jobs in groups.items():
+            if self.health is not None:
+                self.health.started(jobs[0][0].get('msg_id', None))     # only the first job is retried
+
+            started = time()
+            try:
+                results = self.registry.get(msg_type)([a[0].get('msg', None) for a in jobs], self.context)
+                if len(results) != len(jobs):
+                    raise Exception(f'batch handler returned {len(results)} results for {len(jobs)} jobs')
+            except Exception as e:
+                results = [e] * len(jobs)
+            finished = time()
+
+            for (req_msg, times), result in zip(jobs, results):
+                res_msg = {'msg_id': req_msg.get('msg_id', None)}
+                if isinstance(result, Exception):
+                    res_msg['error'] = f'{type(result).__name__}: {result}'
+                else:
+                    res_msg['msg'] = result
+                if times is not None:
+                    times['started'] = started
+                    times['finished'] = finished
+                    res_msg['times'] = times
+                responses.append(res_msg)
+
+        if responses:
+            self.work_queue_out.write_many(responses)
+        if self.health is not None:
+            self.health.finished()
+
+    # last response of a job, carries the worker timestamps of a timed job
+    def write_final(self, res_msg, times):
+        if times is not None:
+            times['finished'] = time()
+            res_msg['times'] = times
+        self.work_queue_out.write(res_msg)
+        if self.health is not None:
+            self.health.finished()
+
+
+    # send each chunk as it is produced: {'msg_id', 'msg': chunk, 'seq': n} ... {'msg_id', 'seq': n, 'end': True}
+    #   commands are checked between chunks so a cancelled stream stops early
+    def stream(self, msg_id, chunks, times=None):
+        seq = 0
+        try:
+            for chunk in chunks:
+                self.work_queue_out.write({'msg_id': msg_id, 'msg': chunk, 'seq': seq})
+                seq += 1
+                self.beat()
+
+                if not self.stopping and self.check_commands():
+                    self.stopping = True    # finish the stream, then shut down
+                if msg_id in self.cancelled:
+                    del self.cancelled[msg_id]
+                    return
+        except Exception as e:
+            self.write_final({'msg_id': msg_id, 'error': f'{type(e).__name__}: {e}'}, times)
+            return
+        finally:
+            chunks.close()
+
+        self.write_final({'msg_id': msg_id, 'seq': seq, 'end': True}, times)
+
+
+# batch_handlers={msg_type: func(msgs, context)} adds batch handlers to a handlers dict (see HandlerRegistry)
+def start_handler_worker(queues=None, worker_id=None, handlers=None, initializer=None, initargs=(), finalizer=None,
+        batch_handlers=None, batch_size=64, batch_wait=5):
+    if batch_handlers:
+        registry = handlers if isinstance(handlers, HandlerRegistry) else HandlerRegistry(handlers)
+        for msg_type, func in batch_handlers.items():
+            registry.register(msg_type, func, batch=True)
+        handlers = registry
+    WorkerRuntime(queues, worker_id, handlers, initializer, initargs, finalizer, batch_size, batch_wait).run()
+
+
+# Echo with a random delay (request payload is a string)
+def echo_handler(msg, context):
+    rand_sleep = randint(0, 1000) / 1000.0
+    sleep(rand_sleep)
+    return 'worker echo: ' + msg
+
+
 # This is a test function for the BackgroundManager
 #   (basic request wrapped in dicts for testing)
 def start_background_worker(queues=None, worker_id=None):
-    #printLine('start_worker', queues)
+    start_handler_worker(queues, worker_id, handlers={None: echo_handler})
+
+
+# Worker loop for WorkerExecutor, runs {'msg_id': .., 'msg': (fn, args, kwargs)}
+#   responds with {'msg_id': .., 'msg': result} or {'msg_id': .., 'error': exception}
+#   over process queues the call and the response are pickled by the executor and the worker
+#   so a failure is reported on the future instead of being lost in the queue's feeder thread
+#   a thread job carries its 'future', a process job is announced with {'msg_id': .., 'started': True}
+def start_executor_worker(queues=None, worker_id=None):
     work_queue_in = queues.get('work_in')
     work_queue_out = queues.get('work_out')
     cmd_queue_in = queues.get('in')
-    cmd_queue_out = queues.get('out')
-
-    printLine(f'worker [{worker_id}] starting')
+    wait_timeout = idle_timeout(work_queue_in)
+    cancelled = {}      # msg_ids taken off the queue by WorkerExecutor.shutdown(cancel_futures=True)
 
     while True:
-        # Work Queue Requests
-        if work_queue_in != None:
-            req_msg = work_queue_in.read(0.5)     # read from the work and wait 1 second for message
-            if req_msg != None:
-                printLine(f'worker [{worker_id}]:', req_msg)
-
-                request_msg_id = req_msg['msg_id']
-                request_payload = req_msg['msg']    # for testing assume a string
+        req_msg = work_queue_in.read()
+        if req_msg != None and skip_reason(req_msg, cancelled) is None:
+            run_executor_job(req_msg, work_queue_out)
 
-                # Executing Processor/Router here
-                rand_sleep = randint(0, 1000) / 1000.0
-                sleep(rand_sleep)
-                result = 'worker echo: ' + request_payload
-
-                response_msg = {
-                    'msg_id': request_msg_id,
-                    'msg': result,
-                }
-
-                work_queue_out.write(response_msg)
-
-        # Direct Worker Request Queue
         msg = cmd_queue_in.read()   # check queue but don't wait
         if msg == 'shutdown':
-            printLine('cmd: shutting down worker')
             break
+        apply_command(msg, cancelled)
+        if req_msg is None and msg is None:
+            wait_for_any([cmd_queue_in, work_queue_in], wait_timeout)
+
+
+# run one WorkerExecutor job and write its response
+def run_executor_job(req_msg, work_queue_out):
+    future = req_msg.get('future', None)
+    if future is not None and not future.set_running_or_notify_cancel():
+        work_queue_out.write({'msg_id': req_msg['msg_id'], 'cancelled': True})
+        return
+    if future is None:
+        work_queue_out.write({'msg_id': req_msg['msg_id'], 'started': True})
+
+    call = req_msg['msg']
+    pickled = isinstance(call, bytes)
+
+    result = {}
+    try:
+        fn, args, kwargs = pickle.loads(call) if pickled else call
+        result['msg'] = fn(*args, **kwargs)
+    except BaseException as e:
+        result['error'] = e
+
+    response_msg = {'msg_id': req_msg['msg_id']}
+    if pickled:
+        try:
+            response_msg['msg'] = pickle.dumps(result)
+        except Exception as e:
+            response_msg['msg'] = pickle.dumps({'error': Exception(f'response not picklable: {e!r}')})
+        response_msg['pickled'] = True
+    else:
+        response_msg.update(result)
 
-    printLine('worker is shutdown')
-
-
-
+    work_queue_out.write(response_msg)
 
 if __name__ == '__main__':
     # m = MessageStore()
@@ -489,6 +2918,8 @@ if __name__ == '__main__':
     # print(m.get(msg_id))
     # quit()
 
+    log_sink.level = DEBUG      # show every job
+
     p = ProcessManagement()
     worker_ids = []
     for a in range(12):
@@ -0,0 +1,269 @@
+# Shared memory ring channel for ProcessManagement(channel='ring')
+from threading import RLock as ThreadLock
+from queue import Full as QueueFull
+
+import multiprocessing
+from multiprocessing.connection import wait as wait_objects
+
+import pickle
+from time import time, sleep
+import os
+import platform
+
+from intounknown_lib.lib_coms import ThreadCom, WakeSignal, get_codec
+
+
+# the CPU keeps stores in order and loads in order, which RingCom depends on (see RingCom)
+LOCAL_FENCE = platform.machine().lower() in ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+
+
+# Single producer single consumer channel between two processes over a shared memory ring
+#   (the manager -> worker pairs of create_process, see ProcessManagement(channel='ring'))
+#   frames are a 4 byte length, a kind byte and the pickle, the writer copies a frame into the ring and
+#   moves head, the reader copies it out and moves tail, no feeder thread, pipe write or lock per message
+#   a blocked reader sets waiting and sleeps on a pipe, the writer only rings that pipe when waiting is set
+#   capacity: bytes in the ring, a message has to fit, overflow block | timeout | reject when it is full
+#     (block and timeout poll for room, drop_oldest is not possible as only the reader moves tail)
+#   only the one reading process reads, nothing is shared between the processes but the counters, the ring
+#   and the bell, so a process killed at any point cannot leave the other side waiting on a lock
+#   (writes take a thread lock for the threads of the writing process)
+#   x86 only (LOCAL_FENCE): the reader sees the frame bytes before the head that publishes them because the
+#   CPU neither reorders the writer's stores nor the reader's loads, the lock taken between publishing head
+#   and checking waiting (and between setting waiting and checking head) is an atomic instruction that orders
+#   the store before the load so a wakeup is not lost, Python has no release/acquire barriers for machines
+#   that reorder more (ARM), there the constructor raises and channel='queue' has to be used
+class RingCom(ThreadCom):
+    HEAD, TAIL, WRITTEN, READ, WAITING = range(5)
+    FRAME = 5       # length (4 bytes) and kind (1 byte)
+
+    def __init__(self, capacity=1 << 20, overflow='block', put_timeout=None, ctx=None, codec=None):
+        if overflow not in ('block', 'timeout', 'reject'):
+            raise Exception('overflow ['+str(overflow)+'] not supported by RingCom')
+        if not LOCAL_FENCE:
+            raise Exception('RingCom needs an x86 CPU, not ['+platform.machine()+']')
+
+        ctx = multiprocessing.get_context() if ctx is None else ctx
+        self.capacity = capacity
+        self.maxsize = 0
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.codec = get_codec(codec)
+        self.counters = ctx.RawArray('q', 5)
+        self.ring = ctx.RawArray('B', capacity)
+        self.bell_reader, self.bell_writer = ctx.Pipe(duplex=False)
+        if os.name == 'posix':
+            os.set_blocking(self.bell_writer.fileno(), False)     # a full pipe already wakes the reader
+        self._attach()
+
+    def _attach(self):
+        self.buf = memoryview(self.ring).cast('B')
+        self.write_lock = ThreadLock()
+        self.fence = ThreadLock()
+        self.wakeup = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['buf']
+        del state['write_lock']
+        del state['fence']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def _frame(self, msg):
+        if self.codec is None or isinstance(msg, WakeSignal):
+            data = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
+            kind = 0
+        else:
+            data, extra = self.codec.encode(msg)
+            kind = 1
+            if extra is not None:
+                data = pickle.dumps((data, extra), protocol=pickle.HIGHEST_PROTOCOL)
+                kind = 2
+        return len(data).to_bytes(4, 'little') + bytes((kind,)) + data
+
+    def _unframe(self, kind, data):
+        if kind == 0:
+            return pickle.loads(data)
+        if kind == 1:
+            return self.codec.decode(data, None)
+        return self.codec.decode(*pickle.loads(data))
+
+    # wait until n bytes are free, called with the write lock held
+    def _reserve(self, n):
+        if n > self.capacity:
+            raise Exception(f'message of {n} bytes does not fit a ring of {self.capacity} bytes')
+
+        counters = self.counters
+        deadline = None
+        pause = 0.0001
+        while self.capacity - (counters[self.HEAD] - counters[self.TAIL]) < n:
+            if self.overflow == 'reject':
+                raise QueueFull('ring is full')
+            if self.overflow == 'timeout':
+                if deadline is None:
+                    deadline = time() + self.put_timeout
+                if time() >= deadline:
+                    raise QueueFull(f'ring still full after {self.put_timeout}s')
+            sleep(pause)
+            pause = min(pause * 2, 0.005)
+
+    def _put(self, frame):
+        head = self.counters[self.HEAD]
+        n = len(frame)
+        pos = head % self.capacity
+        first = min(n, self.capacity - pos)
+        self.buf[pos:pos + first] = frame[:first]
+        if first < n:
+            self.buf[:n - first] = frame[first:]     # wraps around
+        self.counters[self.WRITTEN] += 1
+        with self.fence:
+            self.counters[self.HEAD] = head + n
+
+    def _copy_out(self, start, n):
+        pos = start % self.capacity
+        first = min(n, self.capacity - pos)
+        if first == n:
+            return bytes(self.buf[pos:pos + n])
+        return bytes(self.buf[pos:]) + bytes(self.buf[:n - first])
+
+    # (True, msg) or (False, None) when the ring is empty
+    #   tail moves after the frame is decoded, a reader killed on the way leaves the frame for the next one
+    def _take(self):
+        counters = self.counters
+        tail = counters[self.TAIL]
+        if counters[self.HEAD] == tail:
+            return False, None
+        header = self._copy_out(tail, self.FRAME)
+        n = int.from_bytes(header[:4], 'little')
+        start = (tail + self.FRAME) % self.capacity
+        if header[4] == 0 and start + n <= self.capacity:
+            msg = pickle.loads(self.buf[start:start + n])     # straight from the ring, before tail moves
+        else:
+            msg = self._unframe(header[4], self._copy_out(tail + self.FRAME, n))
+        counters[self.READ] += 1
+        counters[self.TAIL] = tail + self.FRAME + n
+        return True, msg
+
+    def _ring_bell(self):
+        waiting = self.counters[self.WAITING]
+        if waiting:
+            if waiting == 1:
+                self.counters[self.WAITING] = 0     # one ring per wait, fileno() keeps it set (2)
+            self._send_bell()
+
+    def _send_bell(self):
+        try:
+            self.bell_writer.send_bytes(b'')
+        except BlockingIOError:
+            pass
+
+    def _read_raw(self, timeout=0):
+        deadline = None
+        while True:
+            found, msg = self._take()
+            if found:
+                return msg
+            if timeout == 0:
+                return None
+
+            remaining = None
+            if timeout is not None:
+                if deadline is None:
+                    deadline = time() + timeout
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return None
+
+            if wait_objects([self.waitable()], remaining):
+                self.clear_wakeup()
+
+    def read_many(self, max_count=None, timeout=0):
+        msg = self.read(timeout)
+        if msg is None:
+            return []
+
+        result = [msg]
+        while max_count is None or len(result) < max_count:
+            found, msg = self._take()
+            if not found or isinstance(msg, WakeSignal):
+                break
+            result.append(msg)
+
+        return result
+
+    def write(self, msg, priority=None):
+        frame = self._frame(msg)
+        with self.write_lock:
+            self._reserve(len(frame))
+            self._put(frame)
+            self._ring_bell()
+        return None
+
+    def write_many(self, msgs, priority=None):
+        if not msgs:
+            return None
+
+        frames = [self._frame(a) for a in msgs]
+        with self.write_lock:
+            for frame in frames:
+                self._reserve(len(frame))
+                self._put(frame)
+            self._ring_bell()
+        return None
+
+    # best effort, a full ring already has something for the reader
+    def wake(self):
+        frame = self._frame(WakeSignal())
+        with self.write_lock:
+            if self.capacity - (self.counters[self.HEAD] - self.counters[self.TAIL]) >= len(frame):
+                self._put(frame)
+            self._ring_bell()
+
+    def size(self):
+        return self.counters[self.WRITTEN] - self.counters[self.READ]
+
+    def is_empty(self):
+        return self.counters[self.HEAD] == self.counters[self.TAIL]
+
+    # less than 1/16 of the ring is free
+    def is_full(self):
+        return self.capacity - (self.counters[self.HEAD] - self.counters[self.TAIL]) < self.capacity // 16
+
+    # frames cannot be taken out of the middle of the ring, workers skip cancelled jobs instead
+    def remove(self, predicate):
+        return []
+
+    # ready when a message is written, waiting is set until clear_wakeup (rings right away if not empty)
+    def waitable(self):
+        if self.counters[self.WAITING] == 0:
+            self.counters[self.WAITING] = 1
+        with self.fence:
+            pass
+        if not self.is_empty():
+            self._send_bell()
+        return self.bell_reader
+
+    # for event loops, every write rings the pipe from now on
+    def fileno(self):
+        self.counters[self.WAITING] = 2
+        with self.fence:
+            pass
+        if not self.is_empty():
+            self._send_bell()
+        return self.bell_reader.fileno()
+
+    def clear_wakeup(self):
+        if self.counters[self.WAITING] == 1:
+            self.counters[self.WAITING] = 0
+        while self.bell_reader.poll():
+            self.bell_reader.recv_bytes()
+
+    # one reader, it waits on the bell
+    def watch(self, waiter):
+        return self.waitable()
+
+    def unwatch(self, waiter):
+        self.clear_wakeup()
@@ -0,0 +1,277 @@
+# Socket transport for remote workers, see ProcessManagement.listen and remote_worker.py
+from threading import Thread
+from threading import RLock as ThreadLock
+from threading import Condition
+from multiprocessing.connection import Client
+
+import socket
+import os
+
+from intounknown_lib.lib_logging import printLine, WARNING
+from intounknown_lib.lib_coms import ThreadCom, WakeSignal, MessageBatch
+
+
+# Named message channels over one socket connection (TCP or Unix) for workers on other hosts
+#   frames are (channel, msg) sent with multiprocessing.connection, a reader thread puts each one in its
+#   channel's ThreadCom inbox (or calls the channel's handler), the handshake checks authkey but
+#   messages are pickles so only accept workers from trusted hosts
+class SocketConnection:
+    def __init__(self, conn, on_close=None):
+        self.conn = conn
+        self.on_close = on_close
+        self.send_lock = ThreadLock()
+        self.inbox_lock = ThreadLock()
+        self.inboxes = {}       # {channel: ThreadCom}
+        self.handlers = {}      # {channel: func(msg)} run on the reader thread instead of an inbox
+        self.closed = False
+        self.reader = Thread(target=self._read_loop, daemon=True)
+
+    # address = (host, port) for TCP or a path for a Unix socket
+    @classmethod
+    def connect(cls, address, authkey=None):
+        return cls(Client(address, authkey=authkey))
+
+    def start(self):
+        self.reader.start()
+
+    def channel(self, name, on_read=None):
+        return SocketCom(self, name, on_read)
+
+    def inbox(self, channel):
+        with self.inbox_lock:
+            com = self.inboxes.get(channel, None)
+            if com is None:
+                com = ThreadCom()
+                self.inboxes[channel] = com
+            return com
+
+    # raises OSError or EOFError once the connection is closed
+    def send(self, channel, msg):
+        with self.send_lock:
+            self.conn.send((channel, msg))
+
+    def _read_loop(self):
+        try:
+            while True:
+                channel, msg = self.conn.recv()
+                handler = self.handlers.get(channel, None)
+                if handler is not None:
+                    handler(msg)
+                elif isinstance(msg, MessageBatch):
+                    self.inbox(channel).write_many(list(msg))
+                else:
+                    self.inbox(channel).write(msg)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self.send_lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+
+        with self.inbox_lock:
+            inboxes = list(self.inboxes.values())
+        for com in inboxes:
+            com.wake()      # readers blocked on a closed connection return
+
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def is_alive(self):
+        return not self.closed
+
+    def join(self, timeout=None):
+        self.reader.join(timeout)
+
+
+# unblock a thread reading conn, closing the descriptor alone does not wake a blocked read on Linux
+def abort_connection(conn):
+    try:
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+    except (OSError, ValueError):
+        conn.close()    # closed already, or a handle os.dup cannot copy (Windows)
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+# ThreadCom interface over one channel of a SocketConnection
+#   read/read_many/size use the local inbox, write/write_many send to the other side
+#   on_read(msg) runs for every message read (the remote worker asks for the next job with it)
+class SocketCom:
+    def __init__(self, connection, channel, on_read=None):
+        self.connection = connection
+        self.channel = channel
+        self.on_read = on_read
+        self.inbox = connection.inbox(channel)
+
+    def read(self, timeout=0):
+        msg = self._read_raw(timeout)
+        if isinstance(msg, WakeSignal):
+            return None
+        return msg
+
+    def _read_raw(self, timeout=0):
+        msg = self.inbox._read_raw(timeout)
+        if msg is not None and not isinstance(msg, WakeSignal) and self.on_read is not None:
+            self.on_read(msg)
+        return msg
+
+    def read_many(self, max_count=None, timeout=0):
+        msgs = self.inbox.read_many(max_count, timeout)
+        if self.on_read is not None:
+            for msg in msgs:
+                self.on_read(msg)
+        return msgs
+
+    def write(self, msg, priority=None):
+        self.connection.send(self.channel, msg)
+        return None
+
+    # one frame for the whole list
+    def write_many(self, msgs, priority=None):
+        if msgs:
+            self.connection.send(self.channel, MessageBatch(msgs))
+        return None
+
+    def size(self):
+        return self.inbox.size()
+
+    def is_empty(self):
+        return self.inbox.is_empty()
+
+    def is_full(self):
+        return False
+
+    def wake(self):
+        self.inbox.wake()
+
+    def remove(self, predicate):
+        return self.inbox.remove(predicate)
+
+    def waitable(self):
+        return self.inbox.waitable()
+
+    def fileno(self):
+        return self.inbox.fileno()
+
+    def clear_wakeup(self):
+        self.inbox.clear_wakeup()
+
+    def watch(self, waiter):
+        return self.inbox.watch(waiter)
+
+    def unwatch(self, waiter):
+        self.inbox.unwatch(waiter)
+
+
+# Manager side of a worker connected with run_remote_worker, stands in for its thread or process object
+#   the worker asks for a job each time it takes one ('pull' frames), the pump sends at most `prefetch`
+#   jobs ahead from the work in queue and responses go straight onto the work out queue
+#   jobs sent but not answered are put back on the work in queue if the connection drops
+class RemoteWorker:
+    def __init__(self, connection, hello):
+        self.connection = connection
+        self.host = hello.get('host', None)
+        self.pid = hello.get('pid', None)
+        self.credit = max(1, int(hello.get('prefetch', 1)))
+        self.credit_cond = Condition(ThreadLock())
+        self.in_flight = {}     # {msg_id: job} sent and not answered
+        self.work_in = None
+        self.work_out = None
+        self.worker_id = None
+        self.on_lost = None     # on_lost(link) after the connection closed and its jobs were requeued
+        self.pump = Thread(target=self._pump, daemon=True)
+
+    def start(self, work_in, work_out):
+        self.work_in = work_in
+        self.work_out = work_out
+        self.connection.handlers['work_out'] = self._on_response
+        self.connection.handlers['pull'] = self._on_pull
+        self.connection.on_close = self._on_close
+        self.connection.start()
+        self.pump.start()
+
+    def _pump(self):
+        while self.connection.is_alive():
+            with self.credit_cond:
+                while self.credit <= 0 and self.connection.is_alive():
+                    self.credit_cond.wait(0.5)
+            if not self.connection.is_alive():
+                break
+
+            msg = self.work_in._read_raw(0.5)
+            if msg is None:
+                continue
+
+            msg_id = msg.get('msg_id', None) if isinstance(msg, dict) else None
+            if msg_id is not None:
+                self.in_flight[msg_id] = msg
+            try:
+                self.connection.send('work_in', msg)
+            except (EOFError, OSError):
+                # _on_close may have requeued the job already, whoever takes it out of in_flight writes it
+                if msg_id is not None:
+                    if self.in_flight.pop(msg_id, None) is not None:
+                        self.work_in.write(msg)
+                elif not isinstance(msg, WakeSignal):
+                    self.work_in.write(msg)     # not in in_flight, only this thread has it
+                break
+
+            if not isinstance(msg, WakeSignal):
+                with self.credit_cond:
+                    self.credit -= 1
+
+    def _on_pull(self, count):
+        with self.credit_cond:
+            self.credit += count
+            self.credit_cond.notify()
+
+    def _on_response(self, msg):
+        msgs = list(msg) if isinstance(msg, MessageBatch) else [msg]
+        for res_msg in msgs:
+            # the last message of a job (chunks of a stream carry 'seq' until the 'end' message)
+            if isinstance(res_msg, dict) and ('seq' not in res_msg or res_msg.get('end', False)):
+                self.in_flight.pop(res_msg.get('msg_id', None), None)
+            if isinstance(res_msg, dict) and isinstance(res_msg.get('times', None), dict):
+                res_msg['times']['worker'] = self.worker_id     # metrics use the manager's id, not the remote one
+        self.work_out.write_many(msgs)
+
+    def _on_close(self, connection):
+        lost = []
+        for msg_id in list(self.in_flight):
+            msg = self.in_flight.pop(msg_id, None)      # the pump may take one back at the same time
+            if msg is not None:
+                lost.append(msg)
+        if lost:
+            printLine(f'remote worker {self.host}:{self.pid} disconnected, {len(lost)} jobs requeued', level=WARNING)
+            self.work_in.write_many(lost)
+        with self.credit_cond:
+            self.credit_cond.notify()
+
+        if self.on_lost is not None:
+            self.on_lost(self)
+
+    def is_alive(self):
+        return self.connection.is_alive() or self.pump.is_alive()
+
+    def join(self, timeout=None):
+        self.connection.join(timeout)
+        self.pump.join(timeout)
+
+    def terminate(self):
+        self.connection.close()
+
+    def kill(self):
+        self.connection.close()
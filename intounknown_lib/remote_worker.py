@@ -0,0 +1,91 @@
+# Remote Worker - run ProcessManagement workers on another host
+#
+#   manager:  address = p.listen(('0.0.0.0', 6000), authkey=b'secret')
+#   worker:   python -m intounknown_lib.remote_worker 10.0.0.5:6000 --authkey secret --workers 4
+#             python -m intounknown_lib.remote_worker /tmp/workers.sock --target mypackage.jobs:start_worker
+#
+# each worker is a process with its own connection, the manager tracks it like a local worker
+#
+import argparse
+import importlib
+from multiprocessing import Process
+import socket
+import os
+
+from intounknown_lib.lib_processing import start_background_worker
+from intounknown_lib.lib_transport import SocketConnection
+from intounknown_lib.lib_logging import log_sink
+
+
+# worker side of ProcessManagement.listen, runs target_func with queues that talk to the manager
+#   main() below starts these from the command line
+def run_remote_worker(address, target_func=None, authkey=None, prefetch=2, **kwargs):
+    if target_func is None:
+        target_func = start_background_worker
+
+    connection = SocketConnection.connect(address, authkey)
+    connection.send('hello', {'host': socket.gethostname(), 'pid': os.getpid(), 'prefetch': prefetch})
+
+    def pull(msg):
+        connection.send('pull', 1)
+
+    queues = {
+        'work_in': connection.channel('work_in', on_read=pull),
+        'work_out': connection.channel('work_out'),
+        'in': connection.channel('in'),
+        'out': connection.channel('out'),
+    }
+    connection.on_close = lambda c: queues['in'].inbox.write('shutdown')     # manager went away
+    connection.start()
+
+    try:
+        target_func(queues=queues, **kwargs)
+    finally:
+        connection.close()
+        log_sink.flush()    # atexit does not run when this is a multiprocessing child
+
+
+# host:port for TCP, anything else is a Unix socket path
+def parse_address(text):
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return text
+
+
+# module.path:function
+def load_target(text):
+    module_name, sep, func_name = text.partition(':')
+    if not sep:
+        raise Exception('target ['+text+'] should look like module.path:function')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Connect workers to a ProcessManagement.listen address')
+    parser.add_argument('address', help='host:port or a Unix socket path')
+    parser.add_argument('--target', default='intounknown_lib.lib_processing:start_background_worker')
+    parser.add_argument('--authkey', default=None, help='shared secret, required for host:port')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=2, help='jobs sent ahead to each worker')
+    args = parser.parse_args()
+
+    address = parse_address(args.address)
+    if isinstance(address, tuple) and args.authkey is None:
+        parser.error('--authkey is required for a TCP address')
+    target_func = load_target(args.target)
+    authkey = args.authkey.encode() if args.authkey is not None else None
+
+    processes = []
+    for a in range(args.workers):
+        p = Process(target=run_remote_worker, args=(address, target_func, authkey, args.prefetch),
+            kwargs={'worker_id': a})
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()
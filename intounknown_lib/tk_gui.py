@@ -307,6 +307,7 @@ class EnhancedListbox(tk.Frame):
     def __init__(self, parent, txt, values=None, onchange=None, label_args=None, inputs_args=None, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
         self.onchange = onchange
+        self.values = []
         input_args = inputs_args or {}
         label_args = label_args or {}
         self.config(padx=10, pady=10)
@@ -365,6 +366,23 @@ class EnhancedListbox(tk.Frame):
         self.list_var.set(text_val)
         self.listbox.see(0)
 
+    # append rows without rebuilding the list, values = [(lookup, name), ...]
+    def add_options(self, values):
+        match_quote_re = re.compile(r'[\"]')
+
+        self.values = list(self.values)
+        for row in values:
+            self.values.append(row)
+            self.listbox.insert(tk.END, match_quote_re.sub("'", str(row[1])))
+
+    # remove the rows with these lookups
+    def remove_options(self, lookups):
+        lookups = set(lookups)
+        for idx in range(len(self.values) - 1, -1, -1):
+            if self.values[idx][0] in lookups:
+                del self.values[idx]
+                self.listbox.delete(idx)
+
     def set(self, value):
         self.clear()
 
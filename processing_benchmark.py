@@ -0,0 +1,211 @@
+# Processing Benchmark - push jobs through ProcessManagement workers and measure throughput and latency
+#
+#   python processing_benchmark.py --quick                              small matrix, prints a table
+#   python processing_benchmark.py --output results.json                 full matrix saved as json
+#   python processing_benchmark.py --baseline results.json               run again and compare with the saved run
+#
+# every case runs `--jobs` jobs through one transport with a worker count, payload size and handler kind
+#   transport   thread (thread workers on thread queues) | process (process workers on process queues)
+#   payload     bytes sent to the worker and echoed back
+#   kind        cpu (busy loop of --cpu-loops iterations) | io (sleep of --io-sleep milliseconds)
+#   codec       --codecs pickle,pickle5,marshal compares serialization of the process queues (default: none)
+#
+import argparse
+import json
+import os
+import platform
+import sys
+import multiprocessing
+from time import time, sleep
+
+from intounknown_lib.lib_processing import ProcessManagement, start_handler_worker
+from intounknown_lib.lib_logging import log_sink, WARNING
+
+
+def cpu_handler(msg, context):
+    total = 0
+    for i in range(msg['loops']):
+        total += i * i
+    return msg['payload']
+
+
+def io_handler(msg, context):
+    sleep(msg['sleep'])
+    return msg['payload']
+
+
+HANDLERS = {'cpu': cpu_handler, 'io': io_handler}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_case(transport, workers, payload_size, kind, jobs, cpu_loops, io_sleep, warmup, codec=None):
+    p = ProcessManagement(codec=codec)
+    worker_ids = []
+    for a in range(workers):
+        if transport == 'thread':
+            worker_ids.append(p.create_thread(start_handler_worker, handlers=HANDLERS))
+        else:
+            worker_ids.append(p.create_process(start_handler_worker, handlers=HANDLERS))
+    first_id = worker_ids[0]
+
+    payload = b'x' * payload_size
+    msg = {'payload': payload, 'loops': cpu_loops, 'sleep': io_sleep / 1000.0}
+
+    def push(count):
+        sent = {}
+        start = time()
+        for msg_id in range(count):
+            sent[msg_id] = time()
+            p.write_work(first_id, {'msg_id': msg_id, 'msg': msg, 'type': kind})
+
+        latencies = []
+        while len(latencies) < count:
+            for res_msg in p.read_work_many(first_id, None, 0.5):
+                if res_msg is None or res_msg.get('msg_id', None) not in sent:
+                    continue
+                latencies.append(time() - sent.pop(res_msg['msg_id']))
+            if time() - start > 600:
+                raise Exception('benchmark case did not finish in 600 seconds')
+        return time() - start, latencies
+
+    try:
+        push(warmup)    # start up workers and fill caches before timing
+        seconds, latencies = push(jobs)
+        codec_stats = p.get_codec_stats() if codec is not None else None
+    finally:
+        p.shutdown_all(timeout=5)
+
+    case = f'{transport}/{kind}/{workers}w/{payload_size}b'
+    if codec is not None:
+        case += f'/{codec}'
+    return {
+        'case': case,
+        'codec': codec,
+        'codec_stats': codec_stats,     # encode costs of work_in, decode costs of work_out (parent side)
+        'transport': transport,
+        'kind': kind,
+        'workers': workers,
+        'payload': payload_size,
+        'jobs': jobs,
+        'seconds': seconds,
+        'jobs_per_second': jobs / seconds,
+        'mb_per_second': 2 * jobs * payload_size / seconds / (1 << 20),    # sent and echoed
+        'latency': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+        },
+    }
+
+
+def worker_counts(limit):
+    counts = []
+    a = 1
+    while a < limit:
+        counts.append(a)
+        a *= 2
+    counts.append(limit)
+    return counts
+
+
+# compare jobs per second with a stored run, returns the cases that got slower than threshold
+def compare(results, baseline, threshold):
+    old = {a['case']: a for a in baseline['results']}
+    regressions = []
+    print(f"{'case':40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for result in results:
+        before = old.get(result['case'], None)
+        if before is None:
+            print(f"{result['case']:40} {'-':>12} {result['jobs_per_second']:12.1f} {'new':>8}")
+            continue
+
+        change = result['jobs_per_second'] / before['jobs_per_second'] - 1.0
+        flag = ''
+        if change < -threshold:
+            flag = '  slower'
+            regressions.append(result['case'])
+        print(f"{result['case']:40} {before['jobs_per_second']:12.1f} {result['jobs_per_second']:12.1f} "
+            f"{change * 100:7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lib_processing transports and worker counts')
+    parser.add_argument('--transports', default='thread,process')
+    parser.add_argument('--kinds', default='cpu,io')
+    parser.add_argument('--payloads', default='16,1024,65536,1048576', help='payload sizes in bytes')
+    parser.add_argument('--workers', default=None, help='worker counts, default 1, 2, 4 .. cpu count')
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--cpu-loops', type=int, default=20000)
+    parser.add_argument('--io-sleep', type=float, default=1.0, help='milliseconds')
+    parser.add_argument('--start-method', default=None, help='fork | spawn | forkserver')
+    parser.add_argument('--codecs', default='none', help='none,pickle,pickle5,marshal (process transport only)')
+    parser.add_argument('--quick', action='store_true', help='1 and 2 workers, 16 and 65536 bytes, 200 jobs')
+    parser.add_argument('--output', default=None, help='write results as json')
+    parser.add_argument('--baseline', default=None, help='json from an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.10, help='slowdown that counts as a regression')
+    args = parser.parse_args()
+
+    if args.start_method is not None:
+        multiprocessing.set_start_method(args.start_method)
+    log_sink.level = WARNING    # keep worker start and stop lines out of the timings
+
+    payloads = [int(a) for a in args.payloads.split(',')]
+    counts = [int(a) for a in args.workers.split(',')] if args.workers else worker_counts(os.cpu_count() or 1)
+    jobs = args.jobs
+    if args.quick:
+        payloads = [16, 65536]
+        counts = [1, 2]
+        jobs = 200
+
+    codecs = [None if a == 'none' else a for a in args.codecs.split(',')]
+
+    results = []
+    for transport in args.transports.split(','):
+        for kind in args.kinds.split(','):
+            for workers in counts:
+                for payload_size in payloads:
+                    for codec in (codecs if transport == 'process' else [None]):
+                        result = run_case(transport, workers, payload_size, kind, jobs, args.cpu_loops,
+                            args.io_sleep, args.warmup, codec)
+                        results.append(result)
+                        print(f"{result['case']:40} {result['jobs_per_second']:10.1f} jobs/s "
+                            f"{result['mb_per_second']:8.1f} MB/s  p50 {result['latency']['p50'] * 1000:8.2f} ms "
+                            f"p99 {result['latency']['p99'] * 1000:8.2f} ms", flush=True)
+
+    report = {
+        'meta': {
+            'time': time(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'start_method': multiprocessing.get_start_method(),
+            'jobs': jobs,
+            'cpu_loops': args.cpu_loops,
+            'io_sleep': args.io_sleep,
+        },
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} case(s) slower than the baseline by more than {args.threshold * 100:.0f}%')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
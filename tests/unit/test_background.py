@@ -0,0 +1,544 @@
+import unittest
+import heapq
+import selectors
+import time
+import threading
+import json
+import os
+import tempfile
+
+from intounknown_lib.lib_processing import ProcessManagement, BackgroundManager, start_handler_worker
+from intounknown_lib.lib_processing import JobMetrics, RollingHistogram, MessageStore
+from intounknown_lib.lib_processing import JobRecord, JobTimeout
+from intounknown_lib.lib_logging import log_sink, ERROR
+
+
+def upper_handler(msg, context):
+    return msg.upper()
+
+
+# run_after and add_reader of an event loop (Tk, tornado), driven by the test
+class FakeLoop:
+    def __init__(self):
+        self.timers = []    # heap of (due, seq, callback)
+        self.seq = 0
+        self.selector = selectors.DefaultSelector()
+
+    def run_after(self, ms, callback):
+        heapq.heappush(self.timers, (time.time() + ms / 1000.0, self.seq, callback))
+        self.seq += 1
+
+    def add_reader(self, fd, callback):
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd):
+        self.selector.unregister(fd)
+
+    # run due timers and readable file handlers until done() or timeout seconds passed
+    def run(self, done, timeout=5):
+        deadline = time.time() + timeout
+        while not done() and time.time() < deadline:
+            now = time.time()
+            if self.timers and self.timers[0][0] <= now:
+                heapq.heappop(self.timers)[2]()
+                continue
+
+            wait = min(deadline - now, 0.05)
+            if self.timers:
+                wait = min(wait, self.timers[0][0] - now)
+            for key, events in self.selector.select(max(wait, 0)):
+                key.data()
+        return done()
+
+    def close(self):
+        self.selector.close()
+
+
+# thread workers, BackgroundManager reads from thread workers (work_queue_type='process' puts a pipe behind fileno)
+def new_manager(handler, count=1, work_queue_type='thread', **kwargs):
+    manager = ProcessManagement(**kwargs)
+    for i in range(count):
+        manager.create_thread(start_handler_worker, work_queue_type=work_queue_type, handlers={None: handler})
+    return manager
+
+
+def count_handler(msg, context):
+    for i in range(msg):
+        yield i
+
+
+def typed_handler(msg, context):
+    if msg['type'] == 'bad':
+        raise ValueError('bad job')
+    time.sleep(0.01)
+    return msg['n']
+
+
+class TestWakeupMode(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _background(self, manager, **kwargs):
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            remove_reader_cb=self.loop.remove_reader, **kwargs)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        self.addCleanup(background.shutdown)
+        return background
+
+    # the callback runs as soon as the response lands, nothing is polled
+    def test_callback_without_polling(self):
+        for work_queue_type in ('thread', 'process'):
+            background = self._background(new_manager(upper_handler, work_queue_type=work_queue_type))
+            for a in range(3):
+                results = []
+                start = time.time()
+                background.add_job('job', lambda res_msg: results.append(time.time()))
+                self.assertTrue(self.loop.run(lambda: results))
+                if a > 0:   # the first job waits for the worker to start
+                    self.assertLess(results[0] - start, 0.05)
+
+            self.assertEqual(self.loop.timers, [])
+            self.assertEqual(background.get_queue_size(), 0)
+
+    def test_shutdown_removes_reader(self):
+        manager = new_manager(upper_handler)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            remove_reader_cb=self.loop.remove_reader)
+        self.assertEqual(len(self.loop.selector.get_map()), 1)
+        background.shutdown()
+        self.assertEqual(len(self.loop.selector.get_map()), 0)
+        self.assertIsNone(manager.thread_queue_work_out.wakeup)     # the socket pair is closed
+
+    def test_polling_mode(self):
+        manager = new_manager(upper_handler)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        background = BackgroundManager(manager, self.loop.run_after)
+        self.addCleanup(background.shutdown)
+
+        results = []
+        background.add_job('job', results.append)
+        self.assertTrue(self.loop.run(lambda: results))
+        self.assertEqual(results, ['JOB'])
+        self.assertEqual(len(self.loop.timers), 1)  # the next poll
+
+
+class TestCancel(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _gated(self, msg, context):
+        self.gate.wait(5)
+        return msg
+
+    def test_cancel_and_expired(self):
+        manager = new_manager(self._gated)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        dropped = []
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            on_dropped=lambda msg_id, msg, reason: dropped.append((msg, reason)))
+        self.addCleanup(background.shutdown)
+
+        results = []
+        background.add_job('first', results.append)
+        time.sleep(0.1)     # the worker is running it
+        cancelled_id = background.add_job('cancelled', results.append)
+        background.add_job('late', results.append, deadline=time.time() - 1)
+        self.assertTrue(background.cancel(cancelled_id))
+        self.assertFalse(background.cancel(cancelled_id))
+        self.gate.set()
+
+        self.assertTrue(self.loop.run(lambda: dropped))
+        self.assertEqual(results, ['first'])
+        self.assertEqual(dropped, [('late', 'expired')])
+        self.assertEqual(background.get_queue_size(), 0)
+
+
+class TestStreamJobs(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_stream_and_collected_chunks(self):
+        manager = new_manager(count_handler)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader)
+        self.addCleanup(background.shutdown)
+
+        chunks = []
+        collected = []
+        background.add_job(3, lambda chunk, seq, end: chunks.append((chunk, seq, end)), stream=True)
+        background.add_job(2, collected.append)
+        self.assertTrue(self.loop.run(lambda: collected and chunks and chunks[-1][2]))
+        self.assertEqual(chunks, [(0, 0, False), (1, 1, False), (2, 2, False), (None, 3, True)])
+        self.assertEqual(collected, [[0, 1]])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_histogram(self):
+        histogram = RollingHistogram(window=10, slices=2)
+        for a in range(100):
+            histogram.record(0.001 * a, now=100.0)
+        snapshot = histogram.snapshot(now=100.0)
+        self.assertEqual(snapshot['count'], 100)
+        self.assertAlmostEqual(snapshot['max'], 0.099)
+        self.assertLessEqual(snapshot['p50'], snapshot['p99'])
+        self.assertEqual(histogram.snapshot(now=200.0)['count'], 0)     # left the window
+        self.assertEqual(histogram.snapshot(now=200.0)['all_count'], 100)
+
+    def test_job_stages_and_counters(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.json')
+        manager = new_manager(typed_handler, count=2)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        errors = []
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            metrics=JobMetrics(), metrics_file=path, metrics_interval=50,
+            on_error=lambda msg_id, msg, error: errors.append(error))
+        self.addCleanup(background.shutdown)
+
+        results = []
+        for a in range(10):
+            background.add_job({'type': 'a' if a % 2 else 'b', 'n': a}, results.append)
+        background.add_job({'type': 'bad', 'n': 0}, results.append)
+        self.assertTrue(self.loop.run(lambda: len(results) == 10 and errors))
+        self.assertTrue(self.loop.run(lambda: os.path.exists(path)))
+
+        snapshot = background.get_metrics()
+        self.assertEqual(snapshot['counters']['enqueued'], 11)
+        self.assertEqual(snapshot['counters']['completed'], 10)
+        self.assertEqual(snapshot['counters']['failed'], 1)
+        for stage in ('queue_wait', 'dispatch', 'run', 'delivery'):
+            self.assertEqual(snapshot['overall']['stages'][stage]['count'], 11, stage)
+        for stage in ('callback', 'total'):
+            self.assertEqual(snapshot['overall']['stages'][stage]['count'], 10, stage)    # no callback on failure
+        self.assertGreaterEqual(snapshot['overall']['stages']['run']['p50'], 0.005)
+        self.assertEqual(snapshot['by_type']['a']['completed'], 5)
+        self.assertEqual(snapshot['by_type']['bad']['failed'], 1)
+        # grouped by the manager's worker ids even though the workers were not given one
+        self.assertLessEqual(set(snapshot['by_worker']), {'0', '1'})
+        self.assertEqual(sum(a['completed'] + a['failed'] for a in snapshot['by_worker'].values()), 11)
+
+        with open(path) as f:
+            self.assertIn('counters', json.load(f))
+
+
+class TestMessageStore(unittest.TestCase):
+    def test_integer_ids_and_sweep(self):
+        store = MessageStore(ttl=10)
+        old_id = store.set(JobRecord('old', None))
+        store.get(old_id).created -= 20
+        new_id = store.set(JobRecord('new', None))
+        self.assertEqual((old_id, new_id), (1, 2))
+
+        expired = store.sweep()
+        self.assertEqual([a[0] for a in expired], [old_id])
+        self.assertEqual(store.get_ids(), (new_id,))
+        self.assertEqual(MessageStore().sweep(), [])    # no ttl
+
+
+class TestJobTtl(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _gated(self, msg, context):
+        self.gate.wait(5)
+        return msg
+
+    # a job without a response is given up after job_ttl, its late response is ignored
+    def test_sweep_times_out_lost_jobs(self):
+        manager = new_manager(self._gated)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            job_ttl=0.2, sweep_interval=50)
+        self.addCleanup(background.shutdown)
+
+        results = []
+        msg_id = background.add_job('lost', results.append)
+        self.assertTrue(self.loop.run(lambda: results))
+        self.assertIsInstance(results[0], JobTimeout)
+        self.assertEqual(results[0].msg_id, msg_id)
+        self.assertEqual(background.store.get_size(), 0)
+        self.assertEqual(background.get_queue_size(), 0)
+
+        self.gate.set()
+        self.loop.run(lambda: False, timeout=0.3)
+        self.assertEqual(len(results), 1)
+
+
+class TestNotifications(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _gated(self, msg, context):
+        self.gate.wait(5)
+        return msg
+
+    def _background(self):
+        manager = new_manager(self._gated)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader)
+        self.addCleanup(background.shutdown)
+        return background
+
+    def test_delta(self):
+        background = self._background()
+        pending_id = background.add_job('pending', lambda res_msg: None)    # before the subscriber
+        calls = []
+        background.set_notify_subscriber(lambda added, completed: calls.append((added, completed)), delta=True)
+
+        results = []
+        ids = [background.add_job(f'job {a}', results.append) for a in range(3)]
+        self.assertEqual(calls[0], ([(pending_id, 'pending'), (ids[0], 'job 0')], []))
+        self.assertEqual(calls[1:], [([(ids[1], 'job 1')], []), ([(ids[2], 'job 2')], [])])
+
+        self.gate.set()
+        self.assertTrue(self.loop.run(lambda: len(results) == 3))
+        completed = [msg_id for added, done in calls[3:] for msg_id in done]
+        self.assertEqual(sorted(completed), [pending_id] + ids)
+        self.assertTrue(all(not added for added, done in calls[3:]))
+
+    def test_full_list(self):
+        background = self._background()
+        calls = []
+        background.set_notify_subscriber(calls.append)
+
+        results = []
+        background.add_job('a', results.append)
+        background.add_job('b', results.append)
+        self.assertEqual(calls, [['a'], ['a', 'b']])
+
+        self.gate.set()
+        self.assertTrue(self.loop.run(lambda: len(results) == 2))
+        self.assertEqual(calls[-1], [])
+
+
+class TestCoalesce(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+        self.runs = []
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _counted(self, msg, context):
+        self.runs.append(msg)
+        self.gate.wait(5)
+        if msg == 'bad':
+            raise ValueError(msg)
+        return msg * 2
+
+    def _background(self, **kwargs):
+        manager = new_manager(self._counted, count=2)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            metrics=JobMetrics(), **kwargs)
+        self.addCleanup(background.shutdown)
+        return background
+
+    # a coalesced add_job hears about errors, drops and timeouts like the job it joined
+    def test_coalesced_failures_reach_every_caller(self):
+        errors = []
+        dropped = []
+        background = self._background(coalesce=True, on_error=lambda *a: errors.append(a[0]),
+            on_dropped=lambda *a: dropped.append(a))
+        results = []
+
+        msg_id = background.add_job('bad', results.append)
+        self.assertEqual(background.add_job('bad', results.append), msg_id)
+        self.gate.set()
+        self.assertTrue(self.loop.run(lambda: len(errors) == 2))
+        self.assertEqual(errors, [msg_id, msg_id])
+
+        msg_id = background.add_job(7, results.append, deadline=time.time() - 1)
+        background.add_job(7, results.append, deadline=time.time() - 1)
+        background.add_job(7, results.append, deadline=time.time() - 1)
+        self.assertTrue(self.loop.run(lambda: len(dropped) == 3))
+        self.assertEqual(dropped, [(msg_id, 7, 'expired')] * 3)
+        self.assertEqual(results, [])
+
+        self.gate.clear()
+        background.add_job(8, results.append, timeout=0.2)
+        background.add_job(8, results.append, timeout=0.2)
+        self.assertTrue(self.loop.run(lambda: len(results) == 2))
+        self.assertTrue(all(isinstance(a, JobTimeout) for a in results))
+        self.gate.set()
+
+    def test_identical_jobs_share_one_run(self):
+        background = self._background(coalesce=True)
+        results = []
+        first_id = background.add_job(21, results.append)
+        self.assertEqual(background.add_job(21, results.append), first_id)
+        other_id = background.add_job(5, results.append)
+        self.assertNotEqual(other_id, first_id)
+
+        self.gate.set()
+        self.assertTrue(self.loop.run(lambda: len(results) == 3))
+        self.assertEqual(sorted(results), [10, 42, 42])
+        self.assertEqual(sorted(self.runs), [5, 21])
+        self.assertEqual(background.get_metrics()['counters']['coalesced'], 1)
+
+        background.add_job(21, results.append)      # done, runs again
+        self.assertTrue(self.loop.run(lambda: len(results) == 4))
+        self.assertEqual(len(self.runs), 3)
+
+    def test_result_cache(self):
+        self.gate.set()
+        background = self._background(cache_size=2)
+        results = []
+        background.add_job(1, results.append)
+        self.assertTrue(self.loop.run(lambda: results))
+
+        self.assertIsNone(background.add_job(1, results.append))   # answered from the cache
+        self.assertTrue(self.loop.run(lambda: len(results) == 2))
+        self.assertEqual(results, [2, 2])
+        self.assertEqual(self.runs, [1])
+        self.assertEqual(background.get_metrics()['counters']['cached'], 1)
+
+        background.add_job('x', results.append, job_key='k')
+        background.add_job('y', results.append, job_key='k2')
+        self.assertTrue(self.loop.run(lambda: len(results) == 4))
+        background.add_job(1, results.append)      # evicted by the two newer keys
+        self.assertTrue(self.loop.run(lambda: len(results) == 5))
+        self.assertEqual(self.runs, [1, 'x', 'y', 1])
+
+        background.invalidate_cache()
+        background.add_job('x', results.append, job_key='k')
+        self.assertTrue(self.loop.run(lambda: len(results) == 6))
+        self.assertEqual(len(self.runs), 5)
+
+
+class TestTimeoutsAndHedging(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.loop = FakeLoop()
+        self.addCleanup(self.loop.close)
+        self.gate = threading.Event()
+        self.runs = []
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    # the first run of a job hangs until the gate opens, a second run answers right away
+    def _straggler(self, msg, context):
+        self.runs.append(msg)
+        if len(self.runs) == 1:
+            self.gate.wait(5)
+        return len(self.runs)
+
+    def _background(self, count=2, manager_options=None, **kwargs):
+        manager = new_manager(self._straggler, count=count, **(manager_options or {}))
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        self.addCleanup(self.gate.set)      # before the workers are stopped
+        background = BackgroundManager(manager, self.loop.run_after, add_reader_cb=self.loop.add_reader,
+            **kwargs)
+        self.addCleanup(background.shutdown)
+        return background
+
+    def test_timeout(self):
+        background = self._background()
+        results = []
+        start = time.time()
+        background.add_job('slow', results.append, timeout=0.2)
+        self.assertTrue(self.loop.run(lambda: results))
+        self.assertIsInstance(results[0], JobTimeout)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(background.get_queue_size(), 0)
+
+    def test_hedged_copy_wins(self):
+        background = self._background(hedge_after=0.1, hedge_budget=1.0)
+        results = []
+        start = time.time()
+        background.add_job('slow', results.append)
+        self.assertTrue(self.loop.run(lambda: results))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(results, [2])      # the copy, the first run is still hanging
+        self.assertEqual(background.get_hedge_stats()['hedged'], 1)
+        self.assertEqual(background.get_hedge_stats()['hedge_won'], 1)
+
+        self.gate.set()     # the first run finishes, its response is ignored
+        self.loop.run(lambda: False, timeout=0.3)
+        self.assertEqual(results, [2])
+
+    # round robin would hand the copy back to the worker running the original
+    def test_hedge_avoids_the_busy_worker(self):
+        background = self._background(manager_options={'scheduler': 'round_robin'}, hedge_after=0.1,
+            hedge_budget=1.0)
+        results = []
+        background.add_job('slow', results.append)
+        background.add_job('fast', results.append)
+        self.assertTrue(self.loop.run(lambda: len(results) == 2))
+        self.assertEqual(sorted(results), [2, 3])
+        self.assertEqual(background.get_hedge_stats()['hedged'], 1)
+
+    # a full queue skips the hedge instead of raising in the timer
+    def test_hedge_skipped_when_queue_full(self):
+        background = self._background(count=1, manager_options={'work_in_maxsize': 1, 'overflow': 'reject'},
+            hedge_after=0.1, hedge_budget=1.0)
+        results = []
+        background.add_job('slow', results.append)
+        time.sleep(0.1)     # the worker took it
+        background.add_job('queued', results.append)
+        self.loop.run(lambda: False, timeout=0.4)
+        self.assertEqual(background.get_hedge_stats()['hedged'], 0)
+
+        self.gate.set()
+        self.assertTrue(self.loop.run(lambda: len(results) == 2))
+        self.assertEqual(results, [1, 2])
+
+    def test_hedge_budget(self):
+        background = self._background(hedge_after=0.1, hedge_budget=0.0)
+        results = []
+        background.add_job('slow', results.append)
+        self.loop.run(lambda: results, timeout=0.5)
+        self.assertEqual(results, [])
+        self.assertEqual(background.get_hedge_stats()['hedged'], 0)
@@ -0,0 +1,252 @@
+import unittest
+import os
+import time
+import json
+import datetime
+import multiprocessing
+import marshal
+from pickle import PickleBuffer
+from unittest import mock
+from queue import Full as QueueFull
+
+from intounknown_lib.lib_processing import ProcessManagement, start_handler_worker
+from intounknown_lib.lib_coms import ThreadCom, ProcessCom, CustomCodec, get_codec
+from intounknown_lib.lib_ring import RingCom
+from intounknown_lib.lib_logging import log_sink, WARNING
+from intounknown_lib import lib_processing, lib_ring
+
+
+def pid_handler(msg, context):
+    time.sleep(0.3)
+    return os.getpid()
+
+
+def upper_handler(msg, context):
+    return msg.upper()
+
+
+def ring_consumer(com_in, com_out, count):
+    got = [com_in.read(5) for i in range(count)]
+    com_out.write(got)
+
+
+class TestBatching(unittest.TestCase):
+    def test_write_many_read_many(self):
+        com = ThreadCom()
+        com.write_many(list(range(10)))
+        self.assertEqual(com.size(), 10)
+        self.assertEqual(com.read_many(4), [0, 1, 2, 3])
+        self.assertEqual(com.read_many(), list(range(4, 10)))
+        self.assertEqual(com.read_many(), [])
+
+    def test_single_reader_batch(self):
+        com = ProcessCom(single_reader=True)
+        com.write_many([{'msg_id': i} for i in range(5)])
+        time.sleep(0.1)
+        self.assertEqual(com.size(), 5)     # messages, not batches
+        self.assertEqual(com.read(1), {'msg_id': 0})
+        self.assertEqual(com.size(), 4)
+        self.assertEqual([a['msg_id'] for a in com.read_many()], [1, 2, 3, 4])
+        self.assertEqual(com.size(), 0)
+
+    def test_shared_queue_writes_each_message(self):
+        com = ProcessCom()
+        com.write_many([1, 2, 3])
+        self.assertEqual([com.read(1) for i in range(3)], [1, 2, 3])
+
+    # a batch on the shared process work queue is spread over the idle workers
+    def test_shared_queue_spreads_a_batch(self):
+        self.addCleanup(setattr, log_sink, 'level', log_sink.level)
+        log_sink.level = WARNING
+        manager = ProcessManagement()
+        ids = [manager.create_process(start_handler_worker, handlers={None: pid_handler}) for i in range(4)]
+        time.sleep(0.5)
+
+        start = time.time()
+        manager.write_work_many(ids[0], [{'msg_id': i, 'msg': i} for i in range(8)])
+        responses = []
+        while len(responses) < 8 and time.time() - start < 10:
+            responses += manager.read_work_many(ids[0], None, 0.5)
+        elapsed = time.time() - start
+        manager.shutdown_all(timeout=5)
+
+        self.assertEqual(len(responses), 8)
+        self.assertGreater(len(set(a['msg'] for a in responses)), 1)
+        self.assertLess(elapsed, 1.5)   # 8 jobs of 0.3s in one process take 2.4s
+
+
+class TestOverflow(unittest.TestCase):
+    def test_reject_writes_nothing(self):
+        com = ThreadCom(maxsize=4, overflow='reject')
+        com.write_many([1, 2, 3])
+        with self.assertRaises(QueueFull):
+            com.write_many([4, 5])
+        self.assertEqual(com.read_many(), [1, 2, 3])
+
+    def test_drop_oldest(self):
+        com = ThreadCom(maxsize=3, overflow='drop_oldest')
+        com.write_many([1, 2, 3])
+        self.assertEqual(com.write_many([4, 5]), [1, 2])
+        self.assertEqual(com.write(6), [3])
+        self.assertEqual(com.read_many(), [4, 5, 6])
+
+    def test_timeout(self):
+        com = ThreadCom(maxsize=1, overflow='timeout', put_timeout=0.1)
+        com.write(1)
+        start = time.time()
+        with self.assertRaises(QueueFull):
+            com.write(2)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_process_queue_reject(self):
+        com = ProcessCom(maxsize=4, overflow='reject')
+        com.write_many([1, 2, 3])
+        with self.assertRaises(QueueFull):
+            com.write_many([4, 5])
+        time.sleep(0.1)
+        self.assertEqual(com.size(), 3)
+
+
+class TestWake(unittest.TestCase):
+    def test_wake(self):
+        com = ThreadCom()
+        com.wake()
+        com.write(1)
+        self.assertIsNone(com.read())
+        self.assertEqual(com.read(), 1)
+
+    def test_wake_process_queue(self):
+        com = ProcessCom()
+        com.wake()
+        com.write(1)
+        self.assertIsNone(com.read(1))
+        self.assertEqual(com.read(1), 1)
+
+
+class TestCodecs(unittest.TestCase):
+    def test_round_trip(self):
+        msg = {'msg_id': 1, 'msg': ['a', 2, 3.5, None]}
+        for codec in ('pickle', 'pickle5', 'marshal', CustomCodec(lambda a: json.dumps(a).encode(), json.loads)):
+            com = ProcessCom(codec=codec, single_reader=True)
+            com.write(msg)
+            com.write_many([msg, msg])
+            got = []
+            while len(got) < 3:
+                got += com.read_many(None, 1)
+            self.assertEqual(got, [msg] * 3)
+
+    def test_marshal_fallback(self):
+        com = ProcessCom(codec='marshal')
+        com.write({'msg_id': 1})
+        com.write(datetime.date(2020, 1, 1))    # marshal refuses it, it is pickled
+        self.assertEqual(com.read(1), {'msg_id': 1})
+        self.assertEqual(com.read(1), datetime.date(2020, 1, 1))
+        stats = com.codec.get_stats()
+        self.assertEqual((stats['encoded'], stats['fallbacks']), (2, 1))
+
+    # stats count the bytes that go through the pipe, the codec's output and the kind byte, nothing more
+    def test_stats_count_what_is_sent(self):
+        msg = {'msg_id': 1, 'msg': 'x' * 20}
+        com = ProcessCom(codec='marshal')
+        for i in range(3):
+            com.write(msg)
+        self.assertEqual([com.read(1) for i in range(3)], [msg] * 3)
+        stats = com.get_codec_stats()
+        self.assertEqual((stats['encoded'], stats['decoded']), (3, 3))
+        self.assertEqual(stats['bytes'], 3 * (len(marshal.dumps(msg)) + 1))
+
+    # PickleBuffer payloads are written to the pipe on their own, not copied into the pickle
+    def test_out_of_band_buffers(self):
+        payload = bytearray(b'z' * 100000)
+        com = ProcessCom(codec='pickle5')
+        com.write({'msg_id': 1, 'msg': PickleBuffer(payload)})
+        com.write({'msg_id': 2, 'msg': 'in band'})
+        self.assertEqual(bytes(com.read(1)['msg']), bytes(payload))
+        self.assertEqual(com.read(1)['msg'], 'in band')
+        stats = com.get_codec_stats()
+        self.assertEqual(stats['buffers'], 1)
+        self.assertLess(stats['bytes'], len(payload) + 200)
+
+        ring = RingCom(capacity=1 << 18, codec='pickle5')
+        ring.write({'msg_id': 3, 'msg': PickleBuffer(payload)})
+        self.assertEqual(bytes(ring.read()['msg']), bytes(payload))
+
+    def test_bounded_queue_and_wake(self):
+        com = ProcessCom(maxsize=2, overflow='reject', codec='marshal')
+        com.write(1)
+        com.write(2)
+        with self.assertRaises(QueueFull):
+            com.write(3)
+        self.assertEqual(com.size(), 2)
+        self.assertEqual(com.read(1), 1)
+        self.assertEqual(com.read(1), 2)
+        com.wake()
+        com.write(3)
+        self.assertIsNone(com.read(1))      # the wake signal
+        self.assertEqual(com.read(1), 3)
+        self.assertIsNone(com.read(0.05))
+
+    def test_process_workers(self):
+        self.addCleanup(setattr, log_sink, 'level', log_sink.level)
+        log_sink.level = WARNING
+        for method in ('fork', 'spawn'):
+            for codec in ('marshal', 'pickle5'):
+                manager = ProcessManagement(codec=codec, start_method=method)
+                self.addCleanup(manager.shutdown_all, timeout=5)
+                worker_id = manager.create_process(start_handler_worker, handlers={None: upper_handler})
+                manager.write_work_many(worker_id, [{'msg_id': i, 'msg': 'job'} for i in range(20)])
+                responses = []
+                start = time.time()
+                while len(responses) < 20 and time.time() - start < 10:
+                    responses += manager.read_work_many(worker_id, None, 0.5)
+                self.assertEqual(sorted(a['msg_id'] for a in responses), list(range(20)), (method, codec))
+                self.assertEqual({a['msg'] for a in responses}, {'JOB'})
+                manager.shutdown_all(timeout=5)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(Exception):
+            get_codec('json')
+
+
+class TestRingCom(unittest.TestCase):
+    def test_wraps_around(self):
+        com = RingCom(capacity=100, codec='marshal')
+        for i in range(50):
+            com.write({'i': i, 'pad': 'y' * 40})
+            self.assertEqual(com.read()['i'], i)
+
+    def test_message_larger_than_ring(self):
+        com = RingCom(capacity=100)
+        with self.assertRaises(Exception):
+            com.write('z' * 200)
+
+    def test_reject_when_full(self):
+        com = RingCom(capacity=64, overflow='reject')
+        com.write('a' * 20)
+        with self.assertRaises(QueueFull):
+            com.write('b' * 40)
+        self.assertEqual(com.size(), 1)
+        self.assertEqual(com.read_many(), ['a' * 20])
+        self.assertIsNone(com.read(0.1))
+
+    # the ring relies on x86 memory ordering, other machines have to use process queues
+    def test_refused_without_x86_ordering(self):
+        with mock.patch.object(lib_ring, 'LOCAL_FENCE', False):
+            with self.assertRaises(Exception):
+                RingCom()
+        with mock.patch.object(lib_processing, 'LOCAL_FENCE', False):
+            with self.assertRaises(Exception):
+                ProcessManagement(channel='ring')
+
+    def test_between_processes(self):
+        for method in ('fork', 'spawn'):
+            ctx = multiprocessing.get_context(method)
+            com_in = RingCom(capacity=4096, ctx=ctx)
+            com_out = RingCom(ctx=ctx)
+            proc = ctx.Process(target=ring_consumer, args=(com_in, com_out, 500))
+            proc.start()
+            for i in range(500):
+                com_in.write({'msg_id': i, 'msg': 'x' * 16})    # 500 messages do not fit, the writer waits
+            got = com_out.read(10)
+            proc.join(5)
+            self.assertEqual([a['msg_id'] for a in got], list(range(500)))
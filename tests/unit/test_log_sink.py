@@ -0,0 +1,58 @@
+import unittest
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+
+from intounknown_lib.lib_logging import LogSink, log_sink, printLine, DEBUG, INFO, WARNING
+
+
+def log_in_child(process_queue):
+    sink = LogSink()
+    sink.forward(process_queue, INFO)
+    sink.write(INFO, 'from child', os.getpid())
+    sink.write(DEBUG, 'below the level')
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestLogSink(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'log.txt')
+
+    def test_level_and_format(self):
+        sink = LogSink(level=INFO, fmt='{level} {message}')
+        sink.open(self.path)
+        sink.write(DEBUG, 'hidden')
+        sink.write(INFO, 'a', 1)
+        sink.write(WARNING, 'b', 2, sep='-')
+        sink.flush()
+        self.assertEqual(read_file(self.path), 'INFO a 1\nWARNING b-2\n')
+
+    def test_records_from_a_process(self):
+        sink = LogSink()
+        sink.open(self.path)
+        ctx = multiprocessing.get_context('spawn')
+        proc = ctx.Process(target=log_in_child, args=(sink.get_process_queue(ctx),))
+        proc.start()
+        proc.join(10)
+
+        deadline = time.time() + 5
+        while not read_file(self.path) and time.time() < deadline:
+            time.sleep(0.05)
+        sink.flush()
+        self.assertEqual(read_file(self.path), f'from child {proc.pid}\n')
+
+    def test_print_line_file_and_flush(self):
+        level = log_sink.level
+        self.addCleanup(setattr, log_sink, 'level', level)
+        log_sink.level = INFO
+
+        stream = io.StringIO()
+        printLine('x', 1, file=stream, flush=True)
+        printLine('hidden', file=stream, level=DEBUG, flush=True)
+        self.assertEqual(stream.getvalue(), 'x 1\n')
@@ -0,0 +1,617 @@
+import unittest
+import threading
+import time
+import os
+import sys
+import signal
+import subprocess
+from collections import Counter
+from concurrent.futures import BrokenExecutor
+
+from intounknown_lib.lib_processing import ProcessManagement, LeastOutstandingScheduler, start_handler_worker
+from intounknown_lib.lib_processing import WorkerPool, WorkerExecutor, HandlerRegistry, start_worker
+from intounknown_lib.lib_coms import SharedPayload, Priority
+from intounknown_lib.lib_logging import log_sink, ERROR
+
+
+def thread_handler(msg, context):
+    time.sleep(0.01)
+    return threading.get_ident()
+
+
+def read_responses(manager, worker_id, count, timeout=10):
+    responses = []
+    deadline = time.time() + timeout
+    while len(responses) < count and time.time() < deadline:
+        responses += manager.read_work_many(worker_id, None, 0.2)
+    return responses
+
+
+def nap_pid_handler(msg, context):
+    time.sleep(msg)
+    return os.getpid()
+
+
+class FakeReader:
+    def __init__(self, load):
+        self.load = load
+
+    def outstanding(self):
+        return self.load
+
+
+def size_handler(msg, context):
+    with msg['data'] as view:
+        return len(view)
+
+
+def nap_handler(msg, context):
+    time.sleep(msg)
+    return msg
+
+
+def fail(text):
+    raise ValueError(text)
+
+
+registry = HandlerRegistry()
+
+
+@registry.handler('add')
+def add_handler(msg, context):
+    return context['base'] + msg
+
+
+@registry.handler()
+def default_handler(msg, context):
+    return ['default', msg]
+
+
+def open_context(base, opened):
+    opened.append('open')
+    return {'base': base, 'opened': opened}
+
+
+def close_context(context):
+    context['opened'].append('close')
+
+
+def chunk_handler(msg, context):
+    for i in range(msg):
+        yield i
+
+
+def pid_handler(msg, context):
+    return os.getpid()
+
+
+def wait_for_spares(manager, count, timeout=10):
+    deadline = time.time() + timeout
+    while len(manager.spares) < count and time.time() < deadline:
+        time.sleep(0.05)
+    return len(manager.spares)
+
+
+def exit_handler(msg, context):
+    os._exit(1)
+
+
+def double_batch(msgs, context):
+    return [[a * 2, len(msgs)] for a in msgs]
+
+
+def check_batch(msgs, context):
+    return [ValueError('odd') if a % 2 else a for a in msgs]
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _threads(self, count, **kwargs):
+        manager = ProcessManagement(**kwargs)
+        ids = [manager.create_thread(start_handler_worker, handlers={None: thread_handler}) for i in range(count)]
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        return manager, ids
+
+    def test_round_robin(self):
+        manager, ids = self._threads(4, scheduler='round_robin')
+        manager.write_work_many(ids[0], [{'msg_id': i, 'msg': i} for i in range(8)])
+        responses = read_responses(manager, ids[0], 8)
+        self.assertEqual(sorted(Counter(a['msg'] for a in responses).values()), [2, 2, 2, 2])
+
+    def test_consistent_hash(self):
+        manager, ids = self._threads(4, scheduler='consistent_hash')
+        keys = ['a', 'b', 'c', 'd'] * 5
+        for i, key in enumerate(keys):
+            manager.write_work(ids[0], {'msg_id': i, 'msg': i}, key=key)
+        responses = read_responses(manager, ids[0], len(keys))
+        workers = {}
+        for a in responses:
+            workers.setdefault(keys[a['msg_id']], set()).add(a['msg'])
+        self.assertTrue(all(len(a) == 1 for a in workers.values()))
+
+    def test_least_outstanding(self):
+        scheduler = LeastOutstandingScheduler()
+        readers = {0: FakeReader(3), 1: FakeReader(1), 2: FakeReader(2)}
+        self.assertEqual(scheduler.choose([0, 1, 2], readers), 1)
+        readers[1].load = 5
+        self.assertEqual(scheduler.choose([0, 1, 2], readers), 2)
+
+    # a process worker's running job counts, so short jobs go to the idle worker
+    def test_least_outstanding_process_workers(self):
+        manager = ProcessManagement(scheduler='least_outstanding')
+        ids = [manager.create_process(start_handler_worker, handlers={None: nap_pid_handler}) for i in range(2)]
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(ids[0], {'msg_id': 0, 'msg': 1.0})
+        time.sleep(0.2)     # running it
+        loads = manager.get_worker_loads()
+        self.assertEqual(sorted(loads.values()), [0, 1])
+
+        responses = []
+        for i in range(1, 6):
+            manager.write_work(ids[0], {'msg_id': i, 'msg': 0.01})
+            responses += read_responses(manager, ids[0], 1)
+        self.assertEqual([a['msg_id'] for a in responses], [1, 2, 3, 4, 5])
+        self.assertEqual(len(set(a['msg'] for a in responses)), 1)
+
+        slow = read_responses(manager, ids[0], 1)[0]
+        self.assertEqual(slow['msg_id'], 0)
+        self.assertNotEqual(slow['msg'], responses[0]['msg'])
+        self.assertEqual(manager.get_worker_loads(), {ids[0]: 0, ids[1]: 0})
+
+    def test_write_work_direct_needs_scheduler(self):
+        manager, ids = self._threads(1)
+        with self.assertRaises(Exception):
+            manager.write_work_direct(ids[0], {'msg_id': 1, 'msg': 1})
+
+
+class TestPayloads(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_view_shares_the_block(self):
+        payload = SharedPayload.create(b'abc')
+        self.addCleanup(payload.unlink)
+        attached = SharedPayload(payload.name, payload.size)
+        with attached as view:
+            view[0] = ord('x')
+        self.assertEqual(bytes(payload.view()), b'xbc')
+
+    def test_payloads_are_released(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_process(start_handler_worker, handlers={None: size_handler})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        for i in range(3):
+            manager.write_work(worker_id, {'msg_id': i, 'msg': {'data': manager.share(b'x' * 1000)}})
+        responses = read_responses(manager, worker_id, 3)
+        self.assertEqual([a['msg'] for a in responses], [1000] * 3)
+        self.assertEqual(manager.payloads, {})
+
+        manager.write_work(worker_id, {'msg_id': 9, 'msg': {'data': manager.share(b'y')}})
+        manager.cancel_work(worker_id, [9])
+        self.assertEqual(manager.payloads, {})
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_scales_up_and_down(self):
+        manager = ProcessManagement()
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        decisions = []
+        pool = WorkerPool(manager, start_handler_worker, min_workers=1, max_workers=3, scale_up_depth=2,
+            scale_up_wait=None, idle_cooldown=0.2, on_scale=decisions.append, handlers={None: nap_handler})
+        self.assertEqual(pool.get_size(), 1)
+
+        manager.write_work_many(pool.get_worker(), [{'msg_id': i, 'msg': 0.05} for i in range(20)])
+        pool.check()
+        pool.check()
+        pool.check()    # at max_workers
+        self.assertEqual(pool.get_size(), 3)
+        self.assertEqual([a['action'] for a in decisions], ['scale_up', 'scale_up'])
+
+        self.assertEqual(len(read_responses(manager, pool.get_worker(), 20)), 20)
+        deadline = time.time() + 5
+        while len(manager.workers) > 1 and time.time() < deadline:
+            pool.check()
+            time.sleep(0.05)
+
+        self.assertEqual(pool.get_size(), 1)
+        self.assertEqual(len(manager.workers), 1)   # retired workers were reaped
+        self.assertEqual([a['action'] for a in decisions][2:], ['scale_down', 'scale_down'])
+        self.assertEqual(pool.get_stats()['workers'], 1)
+
+    def test_scales_up_on_wait(self):
+        manager = ProcessManagement()
+        self.addCleanup(manager.shutdown_all, timeout=5)
+        pool = WorkerPool(manager, start_handler_worker, max_workers=2, scale_up_depth=100, scale_up_wait=0.1,
+            handlers={None: nap_handler})
+
+        manager.write_work_many(pool.get_worker(), [{'msg_id': i, 'msg': 0.1} for i in range(5)])
+        self.assertIsNone(pool.check())
+        time.sleep(0.15)
+        self.assertEqual(pool.check()['action'], 'scale_up')
+
+
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_results_and_errors(self):
+        for worker_type in ('thread', 'process'):
+            executor = WorkerExecutor(2, worker_type)
+            self.assertEqual(executor.submit(pow, 2, 10).result(5), 1024)
+            self.assertEqual(list(executor.map(abs, [-1, -2, -3])), [1, 2, 3])
+            with self.assertRaises(ValueError):
+                executor.submit(fail, 'bad').result(5)
+            executor.shutdown()
+
+    def test_running_job_cannot_be_cancelled(self):
+        for worker_type in ('thread', 'process'):
+            executor = WorkerExecutor(1, worker_type)
+            future = executor.submit(time.sleep, 0.5)
+            time.sleep(0.3)
+            self.assertTrue(future.running())
+            self.assertFalse(future.cancel())
+            self.assertIsNone(future.result(5))
+            executor.shutdown()
+
+    def test_shutdown_cancel_futures(self):
+        for worker_type in ('thread', 'process'):
+            executor = WorkerExecutor(2, worker_type)
+            futures = [executor.submit(time.sleep, 0.3) for i in range(10)]
+            time.sleep(0.1)
+
+            start = time.time()
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.assertLess(time.time() - start, 1)
+            self.assertGreaterEqual(sum(a.cancelled() for a in futures), 6)
+            self.assertTrue(all(a.done() for a in futures))
+
+    def test_dead_process_worker_breaks_executor(self):
+        executor = WorkerExecutor(2, 'process')
+        futures = [executor.submit(time.sleep, 5) for i in range(4)]
+        time.sleep(0.5)
+        os.kill(executor.process_manager.workers[0]['object'].pid, signal.SIGKILL)
+
+        start = time.time()
+        for future in futures:
+            with self.assertRaises(BrokenExecutor):
+                future.result(5)
+        executor.shutdown(wait=True)
+        self.assertLess(time.time() - start, 5)
+        with self.assertRaises(BrokenExecutor):
+            executor.submit(abs, -1)
+
+    # no shutdown(): the interpreter still exits, after the pending future is done
+    def test_exit_without_shutdown(self):
+        for worker_type in ('thread', 'process'):
+            code = ('import time\n'
+                'from intounknown_lib.lib_processing import WorkerExecutor\n'
+                'executor = WorkerExecutor(2, '+repr(worker_type)+')\n'
+                'print(executor.submit(abs, -3).result(5))\n'
+                'executor.submit(time.sleep, 0.2)\n')
+            result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=30,
+                cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout.strip(), '3')
+
+    # submit routes on the caller's thread while the collector unroutes, nothing may be left counted
+    def test_scheduled_loads_settle(self):
+        executor = WorkerExecutor(4, 'thread', scheduler='least_outstanding')
+        self.addCleanup(executor.shutdown)
+        futures = [executor.submit(abs, -i) for i in range(2000)]
+        self.assertEqual([a.result(10) for a in futures], list(range(2000)))
+        manager = executor.process_manager
+        deadline = time.time() + 5
+        while manager.routed and time.time() < deadline:
+            time.sleep(0.05)    # the collector sets a result before it reads the next batch
+        self.assertEqual(manager.routed, {})
+        self.assertEqual(set(manager.get_worker_loads().values()), {0})
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+        self.gate = threading.Event()
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def _gated(self, msg, context):
+        if msg == 'block':
+            self.gate.wait(5)
+        return msg
+
+    def test_priority_and_cancel(self):
+        manager = ProcessManagement(priority_lanes=3)
+        worker_id = manager.create_thread(start_handler_worker, handlers={None: self._gated})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(worker_id, {'msg_id': 0, 'msg': 'block'})
+        time.sleep(0.2)     # the worker is running it
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': 'low'}, priority=Priority.LOW)
+        manager.write_work(worker_id, {'msg_id': 2, 'msg': 'low'}, priority=Priority.LOW)
+        manager.write_work(worker_id, {'msg_id': 3, 'msg': 'high'}, priority=Priority.HIGH)
+        self.assertEqual(manager.cancel_work(worker_id, [2]), {2})
+        self.gate.set()
+
+        responses = read_responses(manager, worker_id, 3)
+        self.assertEqual([a['msg_id'] for a in responses], [0, 3, 1])
+
+    def test_deadline(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_thread(start_handler_worker, handlers={None: self._gated})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': 'late', 'deadline': time.time() - 1})
+        self.assertEqual(read_responses(manager, worker_id, 1), [{'msg_id': 1, 'expired': True}])
+
+    # a job already in a process worker's pipe is skipped by the worker
+    def test_cancel_in_process_queue(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_process(start_handler_worker, handlers={None: nap_handler})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work_many(worker_id, [{'msg_id': i, 'msg': 0.2} for i in range(3)])
+        time.sleep(0.1)
+        self.assertEqual(manager.cancel_work(worker_id, [1]), set())
+        responses = read_responses(manager, worker_id, 2)
+        self.assertEqual([a['msg_id'] for a in responses], [0, 2])
+
+    # cancel_work sends ('cancel', [..]) to every worker of the queue, a legacy start_worker survives it
+    def test_cancel_with_legacy_worker(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_thread(start_handler_worker, handlers={None: self._gated})
+        legacy_id = manager.create_thread(start_worker)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(worker_id, {'msg_id': 0, 'msg': 'block'})
+        time.sleep(0.2)
+        self.assertEqual(manager.cancel_work(worker_id, [0]), set())
+        manager.write_in(legacy_id, 'ping')
+        time.sleep(0.2)
+        self.gate.set()
+        self.assertTrue(manager.workers[legacy_id]['object'].is_alive())
+        self.assertEqual(manager.shutdown_all(timeout=5)['stopped'], [worker_id, legacy_id])
+
+
+class TestShutdown(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_abort_discards_queued_jobs(self):
+        manager = ProcessManagement()
+        ids = [manager.create_process(start_handler_worker, handlers={None: nap_handler}) for i in range(2)]
+        manager.write_work_many(ids[0], [{'msg_id': i, 'msg': 0.2} for i in range(20)])
+        time.sleep(0.3)
+
+        start = time.time()
+        result = manager.shutdown_all(timeout=5)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(sorted(result['stopped']), ids)
+
+    def test_drain_finishes_queued_jobs(self):
+        manager = ProcessManagement()
+        ids = [manager.create_thread(start_handler_worker, handlers={None: nap_handler}) for i in range(2)]
+        manager.write_work_many(ids[0], [{'msg_id': i, 'msg': 0.01} for i in range(10)])
+
+        result = manager.shutdown_all(drain=True, timeout=5)
+        self.assertEqual(sorted(result['stopped']), ids)
+        self.assertEqual(len(manager.read_work_many(ids[0])), 10)
+
+    def test_timeout_terminates_processes(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_process(start_handler_worker, handlers={None: nap_handler})
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': 30})
+        time.sleep(0.3)
+
+        start = time.time()
+        result = manager.shutdown_all(timeout=0.5)
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(result['terminated'], [worker_id])
+
+
+class TestHandlers(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_dispatch_and_initializer(self):
+        opened = []
+        manager = ProcessManagement()
+        worker_id = manager.create_thread(start_handler_worker, handlers=registry, initializer=open_context,
+            initargs=(10, opened), finalizer=close_context)
+
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': 5, 'type': 'add'})
+        manager.write_work(worker_id, {'msg_id': 2, 'msg': {'type': 'other'}})
+        manager.write_work(worker_id, {'msg_id': 3, 'msg': 'x', 'type': 'add'})    # str + int raises
+        responses = read_responses(manager, worker_id, 3)
+        manager.shutdown_all(timeout=5)
+
+        self.assertEqual(responses[0], {'msg_id': 1, 'msg': 15})
+        self.assertEqual(responses[1], {'msg_id': 2, 'msg': ['default', {'type': 'other'}]})
+        self.assertTrue(responses[2]['error'].startswith('TypeError'))
+        self.assertEqual(opened, ['open', 'close'])
+
+    def test_missing_handler(self):
+        with self.assertRaises(Exception):
+            HandlerRegistry({'a': add_handler}).get('b')
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_stream(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_process(start_handler_worker, handlers={None: chunk_handler})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': 3})
+        responses = read_responses(manager, worker_id, 4)
+        self.assertEqual([a.get('msg') for a in responses[:3]], [0, 1, 2])
+        self.assertEqual(responses[3], {'msg_id': 1, 'seq': 3, 'end': True})
+
+
+class TestWarmProcesses(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    # create_process hands its target to a prestarted process and a replacement is started
+    def test_handoff(self):
+        for method in ('fork', 'spawn'):
+            manager = ProcessManagement(start_method=method, warm_processes=1)
+            self.addCleanup(manager.shutdown_all, timeout=5)
+            self.assertEqual(wait_for_spares(manager, 1), 1)
+            spare = manager.spares[0][0]
+
+            worker_id = manager.create_process(start_handler_worker, handlers={None: pid_handler})
+            self.assertIs(manager.workers[worker_id]['object'], spare)
+            manager.write_work(worker_id, {'msg_id': 1, 'msg': None})
+            self.assertEqual(read_responses(manager, worker_id, 1)[0]['msg'], spare.pid)
+
+            self.assertEqual(wait_for_spares(manager, 1), 1)
+            self.assertIsNot(manager.spares[0][0], spare)
+
+    # spares nobody took are stopped with the workers
+    def test_shutdown_stops_spares(self):
+        manager = ProcessManagement(start_method='fork', warm_processes=2)
+        self.assertEqual(wait_for_spares(manager, 2), 2)
+        spares = [a[0] for a in manager.spares]
+        manager.shutdown_all(timeout=5)
+        self.assertFalse(any(a.is_alive() for a in spares))
+
+
+class TestSupervise(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    # a worker killed in the middle of a job is restarted and the job runs again
+    def test_killed_worker_is_restarted(self):
+        manager = ProcessManagement(supervise=True, heartbeat_interval=0.1)
+        worker_id = manager.create_process(start_handler_worker, handlers={None: nap_handler})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': 0.5})
+        time.sleep(0.3)     # running it
+        os.kill(manager.workers[worker_id]['object'].pid, signal.SIGKILL)
+
+        self.assertEqual(read_responses(manager, worker_id, 1), [{'msg_id': 1, 'msg': 0.5}])
+        self.assertEqual(manager.get_worker_health()[worker_id]['restarts'], 1)
+        self.assertTrue(manager.get_worker_health()[worker_id]['alive'])
+
+    # a job that keeps killing its worker is answered with an error after max_retries
+    def test_max_retries(self):
+        manager = ProcessManagement(supervise=True, heartbeat_interval=0.1, max_retries=1)
+        worker_id = manager.create_process(start_handler_worker, handlers={None: exit_handler})
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work(worker_id, {'msg_id': 1, 'msg': None})
+        responses = read_responses(manager, worker_id, 1)
+        self.assertTrue(responses[0]['error'].startswith('WorkerLost'))
+        self.assertEqual(manager.workers[worker_id]['restarts'], 2)
+
+
+class TestRingWorkers(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    # a killed worker is restarted on its ring and its jobs are written again
+    def test_supervised_ring_workers_survive_kills(self):
+        manager = ProcessManagement(scheduler='round_robin', channel='ring', supervise=True, heartbeat_interval=0.2)
+        ids = [manager.create_process(start_handler_worker, handlers={None: nap_handler}) for i in range(2)]
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        count = 600
+        manager.write_work_many(ids[0], [{'msg_id': i, 'msg': 0.002} for i in range(count)])
+        answered = set()
+        killed = 0
+        deadline = time.time() + 30
+        while len(answered) < count and time.time() < deadline:
+            answered.update(a['msg_id'] for a in manager.read_work_many(ids[0], None, 0.2))
+            if killed < 3 and len(answered) > (killed + 1) * 100:
+                os.kill(manager.workers[ids[killed % 2]]['object'].pid, signal.SIGKILL)
+                killed += 1
+
+        self.assertEqual(len(answered), count)
+        self.assertEqual(sum(manager.workers[a]['restarts'] for a in ids), 3)
+
+
+class TestBatchHandlers(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    def test_batch_handler(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_process(start_handler_worker, batch_handlers={'double': double_batch},
+            batch_wait=50)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        manager.write_work_many(worker_id, [{'msg_id': i, 'msg': i, 'type': 'double'} for i in range(10)])
+        responses = read_responses(manager, worker_id, 10)
+        self.assertEqual(sorted(a['msg'][0] for a in responses), [i * 2 for i in range(10)])
+        self.assertGreater(max(a['msg'][1] for a in responses), 1)     # more than one job per call
+
+    # an Exception in the results fails only its own job, other types run one by one
+    def test_failed_items_and_mixed_types(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_thread(start_handler_worker, handlers={None: nap_handler},
+            batch_handlers={'check': check_batch}, batch_wait=50)
+        self.addCleanup(manager.shutdown_all, timeout=5)
+
+        jobs = [{'msg_id': i, 'msg': i, 'type': 'check'} for i in range(4)]
+        jobs.insert(2, {'msg_id': 9, 'msg': 0})
+        manager.write_work_many(worker_id, jobs)
+        responses = {a['msg_id']: a for a in read_responses(manager, worker_id, 5)}
+        self.assertEqual(responses[9], {'msg_id': 9, 'msg': 0})
+        self.assertEqual([responses[i].get('msg') for i in (0, 2)], [0, 2])
+        self.assertEqual([responses[i].get('error') for i in (1, 3)], ['ValueError: odd'] * 2)
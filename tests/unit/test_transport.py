@@ -0,0 +1,193 @@
+import unittest
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+from multiprocessing.connection import Client, AuthenticationError
+
+from intounknown_lib.lib_processing import ProcessManagement, start_handler_worker
+from intounknown_lib.lib_coms import ThreadCom
+from intounknown_lib.lib_transport import RemoteWorker
+from intounknown_lib.remote_worker import run_remote_worker
+from intounknown_lib.lib_logging import log_sink, printLine, ERROR
+
+
+AUTHKEY = b'test key'
+
+
+def pid_handler(msg, context):
+    time.sleep(0.05)
+    return [msg, os.getpid()]
+
+
+def pid_worker(queues=None, worker_id=None):
+    start_handler_worker(queues, worker_id, handlers={None: pid_handler})
+
+
+def logging_worker(queues=None, worker_id=None):
+    pid_worker(queues, worker_id)
+    printLine('remote worker', worker_id, 'stopped', level=ERROR)
+
+
+def start_remote(address, authkey, count):
+    procs = [multiprocessing.Process(target=run_remote_worker, args=(address, pid_worker, authkey),
+        kwargs={'worker_id': i}) for i in range(count)]
+    for a in procs:
+        a.start()
+    return procs
+
+
+# accept remote workers until count of them joined
+def accept(manager, count, timeout=10):
+    ids = []
+    deadline = time.time() + timeout
+    while len(ids) < count and time.time() < deadline:
+        ids += manager.accept_remote_workers()
+        time.sleep(0.05)
+    return ids
+
+
+def read_responses(manager, worker_id, count, timeout=10):
+    responses = []
+    deadline = time.time() + timeout
+    while len(responses) < count and time.time() < deadline:
+        responses += manager.read_work_many(worker_id, None, 0.2)
+    return responses
+
+
+# connection that drops while the pump sends, the reader thread notices it first
+class DroppingConnection:
+    def __init__(self):
+        self.handlers = {}
+        self.on_close = None
+        self.alive = True
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+    def send(self, channel, msg):
+        self.alive = False
+        self.on_close(self)
+        raise OSError('connection reset')
+
+    def join(self, timeout=None):
+        pass
+
+    def close(self):
+        self.alive = False
+
+
+class TestRemoteWorker(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    # a job whose send fails goes back to the work queue once
+    def test_failed_send_requeues_once(self):
+        for job in ({'msg_id': 1, 'msg': 'a'}, 'no msg_id'):
+            link = RemoteWorker(DroppingConnection(), {'prefetch': 2})
+            work_in = ThreadCom()
+            work_in.write(job)
+            link.start(work_in, ThreadCom())
+            link.pump.join(5)
+            self.assertEqual(work_in.read_many(), [job])
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = ERROR   # rejected handshakes are logged as warnings
+        self.manager = ProcessManagement()
+        self.procs = []
+
+    def tearDown(self):
+        self.manager.shutdown_all(timeout=5)
+        for a in self.procs:
+            a.join(5)
+            if a.is_alive():
+                a.terminate()
+        log_sink.level = self.log_level
+
+    def test_tcp_requires_authkey(self):
+        with self.assertRaises(Exception):
+            self.manager.listen(('127.0.0.1', 0))
+
+    def test_remote_workers_on_loopback(self):
+        address = self.manager.listen(('127.0.0.1', 0), authkey=AUTHKEY)
+        self.procs = start_remote(address, AUTHKEY, 3)
+        ids = accept(self.manager, 3)
+        self.assertEqual(len(ids), 3)
+
+        self.manager.write_work_many(ids[0], [{'msg_id': i, 'msg': i} for i in range(12)])
+        responses = read_responses(self.manager, ids[0], 12)
+
+        self.assertEqual(sorted(a['msg_id'] for a in responses), list(range(12)))
+        self.assertTrue(all(a['msg'][0] == a['msg_id'] for a in responses))
+        self.assertGreater(len(set(a['msg'][1] for a in responses)), 1)     # spread over the processes
+
+        result = self.manager.shutdown_all(timeout=5)
+        self.assertEqual(sorted(result['stopped']), sorted(ids))
+        for a in self.procs:
+            a.join(5)
+            self.assertEqual(a.exitcode, 0)
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'workers.sock')
+        address = self.manager.listen(path)
+        self.procs = start_remote(address, None, 1)
+        ids = accept(self.manager, 1)
+        self.assertEqual(len(ids), 1)
+
+        self.manager.write_work(ids[0], {'msg_id': 1, 'msg': 'a'})
+        responses = read_responses(self.manager, ids[0], 1)
+        self.assertEqual(responses[0]['msg'][0], 'a')
+
+    def test_rejects_bad_clients(self):
+        address = self.manager.listen(('127.0.0.1', 0), authkey=AUTHKEY, handshake_timeout=0.5)
+
+        with self.assertRaises(AuthenticationError):
+            Client(address, authkey=b'wrong key')
+
+        silent = socket.create_connection(address)     # never answers the challenge
+        not_a_dict = Client(address, authkey=AUTHKEY)
+        not_a_dict.send(('hello', 'worker'))
+        junk = Client(address, authkey=AUTHKEY)
+        junk.send(['junk'])
+
+        # a slow or bad client does not hold up the next one
+        self.procs = start_remote(address, AUTHKEY, 1)
+        ids = accept(self.manager, 1)
+        self.assertEqual(len(ids), 1)
+        time.sleep(1)
+        self.assertEqual(self.manager.accept_remote_workers(), [])
+
+        for a in (silent, not_a_dict, junk):
+            a.close()
+
+    # a forked worker writes its last lines itself, atexit does not run in the child
+    def test_forked_worker_flushes_its_log(self):
+        path = os.path.join(tempfile.mkdtemp(), 'log.txt')
+        log_sink.open(path)
+        self.addCleanup(setattr, log_sink, 'stream', None)
+        self.addCleanup(log_sink.stream.close)
+        printLine('manager', level=ERROR, flush=True)     # the writer thread runs before the fork
+
+        address = self.manager.listen(os.path.join(tempfile.mkdtemp(), 'workers.sock'))
+        ctx = multiprocessing.get_context('fork')
+        self.procs = [ctx.Process(target=run_remote_worker, args=(address, logging_worker), kwargs={'worker_id': 7})]
+        self.procs[0].start()
+        self.assertEqual(len(accept(self.manager, 1)), 1)
+
+        self.manager.shutdown_all(timeout=5)
+        self.procs[0].join(5)
+        self.assertEqual(self.procs[0].exitcode, 0)
+        log_sink.flush()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'manager\nremote worker 7 stopped\n')
@@ -0,0 +1,107 @@
+import unittest
+import threading
+import time
+
+from intounknown_lib.lib_processing import ProcessManagement, start_handler_worker
+from intounknown_lib.lib_coms import ThreadCom, PriorityCom, wait_for_any
+from intounknown_lib.lib_logging import log_sink, WARNING
+
+
+def slow_handler(msg, ctx):
+    time.sleep(0.05)
+    return threading.get_ident()
+
+
+class TestWakeup(unittest.TestCase):
+    def setUp(self):
+        self.log_level = log_sink.level
+        log_sink.level = WARNING
+
+    def tearDown(self):
+        log_sink.level = self.log_level
+
+    # every thread blocked on a shared queue is woken by one write_many
+    def _wait_all(self, com, count=8):
+        ready = threading.Barrier(count + 1)
+        woken = []
+
+        def waiter():
+            ready.wait()
+            if wait_for_any([com], 2):
+                woken.append(time.time())
+
+        threads = [threading.Thread(target=waiter) for i in range(count)]
+        for a in threads:
+            a.start()
+        ready.wait()
+        time.sleep(0.2)     # all of them asleep
+
+        start = time.time()
+        com.write_many(list(range(count)))
+        for a in threads:
+            a.join()
+
+        self.assertEqual(len(woken), count)
+        self.assertLess(max(woken) - start, 0.5)
+
+    def test_shared_thread_queue(self):
+        self._wait_all(ThreadCom())
+
+    def test_shared_priority_queue(self):
+        self._wait_all(PriorityCom([ThreadCom(), ThreadCom()]))
+
+    def test_write_wakes_one_waiter_per_message(self):
+        com = ThreadCom()
+        woken = []
+
+        def waiter():
+            if wait_for_any([com], 0.5):
+                woken.append(com.read())
+
+        threads = [threading.Thread(target=waiter) for i in range(2)]
+        for a in threads:
+            a.start()
+        time.sleep(0.1)
+        com.write('a')
+        com.write('b')
+        for a in threads:
+            a.join()
+
+        self.assertCountEqual(woken, ['a', 'b'])
+
+    def test_close_wakeup_sockets(self):
+        com = ThreadCom()
+        reader = com.waitable()
+        com.close()
+        self.assertIsNone(com.wakeup)
+        self.assertEqual(reader.fileno(), -1)
+        com.write('a')      # no socket to signal
+        self.assertGreaterEqual(com.fileno(), 0)    # a new pair
+        self.assertEqual(com.read(), 'a')
+        com.close()
+
+    def test_shutdown_all_closes_wakeup_sockets(self):
+        manager = ProcessManagement()
+        worker_id = manager.create_thread(start_handler_worker, handlers={None: slow_handler})
+        manager.get_work_out_fileno(worker_id)
+        manager.shutdown_all(timeout=5)
+        self.assertIsNone(manager.thread_queue_work_out.wakeup)
+
+    # 16 jobs of 50ms on 8 idle thread workers sharing the work queue run in parallel
+    def test_idle_thread_workers_share_a_burst(self):
+        for kwargs in ({}, {'priority_lanes': 2}):
+            manager = ProcessManagement(**kwargs)
+            workers = [manager.create_thread(start_handler_worker, handlers={None: slow_handler}) for i in range(8)]
+            time.sleep(0.3)
+
+            start = time.time()
+            manager.write_work_many(workers[0], [{'msg_id': i, 'msg': i} for i in range(16)])
+            responses = []
+            while len(responses) < 16 and time.time() - start < 5:
+                responses += manager.read_work_many(workers[0], None, 0.5)
+            elapsed = time.time() - start
+            manager.shutdown_all(timeout=5)
+
+            self.assertEqual(len(responses), 16)
+            self.assertGreater(len(set(a['msg'] for a in responses)), 1)
+            self.assertLess(elapsed, 0.5)
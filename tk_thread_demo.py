@@ -1,10 +1,12 @@
 from copy import deepcopy
 from pprint import pprint
+import platform
 import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter import messagebox
 from intounknown_lib.tk_gui import install_default_styles, EnhancedButton, EnhancedLabel, EnhancedEntry, EnhancedText, EnhancedCheckbox, ScrollFrame, EnhancedCombobox, EnhancedListbox, HiddenField, EnhancedTable
-from intounknown_lib.lib_processing import ProcessManagement, start_worker, printLine, BackgroundManager, start_background_worker
+from intounknown_lib.lib_processing import ProcessManagement, start_worker, BackgroundManager, start_background_worker
+from intounknown_lib.lib_logging import printLine
 
 class Application(tk.Tk):
     def __init__(self, process_manager, *args, **kwargs):
@@ -14,8 +16,14 @@ class Application(tk.Tk):
         self.job_id = 1
 
         #self.after(1000, lambda: print('after method'))
-        self.bg_mgt = BackgroundManager(process_manager, self.after)
-        self.bg_mgt.set_notify_subscriber(self._evt_update_job_queue)
+        if platform.system() == 'Windows':
+            self.bg_mgt = BackgroundManager(process_manager, self.after)    # Tk file handlers are not available, poll
+        else:
+            # wake up as soon as a worker writes a response instead of polling
+            self.bg_mgt = BackgroundManager(process_manager, self.after,
+                add_reader_cb=lambda fd, cb: self.tk.createfilehandler(fd, tk.READABLE, lambda f, m: cb()),
+                remove_reader_cb=self.tk.deletefilehandler)
+        self.bg_mgt.set_notify_subscriber(self._evt_update_job_queue, delta=True)
 
 
         self.title("TK Thread Demo")
@@ -62,15 +70,10 @@ class Application(tk.Tk):
         self.bg_mgt.add_job(request_job_msg, self._evt_update_form)
         self.job_id += 1
 
-    def _evt_update_job_queue(self, jobs):
-        #if len(jobs) < 1:
-        #    return
-
-        options = []
-        for job in jobs:
-            options.append((job, job))
-
-        self.inputs['jobs'].set_options(options)
+    # only the jobs that were added or completed since the last update
+    def _evt_update_job_queue(self, added, completed):
+        self.inputs['jobs'].remove_options(completed)
+        self.inputs['jobs'].add_options(added)
 
 
     def _evt_update_form(self, response):